@@ -1,33 +1,318 @@
 import os
 import cv2
-import shutil
 import numpy as np
 import wx
-import time
 import re
-from natsort import natsorted
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from SortingHatArchive import path_exists, read_image
+from SortingHatCache import FrameCache
+from SortingHatClaims import ClaimManager
+from SortingHatDuplicates import HASH_FILE_NAME, HashCache, cluster_hashes, hash_samples
+from SortingHatEngine import SortingHatEngine
+from SortingHatMetrics import metrics
+from SortingHatPrescan import INDEX_FILE_NAME, EmptyFrameIndex
+from SortingHatProxy import PROXY_DIRECTORY_NAME, ProxyCache
+from SortingHatSuggest import FEATURE_FILE_NAME, LabelSuggester
+from SortingHatVideo import ClipStream, DecodedClip, PlaybackClock, clip_info, compose_frames, compose_grid, \
+    decode_clip, fit_labels, kept_frame_count, resize_frames
 USE_BUFFERED_DC = True
-class SortingHat():
+
+# Class: DecodedSample
+# Description: a sample as read from disk, before it is fitted to the window: the still image and the
+# DecodedClip at their native resolution. Keeping these around lets a resize re-render without touching the avi.
+# The status is 'ok', 'missing' or 'empty', or 'stream' for a clip too big to decode up front, in which case
+# clip is a ClipStream that reads the frames while they are played.
+class DecodedSample():
+
+    def __init__(self, status, image=None, clip=None):
+        self.status = status
+        self.image = image
+        self.clip = clip
+
+    # Function: nbytes
+    # Description: the memory the decoded frames take up, for the frame cache budget. Frames memory-mapped
+    # from a proxy live in the page cache and aren't counted.
+    def nbytes(self):
+        total = self.image.nbytes if self.image is not None else 0
+        if self.status == 'ok' and not isinstance(self.clip.frames, np.memmap):
+            total += self.clip.frames.nbytes
+        return total
+
+
+# Class: PreparedSample
+# Description: holds everything needed to show one JPG/AVI pair: the resized still image, the composed
+# (image + video frame + labels) RGB frame stack and the video fps. The status is 'ok', 'missing' or 'empty'.
+# A 'stream' sample has no composed frames; source holds the native video frames (a ClipStream or the decoded
+# stack) and each frame is composed only when it is shown.
+class PreparedSample():
+
+    def __init__(self, status, display_image=None, frames=None, fps=0, source=None):
+        self.status = status
+        self.display_image = display_image
+        self.frames = frames if frames is not None else []
+        self.fps = fps
+        self.source = source
+
+
+# Function: decode_sample
+# Description: reads a single sample without touching wx, so it can run on a worker thread.
+# decode_settings is the (remove_empty_frames, frame_stride, max_frames) part of SortingHat.render_settings().
+# If an empty frame index is given, known samples skip the empty frame check and new results are recorded in it.
+# A clip whose decoded frames would take more than max_bytes is not decoded; it is only checked for empty frames
+# and comes back as a 'stream' sample. With dsize, the image and frames are scaled down to it while decoding
+# (used for the grid thumbnails). If a proxy cache is given and holds a current proxy of the sample, its
+# memory-mapped frames are used instead of decoding the avi.
+def decode_sample(sample, decode_settings, empty_index=None, max_bytes=None, dsize=None, proxy_cache=None):
+    remove_empty_frames, frame_stride, max_frames = decode_settings
+    image_name = os.path.join(sample[0], sample[1] + ".jpg")
+    video_name = os.path.join(sample[0], sample[1] + ".avi")
+
+    # If we want to ignore/remove pairs whose avi files have empty frames in them, a sample the index
+    # already knows about is settled without decoding. Unknown samples are checked during the decode below.
+    status = None
+    if remove_empty_frames and empty_index is not None:
+        status = empty_index.lookup(video_name)
+        if status == 'empty':
+            return DecodedSample('empty')
+    black_fraction, black_level = (empty_index.black_fraction, empty_index.black_level) \
+        if empty_index is not None else (None, 8)
+
+    # Proxies only exist for clips without empty frames, as judged by the criterion they were built with.
+    proxy = proxy_cache.load(video_name) if proxy_cache is not None else None
+    if proxy is not None and path_exists(image_name) and \
+            (status is not None or not remove_empty_frames or proxy.criterion == [black_fraction, black_level]):
+        if remove_empty_frames and status is None and empty_index is not None:
+            empty_index.record(video_name, 'valid')
+        frames = proxy.frames[::frame_stride][:max_frames]
+        image = proxy.image
+        if dsize is not None:
+            frames = resize_frames(frames, dsize, cv2.INTER_AREA)
+            image = cv2.resize(image, dsize, interpolation=cv2.INTER_AREA)
+        return DecodedSample('ok', image, DecodedClip(frames, proxy.fps, proxy.frame_count, 0))
+
+    image = read_image(image_name)
+    if image is None or not path_exists(video_name):
+        return DecodedSample('missing')
+    if dsize is not None:
+        image = cv2.resize(image, dsize, interpolation=cv2.INTER_AREA)
+
+    check_empty = remove_empty_frames and status is None
+    stream = None
+    if max_bytes is not None:
+        info = clip_info(video_name)
+        if info is None:
+            return DecodedSample('missing')
+        if kept_frame_count(info[1], frame_stride, max_frames) * info[2] * info[3] * 3 > max_bytes:
+            stream = ClipStream(video_name, frame_stride, max_frames, info)
+    clip = decode_clip(video_name, dsize, frame_stride, max_frames, check_empty=check_empty,
+                       stop_on_empty=True, black_fraction=black_fraction, black_level=black_level,
+                       keep_frames=stream is None)
+    # A clip without a single readable frame is treated as missing, as in the prescan, rather than recorded
+    # as valid. A clip that was only opened for streaming (neither checked nor kept) wasn't read at all.
+    if clip is None or (clip.frame_count == 0 and (check_empty or stream is None)):
+        return DecodedSample('missing')
+    if check_empty:
+        if empty_index is not None:
+            empty_index.record(video_name, 'empty' if clip.empty_frames else 'valid')
+        if clip.empty_frames:
+            return DecodedSample('empty')
+    if stream is not None:
+        return DecodedSample('stream', image, stream)
+    return DecodedSample('ok', image, clip)
+
+
+# Function: render_sample
+# Description: fits a decoded sample to the display size and composes it with the category labels.
+# If the composed frames would take more than max_bytes (as bitmaps, 4 bytes a pixel), they are left to be
+# composed one at a time during playback instead.
+def render_sample(decoded, display_sizes, category_strings, frame_stride, max_bytes=None):
+    if decoded.status not in ('ok', 'stream'):
+        return PreparedSample(decoded.status)
+    display_image = cv2.resize(decoded.image, dsize=display_sizes, interpolation=cv2.INTER_CUBIC)
+    if decoded.status == 'stream':
+        return PreparedSample('stream', display_image, fps=decoded.clip.fps / frame_stride, source=decoded.clip)
+    if max_bytes is not None and len(decoded.clip.frames) * display_sizes[0] * 2 * display_sizes[1] * 4 > max_bytes:
+        return PreparedSample('stream', display_image, fps=decoded.clip.fps / frame_stride,
+                              source=decoded.clip.frames)
+
+    # Put the image, the video frames and the category labels side by side in one go.
+    with metrics.stage('resize'):
+        resized = resize_frames(decoded.clip.frames, display_sizes)
+    with metrics.stage('compose'):
+        frames = compose_frames(display_image, resized, display_sizes, category_strings)
+
+    # Only every frame_stride-th frame was kept, so play them proportionally slower to keep real time.
+    return PreparedSample('ok', display_image, frames, decoded.clip.fps / frame_stride)
+
+
+# Class: SamplePrefetcher
+# Description: keeps the samples around the current index decoded and composed on a small worker pool.
+# Decoded samples are kept separately from their renders, so a new window size only re-renders them.
+# They are kept in a FrameCache of decode_budget bytes, so going back to a recent sample doesn't decode it
+# again; render_budget is the largest composed clip that is built up front rather than streamed.
+# Only the UI thread calls into this class, apart from prepare which is what the workers run.
+class SamplePrefetcher():
+
+    def __init__(self, radius=2, workers=2, decode_budget=512 * 2 ** 20, render_budget=512 * 2 ** 20):
+        # radius is the number of samples kept ready on each side of the current one.
+        self.radius = radius
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = {}
+        self.decoded = FrameCache(decode_budget)
+        self.render_budget = render_budget
+        self.empty_index = None
+        self.mover = None
+        self.proxy_cache = None
+
+    # Function: prepare
+    # Description: renders a sample for the given settings, decoding it first unless that was already done.
+    def prepare(self, sample, settings):
+        display_sizes, category_strings, remove_empty_frames, frame_stride, max_frames = settings
+        decode_key = (sample, settings[2:])
+        decoded = self.decoded.get(decode_key)
+        if decoded is None:
+            # A sample that was just moved back by an undo may still be on its way.
+            if self.mover is not None:
+                self.mover.wait_for(sample)
+            with metrics.stage('decode'):
+                decoded = decode_sample(sample, settings[2:], self.empty_index, self.decoded.budget_bytes,
+                                        proxy_cache=self.proxy_cache)
+            self.decoded.put(decode_key, decoded, decoded.nbytes())
+        return render_sample(decoded, display_sizes, category_strings, frame_stride, self.render_budget)
+
+    # Function: get
+    # Description: returns the prepared sample, waiting on its worker if it is still being built.
+    # Anything that was never scheduled is built right here rather than queued behind the neighbours.
+    def get(self, sample, settings):
+        future = self.pending.get((sample, settings))
+        if future is None or future.cancelled():
+            future = Future()
+            future.set_result(self.prepare(sample, settings))
+            self.pending[(sample, settings)] = future
+        return future.result()
+
+    # Function: refill
+    # Description: cancels work for samples that left the window (or were built at another size) and
+    # schedules the ones that entered it, nearest first. Decoded samples stay in the cache until evicted.
+    def refill(self, sample_paths, index, settings):
+        wanted = []
+        for offset in range(self.radius + 1):
+            for position in (index + offset, index - offset):
+                if 0 <= position < len(sample_paths) and (sample_paths[position], settings) not in wanted:
+                    wanted.append((sample_paths[position], settings))
+        for key in list(self.pending):
+            if key not in wanted:
+                self.pending.pop(key).cancel()
+        for key in wanted:
+            if key not in self.pending:
+                self.pending[key] = self.executor.submit(self.prepare, *key)
+
+    # Function: forget
+    # Description: drops a sample that was sorted or found invalid so it is not handed out again.
+    def forget(self, sample):
+        for key in list(self.pending):
+            if key[0] == sample:
+                self.pending.pop(key).cancel()
+        self.decoded.discard_where(lambda key: key[0] == sample)
+
+    def shutdown(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = {}
+        self.decoded.clear()
+        self.executor.shutdown(wait=False)
+
+
+# Class: StreamedFrames
+# Description: stands in for the list of bitmaps when a clip is too big to hold as bitmaps. The frame being
+# painted is resized, composed with the image and the labels and turned into a bitmap just in time; only the
+# last one is kept, so the repaints between two timer ticks don't build it again.
+class StreamedFrames():
+
+    def __init__(self, source, display_image, display_sizes, category_strings):
+        self.source = source
+        self.display_image = display_image
+        self.display_sizes = tuple(display_sizes)
+        self.category_strings = tuple(category_strings)
+        self.index = None
+        self.bitmap = None
+
+    def __len__(self):
+        return len(self.source)
+
+    def __getitem__(self, index):
+        if index != self.index:
+            frame = self.source[index]
+            resized = np.zeros((1, self.display_sizes[1], self.display_sizes[0], 3), dtype=np.uint8)
+            if frame is not None:
+                cv2.resize(frame, self.display_sizes, dst=resized[0], interpolation=cv2.INTER_CUBIC)
+            with metrics.stage('stream_frame'):
+                composed = compose_frames(self.display_image, resized, self.display_sizes,
+                                          self.category_strings)[0]
+                self.bitmap = wx.Bitmap.FromBuffer(composed.shape[1], composed.shape[0], composed)
+            self.index = index
+        return self.bitmap
+
+    def close(self):
+        if isinstance(self.source, ClipStream):
+            self.source.close()
+
+
+# Class: GridFrames
+# Description: the frames of the grid view, indexed like the list of bitmaps of a single sample so the same
+# playback clock and paint code drive it. Each page frame is composed from the thumbnails when it is painted.
+class GridFrames():
+
+    def __init__(self, cells, columns, rows, cell_size, highlights):
+        self.cells = [(cell.image, cell.clip.frames) for cell in cells]
+        self.columns = columns
+        self.rows = rows
+        self.cell_size = cell_size
+        self.highlights = highlights
+        self.length = max([len(frames) for image, frames in self.cells] + [1])
+        self.index = None
+        self.bitmap = None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index != self.index:
+            with metrics.stage('grid_frame'):
+                page = compose_grid(self.cells, self.columns, self.rows, self.cell_size, index, self.highlights)
+                self.bitmap = wx.Bitmap.FromBuffer(page.shape[1], page.shape[0], page)
+            self.index = index
+        return self.bitmap
+
+
+# Class: SortingHat
+# Description: the SortingHatEngine plus everything needed to display the samples.
+class SortingHat(SortingHatEngine):
 
     # Set up the variables we need for SortingHat.
     def __init__(self):
-        self.behavior_names = []
-        self.behavior_key_mapping = []
-        self.input_image_directory = None
-        self.output_image_directory = None
+        super(SortingHat, self).__init__()
         self.remove_empty_frames = True
         self.image_display_sizes = 0, 0
-        self.undo_key = None
         self.right_arrow = 316
         self.left_arrow = 314
-        self.behavior_sample_paths = None
-        self.category_directories = None
-        self.category_strings = None
-        self.undo_list = [[], [], []]
+        self.redo_key_code = 25
+        # ctrl+d dumps the stage timings (turning them on if they were off), ctrl+p starts/stops profiling.
+        self.metrics_key_code = 4
+        self.profile_key_code = 16
+        # ctrl+s commits the samples labelled so far with defer_moves (see commit_labels).
+        self.commit_key_code = 19
+        # Playback speed keys and the speeds they step through; 1x plays at half the clip's own frame rate.
+        # Like the grid selection key, they only work if no category was given the same key.
+        self.slower_key = '['
+        self.faster_key = ']'
+        self.playback_speeds = (0.25, 0.5, 1.0, 2.0, 4.0)
+        self.playback_rate = 0.5
         self.label_scale = 20
         self.label_height = np.inf
         self.label_width = np.inf
-        self.current_index = 0
         self.image_name = None
         self.video_name = None
         self.cap = None
@@ -38,6 +323,63 @@ class SortingHat():
         self.video = None
         self.video_frames = []
         self.timer_interval = None
+        self.prepared_sample = None
+        # Memory budgets: decoded clips are cached across samples in decode_cache_bytes, the bitmaps of recently
+        # shown (sample, window size) combinations in bitmap_cache_bytes. A clip that doesn't fit is streamed.
+        self.decode_cache_bytes = 512 * 2 ** 20
+        self.bitmap_cache_bytes = 512 * 2 ** 20
+        self.prefetcher = SamplePrefetcher(decode_budget=self.decode_cache_bytes,
+                                           render_budget=self.bitmap_cache_bytes)
+        # The empty frame index is saved whenever index_save_every new results came in (as in the prescan),
+        # so a crash doesn't lose them all; see evt_timer.
+        self.empty_index = None
+        self.index_save_every = 1000
+        # Long clips can be previewed from a subsample: keep every frame_stride-th frame, at most max_frames.
+        self.frame_stride = 1
+        self.max_frames = None
+        # The bitmaps of recent (sample, window size) combinations, so going back and forth
+        # between window sizes or neighbouring samples doesn't rebuild them.
+        self.prepared_key = None
+        self.prepared_bitmaps = None
+        self.bitmap_cache = FrameCache(self.bitmap_cache_bytes)
+        # Key presses only queue the file moves; a PairMover thread carries them out.
+        self.background_moves = True
+        # Grid mode shows a page of grid_columns x grid_rows samples as small looping thumbnails. Thumbnails are
+        # decoded a page at a time on their own pool (the next page in the background) and kept in a FrameCache.
+        self.grid_key_code = 7
+        self.select_key = ' '
+        self.up_arrow = 315
+        self.down_arrow = 317
+        self.grid_columns = 4
+        self.grid_rows = 3
+        self.grid_max_frames = 30
+        self.grid_cells = []
+        self.grid_selection = set()
+        self.thumbnail_cache = FrameCache(128 * 2 ** 20)
+        self.thumbnail_executor = ThreadPoolExecutor(max_workers=4)
+        # The disk budget of the proxies of a SortingHatProxy run (like its --budget-mb). Once the window closes,
+        # the least recently viewed proxies beyond it are evicted; None keeps them all.
+        self.proxy_cache = None
+        self.proxy_budget_bytes = None
+        # With ctrl+c, near-duplicate samples (perceptual hashes within cluster_radius bits) are found on a
+        # background thread, brought together in the order, and in cluster mode a category key sorts them all.
+        self.cluster_key_code = 3
+        self.cluster_radius = 20
+        self.cluster_workers = 4
+        self.cluster_mode = False
+        self.cluster_thread = None
+        self.cluster_result = None
+        # Category suggestions from the k nearest sorted examples. Enter sorts the current sample into the
+        # suggested category. ctrl+r brings the samples suggested with at least reorder_confidence
+        # together per category, so they come in runs that can be confirmed one after the other.
+        self.accept_key_code = 13
+        self.reorder_key_code = 18
+        self.suggest_k = 9
+        self.reorder_confidence = 0.8
+        self.suggester = None
+        self.suggestion = (None, None, None)
+        self.reorder_thread = None
+        self.reorder_result = None
 
     # Fill in the SortingHat variables and map the behaviors to keys.
     # Some of this will likely be simplified in the future using tuples.
@@ -45,160 +387,421 @@ class SortingHat():
     def prepare_hat(self, behavior_names=[], behavior_key_mapping=[],
                     input_image_directory='', output_image_directory=os.getcwd(),
                     remove_empty_frames=True, image_display_sizes=(600, 600), undo_key='u'):
-        self.behavior_names = behavior_names
-        self.behavior_key_mapping = behavior_key_mapping
-        self.input_image_directory = input_image_directory
-        self.output_image_directory = output_image_directory
         self.remove_empty_frames = remove_empty_frames
         self.image_display_sizes = image_display_sizes
-        self.undo_key = undo_key
-        self.behavior_sample_paths = []
-
-        for root, dirs, files in os.walk(self.input_image_directory, topdown=False):
-            for name in files:
-                if name.endswith('.avi'):
-                    self.behavior_sample_paths.append((root, name[:-4]))
-        if not self.behavior_sample_paths:
-            wx.MessageBox("No Samples in the Input folder", "Complete!", wx.OK | wx.ICON_INFORMATION)
-            self.Close()
-        self.behavior_sample_paths = natsorted(self.behavior_sample_paths)
-        self.category_directories = []
-        self.category_strings = []
-        for i in range(len(self.behavior_names)):
-            self.category_strings.append((self.behavior_key_mapping[i]) + ': ' + self.behavior_names[i])
-            if not os.path.exists(os.path.join(self.output_image_directory, 'categories', self.behavior_names[i])):
-                os.makedirs(os.path.join(self.output_image_directory, 'categories', self.behavior_names[i]))
-            self.category_directories.append(os.path.join(self.output_image_directory, 'categories', self.behavior_names[i]))
-        self.category_strings.append("u: Undo")
+        if not self.prepare(behavior_names, behavior_key_mapping, input_image_directory, output_image_directory,
+                            undo_key):
+            wx.MessageBox(f"{input_image_directory} can't be read in place.\n"
+                          "Use a .zip or an uncompressed .tar archive", "Error", wx.OK | wx.ICON_INFORMATION)
+            return False
+        self.prefetcher.mover = self.mover
+        self.suggester = LabelSuggester(os.path.join(self.output_image_directory, FEATURE_FILE_NAME), k=self.suggest_k)
+        # Samples labelled in deferred mode count as sorted examples before they are committed.
+        self.suggester.start(self.category_directories,
+                             self.label_store.pending_rows() if self.label_store is not None else ())
+
+        # Pick up the empty frame results of earlier sessions or of a SortingHatPrescan run,
+        # using whichever empty frame threshold that run was made with.
+        self.empty_index = EmptyFrameIndex(os.path.join(self.sidecar_directory(), INDEX_FILE_NAME))
+        self.empty_index.load(adopt_criterion=True)
+        self.prefetcher.empty_index = self.empty_index
+        # Use the proxies of a SortingHatProxy run, if there was one.
+        proxy_directory = os.path.join(self.input_image_directory, PROXY_DIRECTORY_NAME)
+        if os.path.isdir(proxy_directory):
+            self.proxy_cache = ProxyCache(proxy_directory, self.proxy_budget_bytes)
+            self.prefetcher.proxy_cache = self.proxy_cache
         self.scale_text()
         self.update_image_pointer()
+        return True
 
     def scale_text(self):
-        # Walk through the category label and pick a scaling factor such that they all fit vertically and
-        # only take up 10% of the horizontal space (centered) and 70% of the vertical space.
-        self.label_scale = 100
-        self.label_height = np.inf
-        self.label_width = np.inf
-        for j in range(len(self.category_strings)):
-            while self.label_height > (self.image_display_sizes[1] / len(self.category_strings)) * .7:
-                self.label_scale = self.label_scale * .9
-                (self.label_width, self.label_height), baseline = cv2.getTextSize(self.category_strings[j],
-                                                                                  cv2.FONT_HERSHEY_SIMPLEX,
-                                                                                  self.label_scale,
-                                                                                  int(2 * self.label_scale))
-                self.label_height = self.label_height + baseline
-            while self.label_width > (self.image_display_sizes[0] * 2 * .1):
-                self.label_scale = self.label_scale * .9
-                (self.label_width, self.label_height), baseline = cv2.getTextSize(self.category_strings[j],
-                                                                                  cv2.FONT_HERSHEY_SIMPLEX,
-                                                                                  self.label_scale,
-                                                                                  int(2 * self.label_scale))
-                self.label_height = self.label_height + baseline
+        # Pick a label scaling factor such that the category labels all fit vertically and only take up
+        # 10% of the horizontal space (centered) and 70% of the vertical space. See fit_labels, which
+        # remembers the result per display size and category set.
+        with metrics.stage('scale_text'):
+            self.label_scale, self.label_width, self.label_height = fit_labels(tuple(self.image_display_sizes),
+                                                                               tuple(self.category_strings))
+
+    # Function: render_settings
+    # Description: everything (besides the sample itself) that changes how a sample is composed.
+    # A prefetched sample is only reused if it was built with the same settings, e.g. after a resize.
+    def render_settings(self):
+        return (tuple(self.image_display_sizes), tuple(self.category_strings), self.remove_empty_frames,
+                self.frame_stride, self.max_frames)
+
+    # Function: check_sample_pointer
+    # Description: the cheap part of update_image_pointer, for the samples a burst of keys passes over. It makes
+    # sure the current sample's pair exists and, when empty samples are removed, that it has no empty frames,
+    # dropping it otherwise as if it had been shown. Whatever the prefetcher or the empty frame index already
+    # know is used; an unknown clip is only decoded far enough to check for empty frames, without keeping,
+    # resizing or composing anything. Only the sample the keys end on is rendered, by update_image_pointer.
+    def check_sample_pointer(self):
+        while self.behavior_sample_paths:
+            if self.current_index >= len(self.behavior_sample_paths):
+                self.current_index = len(self.behavior_sample_paths) - 1
+            sample = self.behavior_sample_paths[self.current_index]
+            image_name = os.path.join(sample[0], sample[1] + ".jpg")
+            video_name = os.path.join(sample[0], sample[1] + ".avi")
+            settings = self.render_settings()
+            status = None
+            future = self.prefetcher.pending.get((sample, settings))
+            if future is not None and future.done() and not future.cancelled():
+                status = future.result().status
+            elif (sample, settings[2:]) in self.prefetcher.decoded:
+                decoded = self.prefetcher.decoded.get((sample, settings[2:]))
+                status = decoded.status if decoded is not None else None
+            if status is None:
+                with metrics.stage('check_sample'):
+                    status = self.check_sample(sample, image_name, video_name)
+            if status in ('missing', 'empty'):
+                print(f"The image or video file was not present: {image_name}" if status == 'missing' else
+                      "Found empty frame in: " + sample[0] + "/" + sample[1])
+                self.prefetcher.forget(sample)
+                self.drop_sample(self.current_index)
+                continue
+            return
+
+    # Function: check_sample
+    # Description: 'missing', 'empty' or 'valid' for a sample nothing is known about yet (see check_sample_pointer).
+    def check_sample(self, sample, image_name, video_name):
+        # A sample that was just moved back by an undo may still be on its way.
+        if self.mover is not None:
+            self.mover.wait_for(sample)
+        if not path_exists(image_name) or not path_exists(video_name):
+            return 'missing'
+        if not self.remove_empty_frames:
+            return 'valid'
+        status = self.empty_index.lookup(video_name) if self.empty_index is not None else None
+        if status is not None:
+            return status
+        black_fraction, black_level = (self.empty_index.black_fraction, self.empty_index.black_level) \
+            if self.empty_index is not None else (None, 8)
+        clip = decode_clip(video_name, frame_stride=self.frame_stride, max_frames=self.max_frames, check_empty=True,
+                           stop_on_empty=True, black_fraction=black_fraction, black_level=black_level,
+                           keep_frames=False)
+        # As in decode_sample: a clip without a single readable frame is missing and isn't recorded.
+        if clip is None or clip.frame_count == 0:
+            return 'missing'
+        status = 'empty' if clip.empty_frames else 'valid'
+        if self.empty_index is not None:
+            self.empty_index.record(video_name, status)
+        return status
 
     def update_image_pointer(self):
-        while True:
-            # Load the latest file name into the image_name and video_name with the correct extension.
-            self.image_name = os.path.join(self.behavior_sample_paths[self.current_index][0],
-                                           self.behavior_sample_paths[self.current_index][1] + ".jpg")
-            self.video_name = os.path.join(self.behavior_sample_paths[self.current_index][0],
-                                           self.behavior_sample_paths[self.current_index][1] + ".avi")
+        while self.behavior_sample_paths:
+            if self.current_index >= len(self.behavior_sample_paths):
+                self.current_index = len(self.behavior_sample_paths) - 1
+            sample = self.behavior_sample_paths[self.current_index]
 
-            # Open and display the image that will be used to categorize the animal.
-            # Catch the error that the file doesn't exist or has moved since sorting started so the
-            # program doesn't crash. Instead, remove it from the list and continue.
-            try:
-                self.display_image = cv2.imread(self.image_name)
-                self.display_image = cv2.resize(self.display_image, dsize=self.image_display_sizes,
-                                                interpolation=cv2.INTER_CUBIC)
-            except:
-                print(f"The image file was not present: {self.image_name}")
-                self.behavior_sample_paths.remove(self.behavior_sample_paths[self.current_index])
-                return
+            # Load the latest file name into the image_name and video_name with the correct extension.
+            self.image_name = os.path.join(sample[0], sample[1] + ".jpg")
+            self.video_name = os.path.join(sample[0], sample[1] + ".avi")
+
+            # The sample is normally already decoded by the prefetcher; otherwise this waits for it.
+            self.prepared_key = (sample, self.render_settings())
+            cached = self.bitmap_cache.get(self.prepared_key)
+            if cached is not None:
+                self.prepared_sample, self.prepared_bitmaps = cached
+            else:
+                with metrics.stage('wait_for_prefetch'):
+                    self.prepared_sample = self.prefetcher.get(sample, self.render_settings())
+                self.prepared_bitmaps = None
 
-            # Open the video that will be used to categorize the animal.
             # Catch the error that the file doesn't exist or has moved since sorting started so the
             # program doesn't crash. Instead, remove it from the list and continue.
-            try:
-                self.cap = cv2.VideoCapture(self.video_name)
-            except:
-                print(f"The video file was not present: {self.image_name}")
-                self.behavior_sample_paths.remove(self.behavior_sample_paths[self.current_index])
-                return
+            if self.prepared_sample.status == 'missing':
+                print(f"The image or video file was not present: {self.image_name}")
+                self.prefetcher.forget(sample)
+                self.drop_sample(self.current_index)
+                continue
 
-            # If we want to ignore/remove pairs whose avi files have empty frames in them
-            # then loop through the avi frames and make sure they ALL have some content.
-            # If ANY of the frames are empty then skip this file.
+            # If we want to ignore/remove pairs whose avi files have empty frames in them, skip this file.
             # Note: it will not delete or remove the files from the directory, so this can
             # cause the appearance of residual files after a sorting session. May
             # change this behavior in the future.
-            if self.remove_empty_frames:
-                found_empty = False
-                while True:
-                    _, frame = self.cap.read()
-                    if frame is None:
-                        break
-                    if not frame.any():
-                        found_empty = True
-                        break
-
-                # If we found an empty frame, remove the filename from our list and print out the filename to
-                # the console if commented.
-                if found_empty:
-                    self.behavior_sample_paths.remove(self.behavior_sample_paths[self.current_index])
-                    print("Found empty frame in: " + self.behavior_sample_paths[self.current_index][0] + "/" +
-                          self.behavior_sample_paths[self.current_index][1])
-                    if not self.behavior_sample_paths:
-                        return
-                else:
-                    self.cap.set(cv2.CAP_PROP_POS_MSEC, 0)
-                    return
+            if self.prepared_sample.status == 'empty':
+                print("Found empty frame in: " + sample[0] + "/" + sample[1])
+                self.prefetcher.forget(sample)
+                self.drop_sample(self.current_index)
+                continue
+
+            self.display_image = self.prepared_sample.display_image
+            self.prefetcher.refill(self.behavior_sample_paths, self.current_index, self.render_settings())
+            if self.suggester is not None:
+                for position in range(self.current_index, min(self.current_index + self.prefetcher.radius + 1,
+                                                              len(self.behavior_sample_paths))):
+                    self.suggester.request(self.behavior_sample_paths[position])
+            return
+        # Nothing is left to show (for now); load_new_video then clears the frames.
+        self.prepared_sample = None
 
     # Dynamically playing (looping) through the video frame also calls a "rescale" function internally within wxpython.
     # However, "rescale" is not optimized at all and therefore spikes the CPU and causes the video to play slowly.
     # This function buffers the video frames after scaling them. Therefore they can be played on screen rapidly
     # without performance issue. It is called every time a new video/image pair is selected or the
-    # window is resized.
+    # window is resized. The decoding and composing already happened in the prefetcher, so only the
+    # bitmaps are built here, straight from the contiguous RGB frames without an intermediate wx.Image.
+    # Clips too big for the bitmap cache are played through StreamedFrames instead.
     def load_new_video(self):
+        if isinstance(self.video_frames, StreamedFrames):
+            self.video_frames.close()
         self.video_frames = []
-        try:
-            self.video = self.cap
-            self.display_image = self.display_image
-        except:
-            print(f"The video file was not present: {self.image_name}")
-            self.behavior_sample_paths.remove(self.behavior_sample_paths[self.current_index])
+        if self.prepared_sample is None or self.prepared_sample.status not in ('ok', 'stream'):
             return
-
-        while True:
-            _, frame = self.video.read()
-            if frame is None:
-                break
+        if self.prepared_bitmaps is not None:
+            self.video_frames = self.prepared_bitmaps
+        elif self.prepared_sample.status == 'stream':
+            self.video_frames = StreamedFrames(self.prepared_sample.source, self.display_image,
+                                               self.image_display_sizes, self.category_strings)
+        else:
+            with metrics.stage('bitmaps'):
+                for composed in self.prepared_sample.frames:
+                    height, width = composed.shape[:2]
+                    self.video_frames.append(wx.Bitmap.FromBuffer(width, height, composed))
+            # The composed frames aren't needed once the bitmaps exist, so the cache doesn't hold on to them.
+            cached_sample = PreparedSample('ok', self.display_image, fps=self.prepared_sample.fps)
+            self.prepared_bitmaps = self.video_frames
+            self.bitmap_cache.put(self.prepared_key, (cached_sample, self.video_frames),
+                                  self.prepared_sample.frames.nbytes // 3 * 4)
+        self.timer_interval = self.prepared_sample.fps
+
+    # Function: cache_stats
+    # Description: the hit/miss counts and resident sizes of the decoded clip, bitmap and thumbnail caches.
+    def cache_stats(self):
+        return {'decoded': self.prefetcher.decoded.stats(), 'bitmaps': self.bitmap_cache.stats(),
+                'thumbnails': self.thumbnail_cache.stats()}
+
+    # Function: record_sort, record_undo, record_redo
+    # Description: keep the suggestion index in step with the category folders. These are also called while the
+    # session journal is replayed, before there is a suggester; it reconciles with the folders when it starts.
+    def record_sort(self, position, category_directory, group=0):
+        sample = self.behavior_sample_paths[position]
+        super(SortingHat, self).record_sort(position, category_directory, group)
+        if self.suggester is not None:
+            self.suggester.sorted(sample, category_directory)
+
+    def record_undo(self):
+        moves = [(self.behavior_sample_paths.sample(self.undo_stack.sample_ids[-i]),
+                  self.behavior_sample_paths.directories[self.undo_stack.categories[-i]])
+                 for i in range(1, self.undo_stack.group_size() + 1)]
+        super(SortingHat, self).record_undo()
+        if self.suggester is not None:
+            for sample, category_directory in moves:
+                self.suggester.unsorted(sample, category_directory)
+
+    def record_redo(self):
+        moves = [(self.behavior_sample_paths.sample(self.redo_stack.sample_ids[-i]),
+                  self.behavior_sample_paths.directories[self.redo_stack.categories[-i]])
+                 for i in range(1, self.redo_stack.group_size() + 1)]
+        super(SortingHat, self).record_redo()
+        if self.suggester is not None:
+            for sample, category_directory in moves:
+                self.suggester.sorted(sample, category_directory)
+
+    # Function: poll_failed_moves
+    # Description: also keeps the suggestion index in step with the samples whose move failed.
+    def poll_failed_moves(self):
+        changes = super(SortingHat, self).poll_failed_moves()
+        if self.suggester is not None:
+            for sample, category_directory, is_sorted in changes:
+                if is_sorted:
+                    self.suggester.sorted(sample, category_directory)
+                else:
+                    self.suggester.unsorted(sample, category_directory)
+        return changes
+
+    # Function: current_suggestion
+    # Description: (category index, confidence) suggested for the current sample, or None. It is only looked
+    # up again when the sample or the index changed, so it can be asked for on every paint.
+    def current_suggestion(self):
+        if self.suggester is None or not self.behavior_sample_paths:
+            return None
+        sample = self.behavior_sample_paths[min(self.current_index, len(self.behavior_sample_paths) - 1)]
+        if self.suggestion[:2] != (sample, self.suggester.version):
+            suggestion = self.suggester.suggest(sample)
+            if suggestion is not None and suggestion[0] in self.behavior_names:
+                suggestion = self.behavior_names.index(suggestion[0]), suggestion[1]
             else:
-                self.video_frames.append(cv2.resize(frame, self.image_display_sizes))
-                frame = cv2.resize(frame, dsize=self.image_display_sizes, interpolation=cv2.INTER_CUBIC)
-                horizontal_concat = np.concatenate((self.display_image, frame), axis=1)
-
-                # Draw the category labels onto the display image.
-                for j in range(len(self.category_strings)):
-                    cv2.putText(horizontal_concat, self.category_strings[j],
-                                (int(self.image_display_sizes[0] - self.label_width / 2),
-                                 self.label_height * (j + 1) + 1),
-                                cv2.FONT_HERSHEY_SIMPLEX, self.label_scale, (255, 0, 0), int(self.label_scale * 2))
-                self.video_frames[-1] = horizontal_concat
-                height, width = self.video_frames[-1].shape[:2]
-                image = wx.Image(width, height)
-                image.SetData(self.video_frames[-1])
-                self.video_frames[-1] = image.ConvertToBitmap()
-        self.timer_interval = self.video.get(cv2.CAP_PROP_FPS)
-        self.video.release()
+                suggestion = None
+            # Not cached until the features are there, so it is asked for again on the next tick.
+            if tuple(sample) not in self.suggester.features:
+                return None
+            self.suggestion = (sample, self.suggester.version, suggestion)
+        return self.suggestion[2]
+
+    # Function: start_reorder
+    # Description: suggests a category for every sample still to sort on a background thread; poll_reorder
+    # picks up the result.
+    def start_reorder(self):
+        if self.reorder_thread is not None or self.suggester is None:
+            return
+        samples = self.behavior_sample_paths
+        sample_ids = [sample_id for sample_id in range(len(samples.alive)) if samples.alive[sample_id]]
+        pairs = [samples.sample(sample_id) for sample_id in sample_ids]
+
+        def run():
+            suggested, confidence = self.suggester.suggest_all(pairs)
+            groups = {}
+            for sample_id, name, value in zip(sample_ids, suggested, confidence):
+                if name is not None and value >= self.reorder_confidence:
+                    groups.setdefault(name, []).append(sample_id)
+            self.reorder_result = groups
+
+        self.reorder_thread = threading.Thread(target=run, name='SortingHatReorder', daemon=True)
+        self.reorder_thread.start()
+
+    # Function: poll_reorder
+    # Description: once the suggestions are in, brings the confidently suggested samples of each category
+    # together. Returns True if that happened, so the display can be refreshed.
+    def poll_reorder(self):
+        if self.reorder_result is None:
+            return False
+        groups, self.reorder_result, self.reorder_thread = self.reorder_result, None, None
+        self.regroup_samples(list(groups.values()))
+        print(f"Grouped {sum(len(group) for group in groups.values())} samples suggested with at least "
+              f"{self.reorder_confidence:.0%} confidence: " +
+              ', '.join(f"{len(group)} {name}" for name, group in sorted(groups.items())))
+        return True
+
+    # Function: start_clustering
+    # Description: hashes the samples still to sort (using and filling the hash cache in the input directory)
+    # and clusters them on a background thread. poll_clusters picks up the result.
+    def start_clustering(self):
+        if self.cluster_thread is not None:
+            return
+        samples = self.behavior_sample_paths
+        sample_ids = [sample_id for sample_id in range(len(samples.alive)) if samples.alive[sample_id]]
+        video_names = [os.path.join(*samples.sample(sample_id)) + '.avi' for sample_id in sample_ids]
+
+        def run():
+            hash_cache = HashCache(os.path.join(self.sidecar_directory(), HASH_FILE_NAME))
+            hash_cache.load()
+            hashes = hash_samples(video_names, hash_cache, self.cluster_workers, ThreadPoolExecutor)
+            self.cluster_result = [[sample_ids[i] for i in cluster]
+                                   for cluster in cluster_hashes(hashes, self.cluster_radius)]
+
+        self.cluster_thread = threading.Thread(target=run, name='SortingHatClusters', daemon=True)
+        self.cluster_thread.start()
+
+    # Function: poll_clusters
+    # Description: once the clustering finished, reorders the samples by cluster and turns on cluster mode.
+    # Returns True if that happened, so the display can be refreshed.
+    def poll_clusters(self):
+        if self.cluster_result is None:
+            return False
+        clusters, self.cluster_result, self.cluster_thread = self.cluster_result, None, None
+        self.set_clusters(clusters)
+        self.cluster_mode = True
+        print(f"Found {len(self.cluster_members)} clusters of near-duplicates holding "
+              f"{len(self.sample_clusters)} samples.")
+        return True
+
+    # Function: grid_page_start
+    # Description: the position of the first sample on the grid page holding the current sample.
+    def grid_page_start(self):
+        page_size = self.grid_columns * self.grid_rows
+        return self.current_index - self.current_index % page_size
+
+    # Function: grid_cell_size
+    # Description: the size of one grid cell for the current window size.
+    def grid_cell_size(self):
+        return max(8, self.image_display_sizes[0] * 2 // self.grid_columns), \
+            max(8, self.image_display_sizes[1] // self.grid_rows)
+
+    # Function: thumbnail_settings
+    # Description: the thumbnail size (half a cell inside its border) and the decode settings for the grid.
+    def thumbnail_settings(self):
+        cell_width, cell_height = self.grid_cell_size()
+        return ((cell_width - 4) // 2, cell_height - 4), \
+            (self.remove_empty_frames, self.frame_stride, self.grid_max_frames)
+
+    # Function: decode_thumbnail
+    # Description: decodes one sample at thumbnail size, or takes it from the thumbnail cache. Runs on the pool.
+    def decode_thumbnail(self, sample, settings):
+        key = (sample, settings)
+        decoded = self.thumbnail_cache.get(key)
+        if decoded is None:
+            if self.mover is not None:
+                self.mover.wait_for(sample)
+            with metrics.stage('decode_thumbnail'):
+                decoded = decode_sample(sample, settings[1], self.empty_index, dsize=settings[0],
+                                        proxy_cache=self.proxy_cache)
+            self.thumbnail_cache.put(key, decoded, decoded.nbytes())
+        return decoded
+
+    # Function: load_grid_page
+    # Description: decodes the thumbnails of the current page in one batch on the pool, dropping samples that
+    # turn out missing or empty (like update_image_pointer does), and starts decoding the next page.
+    def load_grid_page(self):
+        settings = self.thumbnail_settings()
+        page_size = self.grid_columns * self.grid_rows
+        while self.behavior_sample_paths:
+            self.current_index = min(self.current_index, len(self.behavior_sample_paths) - 1)
+            start = self.grid_page_start()
+            samples = [self.behavior_sample_paths[i]
+                       for i in range(start, min(start + page_size, len(self.behavior_sample_paths)))]
+            cells = list(self.thumbnail_executor.map(lambda sample: self.decode_thumbnail(sample, settings),
+                                                     samples))
+            bad = [i for i in range(len(cells)) if cells[i].status != 'ok']
+            for i in reversed(bad):
+                if cells[i].status == 'missing':
+                    print(f"The image or video file was not present: {os.path.join(*samples[i])}.jpg")
+                else:
+                    print("Found empty frame in: " + samples[i][0] + "/" + samples[i][1])
+                self.thumbnail_cache.discard((samples[i], settings))
+                self.drop_sample(start + i)
+            if bad:
+                self.grid_selection.clear()
+                continue
+            self.grid_cells = cells
+            for i in range(start + page_size, min(start + 2 * page_size, len(self.behavior_sample_paths))):
+                self.thumbnail_executor.submit(self.decode_thumbnail, self.behavior_sample_paths[i], settings)
+            return
+        self.grid_cells = []
+
+    # Function: load_grid
+    # Description: makes the current grid page (with the selected cells and the current one highlighted)
+    # the frames to play.
+    def load_grid(self):
+        start = self.grid_page_start()
+        highlights = dict((position - start, (0, 200, 0)) for position in self.grid_selection)
+        highlights[self.current_index - start] = (255, 200, 0)
+        self.video_frames = GridFrames(self.grid_cells, self.grid_columns, self.grid_rows, self.grid_cell_size(),
+                                       highlights)
+        fps = self.grid_cells[0].clip.fps if self.grid_cells else 0
+        self.timer_interval = fps / self.frame_stride
+
+    # Function: grid_sort
+    # Description: sends the selected samples (or the current one if none are selected) to a category as one
+    # action, so a single undo brings them all back.
+    def grid_sort(self, category_index):
+        positions = sorted(self.grid_selection) or [self.current_index]
+        for sample in self.sort_samples(positions, category_index):
+            self.prefetcher.forget(sample)
+        self.grid_selection.clear()
+
+    # Function: toggle_grid_selection
+    # Description: adds the sample at a position to the grid selection, or takes it out again.
+    def toggle_grid_selection(self, position):
+        if position in self.grid_selection:
+            self.grid_selection.remove(position)
+        else:
+            self.grid_selection.add(position)
 
 
 class SortingHatFrame(wx.Frame):
 
     def __init__(self, parent, title, input_directory=os.getcwd(), output_directory=os.path.join(os.getcwd(), 'output/'),
-                 categories=["junk"], category_mapping=["0"]):
+                 categories=["junk"], category_mapping=["0"], watch_input=False, share_input=False,
+                 defer_moves=False):
         super(SortingHatFrame, self).__init__(parent, title=title, size=(600, 300))
         # Declare a new SortingHat.
         self.sort = SortingHat()
+        self.sort.watch_input = watch_input
+        self.sort.defer_moves = defer_moves
+        # When several people sort the same input directory, each one claims chunks of it to work on.
+        if share_input:
+            self.sort.claims = ClaimManager(input_directory)
 
         # These are sample categories which could be used.
         #categories = ['junk', 'curling', 'crawling', 'immobile', 'rolling', 'turning', 'uncoiling']
@@ -207,20 +810,46 @@ class SortingHatFrame(wx.Frame):
         # Initialize the data into the SortingHat which we captured in the initial gui.
         # Things that must be captured in advance are categories, category_mapping, input and output directories.
         # This could be enhanced to also take the default window size, but it doesn't seem necessary at this time.
-        self.sort.prepare_hat(categories,
-                              category_mapping,
-                              input_directory,
-                              output_directory,
-                              True,
-                              (300, 600))
+        prepared = self.sort.prepare_hat(categories,
+                                         category_mapping,
+                                         input_directory,
+                                         output_directory,
+                                         True,
+                                         (300, 600))
         self.panel = wx.Panel(self, wx.ID_ANY, size=(0,0))
-        self.InitUI()
-        # Establish the current image and video to be displayed.
-        self.sort.update_image_pointer()
-        self.sort.load_new_video()
+        # Resize events are debounced by this many milliseconds; see evt_on_resize.
+        self.resize_delay = 150
+        self.resize_call = None
+        self.timer_reloads = 0
+        # The title shows how many file moves are still queued (or labels not committed) while there are any.
+        self.base_title = title
+        self.shown_title = title
+        # Playback follows the clock rather than the timer: the timer only wakes up when the frame changes.
+        # housekeeping_interval bounds the wait so resizes and new samples are still noticed on slow clips.
+        self.clock = PlaybackClock(rate=self.sort.playback_rate)
+        self.housekeeping_interval = 0.25
         self.video_frame = 0
-        # Start the timer.
-        self.timer.Start(milliseconds=(int(1000 / self.sort.timer_interval))*2)
+        # In grid mode a page of thumbnails is shown instead of a single sample; see grid_key_event.
+        self.grid_mode = False
+        self.shown_suggestion = None
+        # Key presses are queued and handled in one go once wx is idle, so a burst of keys (a held arrow or fast
+        # typing) only loads and shows the sample it ends on; see drain_keys.
+        self.key_queue = []
+        self.drain_scheduled = False
+        # With the queue empty while more samples may still come (see samples_left), the window waits for them.
+        self.waiting = False
+        if os.environ.get('SORTINGHAT_PROFILE', '') not in ('', '0'):
+            metrics.start_profile()
+        self.InitUI()
+        # Every way out goes through Close, so onClose always closes the session.
+        if not prepared:
+            # prepare_hat already told the user why.
+            wx.CallAfter(self.Close)
+        elif self.samples_left():
+            # Establish the current image and video to be displayed and start the timer.
+            self.show_sample()
+        else:
+            wx.CallAfter(self.finish, "No Samples in the Input folder")
 
 
     def InitUI(self):
@@ -231,135 +860,396 @@ class SortingHatFrame(wx.Frame):
         self.panel.Bind(wx.EVT_CHAR, self.evt_on_key_event)
         self.Bind(wx.EVT_CHAR, self.evt_on_key_event)
         self.Bind(wx.EVT_SIZE, self.evt_on_resize)
+        self.Bind(wx.EVT_LEFT_DOWN, self.evt_on_click)
+        self.panel.Bind(wx.EVT_LEFT_DOWN, self.evt_on_click)
+        self.Bind(wx.EVT_CLOSE, self.onClose)
         self.Centre()
         self.Show(True)
         self.SetFocus()
 
     # Function: restart_timer
-    # Description: simple function to restart the timer with a new interval based on the current video
-    # This ensures that all samples play at 1/2 their own appropriate frame rate.
-    def restart_timer(self):
+    # Description: starts playing the current video from its first frame, at its own frame rate times the
+    # playback rate (1/2 by default) and speed. With restart_clip off (e.g. after a resize) it keeps its place.
+    def restart_timer(self, restart_clip=True):
         self.timer.Stop()
-        self.timer.Start(milliseconds=(int(1000 / self.sort.timer_interval)*2))
+        if restart_clip:
+            self.clock.start(self.sort.timer_interval, len(self.sort.video_frames))
+        self.show_frame()
+        self.schedule_tick()
+
+    # Function: schedule_tick
+    # Description: wakes the timer up when the next frame is due, or after housekeeping_interval at the latest.
+    def schedule_tick(self):
+        delay = min(self.clock.seconds_to_next_frame(), self.housekeeping_interval)
+        self.timer.StartOnce(max(1, int(delay * 1000 + 0.5)))
+
+    # Function: show_frame
+    # Description: repaints only if the clock moved on to another frame (dropping any it skipped over).
+    def show_frame(self, force=True):
+        frame = self.clock.frame_at()
+        if frame != self.video_frame or force:
+            self.video_frame = frame
+            self.Refresh(eraseBackground=False)
+
+    # Function: change_speed
+    # Description: steps the playback speed up or down through playback_speeds.
+    def change_speed(self, step):
+        speeds = self.sort.playback_speeds
+        current = min(range(len(speeds)), key=lambda i: abs(speeds[i] - self.clock.speed))
+        speed = speeds[max(0, min(len(speeds) - 1, current + step))]
+        if speed != self.clock.speed:
+            self.clock.set_speed(speed)
+            self.update_title()
+            self.timer.Stop()
+            self.schedule_tick()
 
     # Function: evt_on_key_event
-    # Description: captures key input from the user and then take the appropriate action
-    # 1) Move forward and backward through the files based on the arrows.
-    # 2) Move the files to the correct category folder if mapped.
-    # 3) Undo the previous move if the user presses "u".
-    # 4) Ignore the key input if it didn't match anything in items 1 -> 3 above.
+    # Description: queues the key the user pressed. The keys are handled by drain_keys, which wx calls once it
+    # has delivered the key events already waiting, so a burst of keys is handled together.
     def evt_on_key_event(self, event):
         # Keep this print statement here for future key capture debugging if required.
         # print("Modifiers: {} Key Code: {}".format(event.GetModifiers(), event.GetKeyCode()))
 
-        # Get the key that the user pressed.
-        k = event.GetKeyCode()
+        # The key to paint latency runs from the first key of a burst to the paint that follows it.
+        if not self.key_queue:
+            metrics.mark('key')
+        self.key_queue.append(event.GetKeyCode())
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            wx.CallAfter(self.drain_keys)
+
+    # Function: drain_keys
+    # Description: handles the queued keys in the order they were pressed. Moving with the arrows only moves the
+    # current index, so several presses become one jump. A category key is applied to the sample the keys
+    # before it lead to, which is checked (skipping missing or empty samples as if they had been shown) but not
+    # displayed. Only the sample the keys end on is loaded and shown.
+    def drain_keys(self):
+        self.drain_scheduled = False
+        keys, self.key_queue = self.key_queue, []
+        # The window may have been closed while the keys were waiting.
+        if not self:
+            return
+        show = False
+        for k in keys:
+            if k == self.sort.metrics_key_code:
+                self.dump_metrics()
+            elif k == self.sort.profile_key_code:
+                self.toggle_profile()
+            elif k == self.sort.commit_key_code:
+                self.commit_labels()
+            elif self.grid_mode:
+                self.grid_key_event(k)
+            else:
+                show = self.sample_key_event(k) or show
+            # The grid view shows itself (and waits for samples by itself, see show_grid); a sample left to
+            # show before switching to it isn't needed any more.
+            if self.grid_mode:
+                if not self.sort.behavior_sample_paths:
+                    return
+                show = False
+            elif not self.sort.behavior_sample_paths:
+                if not self.wait_for_samples():
+                    return
+                show = True
+        if show:
+            self.show_sample()
+
+    # Function: sample_key_event
+    # Description: takes the action of a key in the single sample view. Returns True if the current sample
+    # changed and has to be shown.
+    # 1) Move forward and backward through the files based on the arrows.
+    # 2) Move the files to the correct category folder if mapped.
+    # 3) Undo the previous move if the user presses "u".
+    # 4) Redo the last undone move if the user presses ctrl+y.
+    # 5) Slow down or speed up the playback with "[" and "]" (0.25x to 4x).
+    # 6) Switch to the grid view with ctrl+g (see grid_key_event for the keys there).
+    #    Find near-duplicates with ctrl+c; in cluster mode a category key sorts a sample's whole cluster.
+    #    Enter sorts the sample into the suggested category; ctrl+r groups the samples by confident suggestion.
+    # 7) Dump the stage timings with ctrl+d, start or stop profiling with ctrl+p, and commit the labels recorded
+    #    so far with ctrl+s (see drain_keys).
+    # 8) Ignore the key input if it didn't match anything in items 1 -> 7 above.
+    def sample_key_event(self, k):
+        # Enter confirms the suggested category, as if its key was pressed. The suggestion is of the sample the
+        # earlier keys led to, so that one is checked first.
+        if k == self.sort.accept_key_code:
+            self.sort.check_sample_pointer()
+            if not self.sort.behavior_sample_paths:
+                return False
+            suggestion = self.sort.current_suggestion()
+            if suggestion is None:
+                return True
+            k = ord(self.sort.behavior_key_mapping[suggestion[0]])
         # If the left arrow is pressed and you are not at the first image already, go back one image.
         if (k == self.sort.left_arrow) and (self.sort.current_index > 0):
-            self.sort.current_index -= 1
-            self.sort.update_image_pointer()
-            self.sort.load_new_video()
-            self.restart_timer()
-            return
+            self.sort.set_current_index(self.sort.current_index - 1)
+            return True
 
         # If the right arrow is pressed and you are not at the end of the images, go to the next image.
         elif (k == self.sort.right_arrow) and (self.sort.current_index >= 0) and \
                 (self.sort.current_index < (len(self.sort.behavior_sample_paths) - 1)):
-            self.sort.current_index += 1
-            self.sort.update_image_pointer()
-            self.sort.load_new_video()
-            self.restart_timer()
-            return
+            self.sort.set_current_index(self.sort.current_index + 1)
+            return True
 
         # If the pressed key is one that has been assigned to a category, then move the file to the correct folder.
         elif str(chr(k)) in self.sort.behavior_key_mapping:
-            file_name = self.sort.behavior_sample_paths[self.sort.current_index][1]
-
-            # Move the file to the correct category directory corresponding to its index in the directory list.
-            shutil.move(self.sort.image_name,
-                        os.path.join(self.sort.category_directories[self.sort.behavior_key_mapping.index(str(chr(k)))],
-                                     file_name + ".jpg"))
-            shutil.move(self.sort.video_name,
-                        os.path.join(self.sort.category_directories[self.sort.behavior_key_mapping.index(str(chr(k)))],
-                                     file_name + ".avi"))
-
-            # Write the full filename, and its index when removed, into the undo list.
-            self.sort.undo_list[0].append(
-                [self.sort.category_directories[self.sort.behavior_key_mapping.index(str(chr(k)))], file_name])
-            self.sort.undo_list[1].append(self.sort.current_index)
-            self.sort.undo_list[2].append(self.sort.behavior_sample_paths[self.sort.current_index])
-
-            # Remove the image name from the tuple list of images to sort.
-            self.sort.behavior_sample_paths.remove(self.sort.behavior_sample_paths[self.sort.current_index])
-
-            # If this isn't the first image, go to the previous image next.
-            if not self.sort.behavior_sample_paths:
-                wx.MessageBox("Done Processing Images", "Complete!", wx.OK | wx.ICON_INFORMATION)
-                self.Close()
-            elif self.sort.current_index >= (len(self.sort.behavior_sample_paths) - 1):
-                self.sort.current_index -= 1
-                self.sort.update_image_pointer()
-                self.sort.load_new_video()
-                self.restart_timer()
-            else:
-                self.sort.update_image_pointer()
-                self.sort.load_new_video()
-                self.restart_timer()
-            return
 
-        # If the user hit the undo ('u') key, then undo the last action.
-        elif (str(chr(k)) == self.sort.undo_key) and (len(self.sort.undo_list[0]) > 0):
+            # Make sure the sample the key is meant for is the current one: after earlier keys of the same
+            # burst, missing or empty samples may still have to be skipped as they would have been on screen.
+            # They are only checked, not rendered (see check_sample_pointer).
+            self.sort.check_sample_pointer()
+            if not self.sort.behavior_sample_paths:
+                return False
 
-            # Get the path the files went to (sorted_path) and the original path.
-            # Create image and video names to make the code simpler to read.
-            sorted_path = self.sort.undo_list[0][-1][0]
-            original_path = self.sort.undo_list[2][-1][0]
-            image_name = self.sort.undo_list[0][-1][1] + ".jpg"
-            video_name = self.sort.undo_list[0][-1][1] + ".avi"
+            # Move the files to the correct category directory corresponding to its index in the directory list.
+            # In cluster mode, the near-duplicates of the sample go along with it.
+            if self.sort.cluster_mode:
+                self.sort.sort_cluster(self.sort.category_for_key(str(chr(k))))
+            else:
+                self.sort.sort_sample(self.sort.category_for_key(str(chr(k))))
 
-            # Move the video and image back to the original directory and out of the category folder.
-            shutil.move(os.path.join(sorted_path, image_name), os.path.join(original_path, image_name))
-            shutil.move(os.path.join(sorted_path, video_name), os.path.join(original_path, video_name))
+            # If this was the last image, go to the previous image next.
+            if self.sort.behavior_sample_paths and \
+                    self.sort.current_index >= (len(self.sort.behavior_sample_paths) - 1):
+                self.sort.set_current_index(self.sort.current_index - 1)
+            return True
 
-            # Insert the file name back in the correct place in the image name list.
-            self.sort.behavior_sample_paths.insert(self.sort.undo_list[1][-1], self.sort.undo_list[2][-1])
+        # If the user hit the undo ('u') key, then undo the last action.
+        elif (str(chr(k)) == self.sort.undo_key) and (len(self.sort.undo_stack) > 0):
+
+            # Move the video and image back to the original directory and out of the category folder,
+            # and set the current image to be sorted to the one we just moved back.
+            self.sort.undo()
+            return True
+
+        # If the user hit the redo key (ctrl+y), sort the last undone sample into the same category again.
+        elif (k == self.sort.redo_key_code) and (len(self.sort.redo_stack) > 0):
+            self.sort.redo()
+            return True
+
+        # The speed keys only change how fast the current video plays.
+        elif str(chr(k)) in (self.sort.slower_key, self.sort.faster_key):
+            self.change_speed(-1 if str(chr(k)) == self.sort.slower_key else 1)
+            return False
+
+        # The cluster key finds the near-duplicates the first time, and then turns cluster mode off and on.
+        elif k == self.sort.cluster_key_code:
+            if self.sort.cluster_thread is not None:
+                print("Still looking for near-duplicates...")
+            elif self.sort.cluster_members:
+                self.sort.cluster_mode = not self.sort.cluster_mode
+                self.update_title()
+            else:
+                print("Looking for near-duplicates...")
+                self.sort.start_clustering()
+            return False
+
+        # The reorder key brings the samples with a confident suggestion together, category by category.
+        elif k == self.sort.reorder_key_code:
+            if self.sort.reorder_thread is not None:
+                print("Still working out the suggestions...")
+            else:
+                print("Suggesting a category for every sample...")
+                self.sort.start_reorder()
+            return False
 
-            # Remove the file name and its index from the undo list.
-            self.sort.undo_list[0].pop()
-            self.sort.undo_list[1].pop()
-            self.sort.undo_list[2].pop()
-
-            # Set the current image to be sorted to the one we just moved back through undo.
-            self.sort.update_image_pointer()
-            self.sort.load_new_video()
-            self.restart_timer()
-            return
+        elif k == self.sort.grid_key_code:
+            self.grid_mode = True
+            self.sort.grid_selection.clear()
+            self.show_grid()
+            return False
 
         # If any other key is pressed, go back and keep waiting for a valid key entry.
         # This gives us a place to debug (print) unmatched key presses in the future if needed.
         else:
             # uncomment the next line to debug key presses
             # if not k == 255: print(str(k))
+            return False
+
+    # Function: grid_key_event
+    # Description: the keys of the grid view.
+    # 1) The arrows move the current (yellow) cell, turning the page at its edges.
+    # 2) Space selects or deselects the current cell (green); a mouse click does the same for any cell.
+    # 3) A category key sends all selected samples (or the current one if none are) to that category at once.
+    # 4) Undo and redo take back or repeat a whole group.
+    # 5) The speed keys work as in the single view, and ctrl+g goes back to it.
+    def grid_key_event(self, k):
+        key = str(chr(k))
+        columns = self.sort.grid_columns
+        steps = {self.sort.left_arrow: -1, self.sort.right_arrow: 1,
+                 self.sort.up_arrow: -columns, self.sort.down_arrow: columns}
+        if k in steps:
+            position = self.sort.current_index + steps[k]
+            if 0 <= position < len(self.sort.behavior_sample_paths):
+                page = self.sort.grid_page_start()
+                self.sort.set_current_index(position)
+                if self.sort.grid_page_start() != page:
+                    self.sort.grid_selection.clear()
+                    self.show_grid()
+                else:
+                    self.refresh_grid()
+        elif key in self.sort.behavior_key_mapping:
+            self.sort.grid_sort(self.sort.category_for_key(key))
+            self.show_grid()
+        elif key == self.sort.select_key:
+            self.sort.toggle_grid_selection(self.sort.current_index)
+            self.refresh_grid()
+        elif key == self.sort.undo_key and len(self.sort.undo_stack) > 0:
+            self.sort.undo()
+            self.sort.grid_selection.clear()
+            self.show_grid()
+        elif k == self.sort.redo_key_code and len(self.sort.redo_stack) > 0:
+            self.sort.redo()
+            self.sort.grid_selection.clear()
+            self.show_grid()
+        elif key in (self.sort.slower_key, self.sort.faster_key):
+            self.change_speed(-1 if key == self.sort.slower_key else 1)
+        elif k == self.sort.grid_key_code:
+            self.grid_mode = False
+            self.show_sample()
+
+    # Function: show_grid
+    # Description: loads the grid page holding the current sample and starts playing it.
+    def show_grid(self, restart_clip=True):
+        self.sort.load_grid_page()
+        while not self.sort.behavior_sample_paths:
+            if not self.wait_for_samples():
+                return
+            self.sort.load_grid_page()
+        self.waiting = False
+        self.sort.load_grid()
+        self.restart_timer(restart_clip)
+        self.update_title()
+
+    # Function: show_sample
+    # Description: loads the current sample and starts playing it, or waits for samples if none are left.
+    def show_sample(self, restart_clip=True):
+        self.sort.update_image_pointer()
+        while not self.sort.behavior_sample_paths:
+            if not self.wait_for_samples():
+                return
+            self.sort.update_image_pointer()
+        self.waiting = False
+        self.sort.load_new_video()
+        self.restart_timer(restart_clip)
+        self.update_title()
+
+    # Function: samples_left
+    # Description: whether anything is left to sort, now or later. With the queue empty, the scanner may just not
+    # have reached the next folder with samples yet, so this waits for it to find one or finish. In watch mode
+    # more samples may always come, and in claim mode chunks held by others may still be given up.
+    def samples_left(self):
+        while not self.sort.behavior_sample_paths and not self.sort.scan_complete and self.sort.scanner is not None:
+            self.sort.poll_scanner(wait=True)
+        return bool(self.sort.behavior_sample_paths) or self.sort.watch_input or \
+            (self.sort.claims is not None and self.sort.claims.outstanding() > 0)
+
+    # Function: wait_for_samples
+    # Description: called when the queue ran empty. Returns True if samples came in after all. Otherwise the
+    # window either shows it is waiting for samples (the timer keeps looking, see evt_timer) or, if the sort is
+    # over, closes.
+    def wait_for_samples(self):
+        if not self.samples_left():
+            self.finish("Done Processing Images")
+            return False
+        if self.sort.behavior_sample_paths:
+            return True
+        if not self.waiting:
+            self.waiting = True
+            self.sort.prepared_sample = None
+            self.sort.load_new_video()
+            self.restart_timer()
+            self.update_title()
+        return False
+
+    # Function: finish
+    # Description: tells the user the sort is over and closes the window.
+    def finish(self, message):
+        wx.MessageBox(message, "Complete!", wx.OK | wx.ICON_INFORMATION)
+        self.Close()
+
+    # Function: refresh_grid
+    # Description: redraws the grid page after the current cell or the selection changed, keeping playback going.
+    def refresh_grid(self):
+        self.sort.load_grid()
+        self.restart_timer(restart_clip=False)
+        self.update_title()
+
+    # Function: evt_on_click
+    # Description: in grid mode, a click makes a cell the current one and selects or deselects it.
+    def evt_on_click(self, event):
+        if not self.grid_mode:
+            event.Skip()
             return
+        x, y = event.GetPosition()
+        cell_width, cell_height = self.sort.grid_cell_size()
+        column, row = x // cell_width, y // cell_height
+        if column < self.sort.grid_columns and row < self.sort.grid_rows:
+            position = self.sort.grid_page_start() + row * self.sort.grid_columns + column
+            if position < len(self.sort.behavior_sample_paths):
+                self.sort.set_current_index(position)
+                self.sort.toggle_grid_selection(position)
+                self.refresh_grid()
+        self.SetFocus()
 
     # Function: evt_timer
     # Description: runs whenever the timer event triggers painting the latest video image.
     def evt_timer(self, event):
         # Check to be sure that the image size and current size of the frame match. If not, fix it.
-        if self.Size != (self.sort.image_display_sizes[0] * 2, self.sort.image_display_sizes[0]):
-            self.sort.update_image_pointer()
-            self.sort.load_new_video()
-            self.restart_timer()
-
-        # Run the function to paint the image to the panel.
-        self.Refresh()
-        self.Update()
-        # If it is the first video frame, pause for 0.5 seconds so that
-        # users notice where the beginning of the video is at.
-        if self.video_frame == 0: time.sleep(0.5)
-
-        # Increment the frame index to the next frame.
-        self.video_frame += 1
+        # This should only happen if a resize slipped past evt_on_resize, so count it to make that visible.
+        if self.display_sizes_for(self.Size) != tuple(self.sort.image_display_sizes) and self.resize_call is None:
+            self.timer_reloads += 1
+            print(f"Window size out of sync with the displayed frames, reloading (timer reloads: {self.timer_reloads})")
+            self.apply_resize()
+
+        # Pick up the samples the background scanner found since the last tick.
+        self.sort.poll_scanner()
+        if self.sort.empty_index is not None and self.sort.empty_index.unsaved >= self.sort.index_save_every:
+            self.sort.empty_index.save()
+        # Once the near-duplicates or suggestions were in, or a failed move put a sample back, the order changed,
+        # so show the current sample again. While waiting for samples, this shows them as soon as they come in
+        # (or closes the window once no more can come).
+        if self.sort.poll_clusters() | self.sort.poll_reorder() | bool(self.sort.poll_failed_moves()) or \
+                self.waiting:
+            if self.grid_mode:
+                self.show_grid()
+            else:
+                self.show_sample()
+            if self.IsBeingDeleted():
+                return
+        self.update_title()
+        # Repaint when the suggestion for the current sample comes in or changes.
+        if not self.grid_mode and self.sort.current_suggestion() != self.shown_suggestion:
+            self.Refresh(eraseBackground=False)
+
+        # Paint the frame the clock says is due, if it changed. The clock also holds the first frame for
+        # half a second so users notice where the beginning of the video is, without blocking key presses.
+        self.show_frame(force=False)
+        self.schedule_tick()
+
+    # Function: update_title
+    # Description: puts the playback speed (unless 1x) and the depth of the background move queue in the
+    # title, only touching it when it changed.
+    def update_title(self):
+        title = self.base_title
+        if self.clock.speed != 1:
+            title += f" [{self.clock.speed:g}x]"
+        if self.grid_mode:
+            title += f" [grid, {len(self.sort.grid_selection)} selected]"
+        elif self.sort.cluster_mode and self.sort.behavior_sample_paths:
+            cluster_size = len(self.sort.cluster_positions(self.sort.current_index))
+            if cluster_size > 1:
+                title += f" [cluster of {cluster_size}]"
+        if self.waiting:
+            title += " [waiting for samples]"
+        pending = self.sort.pending_moves()
+        if pending:
+            title += f" ({pending} moves pending)"
+        pending = self.sort.pending_labels()
+        if pending:
+            title += f" ({pending} to commit)"
+        if title != self.shown_title:
+            self.shown_title = title
+            self.SetTitle(title)
 
     # Function: evt_on_paint
     # Description: It paints a new video frame whenever repainting is required and called by the timer event.
@@ -369,27 +1259,118 @@ class SortingHatFrame(wx.Frame):
         dc = wx.BufferedPaintDC(self)
 
         # If it is not the last stored frame, paint it. Otherwise, go back to the first frame and then paint.
-        if self.video_frame < len(self.sort.video_frames):
-            frame = self.sort.video_frames[self.video_frame]
+        with metrics.stage('paint'):
+            # Nothing to play while waiting for samples.
+            if not self.sort.video_frames:
+                dc.Clear()
+                dc.DrawText("Waiting for samples...", 8, 8)
+                return
+            if self.video_frame < len(self.sort.video_frames):
+                frame = self.sort.video_frames[self.video_frame]
+            else:
+                self.video_frame = 0
+                frame = self.sort.video_frames[self.video_frame]
+            dc.DrawBitmap(frame, 0, 0, False)
+            # The suggested category goes in the bottom left corner of the image.
+            self.shown_suggestion = self.sort.current_suggestion() if not self.grid_mode else None
+            if self.shown_suggestion is not None:
+                category, confidence = self.shown_suggestion
+                dc.SetTextForeground(wx.Colour(255, 255, 0))
+                dc.DrawText(f"Enter: {self.sort.category_strings[category]}? ({confidence:.0%})", 8,
+                            self.sort.image_display_sizes[1] - 24)
+        metrics.finish('key_to_paint', 'key')
+
+    # Function: commit_labels
+    # Description: moves the samples labelled so far (with defer_moves) into their category folders.
+    def commit_labels(self):
+        wx.BeginBusyCursor()
+        try:
+            summary = self.sort.commit_labels()
+        finally:
+            wx.EndBusyCursor()
+        if summary is not None:
+            print(f"Committed {summary['committed']} labelled samples into "
+                  f"{os.path.join(self.sort.output_image_directory, 'categories')}, {summary['failed']} failed.")
+        self.update_title()
+
+    # Function: metrics_prefix
+    # Description: where dump_metrics and the profiler write to: a time-stamped name in the output directory.
+    def metrics_prefix(self, kind):
+        return os.path.join(self.sort.output_image_directory, f"sortinghat_{kind}_{time.strftime('%Y%m%d_%H%M%S')}")
+
+    # Function: dump_metrics
+    # Description: writes the stage timings to json and csv. If they weren't being recorded, starts recording.
+    def dump_metrics(self):
+        if not metrics.enabled:
+            metrics.enable()
+            print("Recording stage timings; press ctrl+d again to write them out.")
+            return
+        print(f"Wrote the stage timings to {metrics.dump(self.metrics_prefix('metrics'))}")
+
+    # Function: toggle_profile
+    # Description: starts profiling the UI thread with cProfile, or stops it and writes the profile out.
+    def toggle_profile(self):
+        if metrics.profiler is None:
+            metrics.start_profile()
+            print("Profiling; press ctrl+p again to stop and write the profile.")
         else:
-            self.video_frame = 0
-            frame = self.sort.video_frames[self.video_frame]
-        dc.DrawBitmap(frame, 0, 0, False)
+            print(f"Wrote the profile to {metrics.stop_profile(self.metrics_prefix('profile') + '.prof')}")
+
+    # Function: display_sizes_for
+    # Description: the size of each half (image and video) of the display for a given window size.
+    def display_sizes_for(self, size):
+        return int(size[0] / 2 + 0.5), size[1] - 20
 
     # Function: evt_on_resize
-    # Description: Called whenever the window is resized. It creates/loads video frames at the appropriate new size.
+    # Description: Called whenever the window is resized. Dragging the window edge produces a burst of these,
+    # so the video frames are only rebuilt once the size has been stable for resize_delay milliseconds.
     def evt_on_resize(self, event):
-        temp = self.Size
-        self.panel.size = temp
+        self.panel.size = self.Size
+        if self.resize_call is None:
+            self.resize_call = wx.CallLater(self.resize_delay, self.apply_resize)
+        else:
+            self.resize_call.Restart(self.resize_delay)
+
+    # Function: apply_resize
+    # Description: creates/loads video frames at the new window size. The samples are re-rendered from their
+    # already decoded frames, or taken from the bitmap cache if this size was used recently.
+    def apply_resize(self):
+        self.resize_call = None
+        display_sizes = self.display_sizes_for(self.Size)
+        if display_sizes == tuple(self.sort.image_display_sizes) or min(display_sizes) < 1:
+            return
+        self.sort.image_display_sizes = display_sizes
         self.sort.scale_text()
-        self.sort.update_image_pointer()
-        self.sort.load_new_video()
-        self.restart_timer()
-        self.sort.image_display_sizes = (int(temp[0] / 2 + 0.5), temp[1] - 20)
+        if self.grid_mode:
+            self.show_grid(restart_clip=False)
+            return
+        self.show_sample(restart_clip=False)
 
     def onClose(self, event):
         self.timer.Stop()
-        self.Close()
+        if self.resize_call is not None:
+            self.resize_call.Stop()
+        stats = self.sort.cache_stats()
+        for name in ('decoded', 'bitmaps', 'thumbnails'):
+            print(f"{name} cache: {stats[name]['hits']} hits, {stats[name]['misses']} misses, "
+                  f"{stats[name]['resident_bytes'] / 2 ** 20:.0f} MB resident")
+        self.sort.prefetcher.shutdown()
+        self.sort.thumbnail_executor.shutdown(wait=False, cancel_futures=True)
+        # prepare_hat may have stopped before setting these up (see SortingHatFrame).
+        if self.sort.empty_index is not None:
+            self.sort.empty_index.save()
+        # After the session: the moves it finishes may still hand their failures to the suggester.
+        self.sort.close_session()
+        if self.sort.suggester is not None:
+            self.sort.suggester.close()
+        if self.sort.proxy_cache is not None:
+            freed = self.sort.proxy_cache.evict()
+            if freed:
+                print(f"Evicted {freed / 2 ** 20:.0f} MB of proxies to stay within the disk budget.")
+        if metrics.profiler is not None:
+            self.toggle_profile()
+        if metrics.enabled:
+            self.dump_metrics()
         event.Skip()
 
 
@@ -401,13 +1382,16 @@ class SortingHatInitialWindow(wx.Frame):
 
     def __init__(self, title):
         # If you want to adjust the size, add arg 'size=(x,y)' but this size seems fine.
-        super(SortingHatInitialWindow, self).__init__(parent=None, title=title, size=(450, 275))
+        super(SortingHatInitialWindow, self).__init__(parent=None, title=title, size=(450, 410))
 
         # Set up the variables that we want to capture.
         self.input_directory = None
         self.output_directory = None
         self.categories = []
         self.category_mapping = []
+        self.watch_input = False
+        self.share_input = False
+        self.defer_moves = False
         self.display_window()
         self.undo_key = 'U'
 
@@ -423,6 +1407,14 @@ class SortingHatInitialWindow(wx.Frame):
         boxsizer.Add(button1, 0, wx.LEFT | wx.RIGHT | wx.EXPAND, 40)
         button1.Bind(wx.EVT_BUTTON, self.evt_get_input_directory)
 
+        # Add some vertical spacing.
+        boxsizer.Add(0, 10, 0)
+
+        # Add the button to sort the samples of a zip or tar archive instead, without extracting it first.
+        button6 = wx.Button(panel, label='Select Input Archive (zip/tar)')
+        boxsizer.Add(button6, 0, wx.LEFT | wx.RIGHT | wx.EXPAND, 40)
+        button6.Bind(wx.EVT_BUTTON, self.evt_get_input_archive)
+
         # Add some vertical spacing.
         boxsizer.Add(0, 30, 0)
 
@@ -442,6 +1434,24 @@ class SortingHatInitialWindow(wx.Frame):
         # Add some vertical spacing.
         boxsizer.Add(0, 30, 0)
 
+        # Add the checkbox to keep picking up samples that LabGym writes while sorting.
+        watch_checkbox = wx.CheckBox(panel, label='Watch input directory for new samples')
+        boxsizer.Add(watch_checkbox, 0, wx.LEFT | wx.RIGHT | wx.EXPAND, 40)
+        watch_checkbox.Bind(wx.EVT_CHECKBOX, self.evt_toggle_watch)
+
+        # Add the checkbox to sort the input directory together with other annotators.
+        share_checkbox = wx.CheckBox(panel, label='Share input directory with other annotators')
+        boxsizer.Add(share_checkbox, 0, wx.LEFT | wx.RIGHT | wx.EXPAND, 40)
+        share_checkbox.Bind(wx.EVT_CHECKBOX, self.evt_toggle_share)
+
+        # Add the checkbox to only record the labels while sorting and move the files in bulk on commit.
+        defer_checkbox = wx.CheckBox(panel, label='Record labels now, move the files on commit (Ctrl+S)')
+        boxsizer.Add(defer_checkbox, 0, wx.LEFT | wx.RIGHT | wx.EXPAND, 40)
+        defer_checkbox.Bind(wx.EVT_CHECKBOX, self.evt_toggle_defer)
+
+        # Add some vertical spacing.
+        boxsizer.Add(0, 15, 0)
+
         # Add the button to start the SortingHat and bind its event function.
         button5 = wx.Button(panel, label='Analyze Behaviors')
         boxsizer.Add(button5, 0, wx.LEFT | wx.RIGHT | wx.EXPAND, 40)
@@ -461,6 +1471,15 @@ class SortingHatInitialWindow(wx.Frame):
             self.input_directory = dlg.GetPath()
         dlg.Destroy()
 
+    # Function: evt_get_input_archive
+    # Description: basic modal file dialog box to get an input archive, which is used like an input directory.
+    def evt_get_input_archive(self, event):
+        dlg = wx.FileDialog(None, "Choose input archive", "", "", "Archives (*.zip;*.tar)|*.zip;*.tar",
+                            wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+        if dlg.ShowModal() == wx.ID_OK:
+            self.input_directory = dlg.GetPath()
+        dlg.Destroy()
+
     # Function: evt_get_output_directory
     # Description: basic modal directory dialog box to get the output directory.
     def evt_get_output_directory(self, event):
@@ -560,6 +1579,21 @@ class SortingHatInitialWindow(wx.Frame):
             else:
                 break
 
+    # Function: evt_toggle_watch
+    # Description: remembers whether the input directory should be watched for new samples.
+    def evt_toggle_watch(self, event):
+        self.watch_input = event.IsChecked()
+
+    # Function: evt_toggle_share
+    # Description: remembers whether the input directory is shared with other annotators (see ClaimManager).
+    def evt_toggle_share(self, event):
+        self.share_input = event.IsChecked()
+
+    # Function: evt_toggle_defer
+    # Description: remembers whether sorting should only record labels (see LabelStore).
+    def evt_toggle_defer(self, event):
+        self.defer_moves = event.IsChecked()
+
     def evt_start_sorting(self, event):
         if self.input_directory is None:
             wx.MessageBox("No Input Directory Provided", "Error", wx.OK | wx.ICON_INFORMATION)
@@ -568,7 +1602,8 @@ class SortingHatInitialWindow(wx.Frame):
         elif len(self.categories) == 0:
             wx.MessageBox("No Categories Provided", "Error", wx.OK | wx.ICON_INFORMATION)
         else:
-            Hat = SortingHatFrame(None, 'LabGym Sorting Hat', self.input_directory, self.output_directory, self.categories, self.category_mapping)
+            Hat = SortingHatFrame(None, 'LabGym Sorting Hat', self.input_directory, self.output_directory, self.categories, self.category_mapping,
+                                  self.watch_input, self.share_input, self.defer_moves)
             Hat.Show()
 # Run the program.
 if __name__ == '__main__':
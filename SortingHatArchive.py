@@ -0,0 +1,349 @@
+import os
+import io
+import json
+import mmap
+import zlib
+import struct
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+from collections import OrderedDict
+from SortingHatScanner import StreamingScanner
+
+# The member index of an archive is kept in the output directory (the archive itself is only ever read).
+# It is rebuilt when the archive's size or mtime changes.
+ARCHIVE_INDEX_FILE_NAME = '.sortinghat_archive_index.json'
+ARCHIVE_INDEX_VERSION = 1
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# The archives currently open, by absolute path. Sample paths below an archive's path (as if it were a
+# directory) are read from it by the functions at the end of this file.
+mounted_archives = {}
+
+
+# Function: is_archive
+# Description: whether a path is a zip or tar file rather than a directory.
+def is_archive(path):
+    if not os.path.isfile(path):
+        return False
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+# Class: ArchiveSource
+# Description: reads the samples of a zip or uncompressed tar archive in place. The archive is memory-mapped and
+# indexed once: the data offset, stored size, size and compression of every jpg and avi member. Stored (and
+# tar) members are then read as zero-copy slices of the map and deflated zip members inflated from it.
+# Samples are named as if the archive was a directory: archive.zip/folder/stem.avi. Clips are handed to OpenCV
+# as in-memory streams where it supports that, and otherwise written to a spool directory (in /dev/shm where
+# there is one) that keeps the last spool_bytes of clips for reuse.
+class ArchiveSource():
+
+    def __init__(self, archive_path, index_path=None, spool_bytes=256 * 2 ** 20):
+        self.archive_path = os.path.abspath(archive_path)
+        self.index_path = index_path
+        self.spool_bytes = spool_bytes
+        self.members = {}
+        self.file = None
+        self.map = None
+        self.mtime_ns = 0
+        # Members compressed other than by deflate are read through zipfile, one at a time.
+        self.zip_file = None
+        self.lock = threading.Lock()
+        # None until the first clip tells whether OpenCV can read from a stream.
+        self.streams_supported = None
+        self.spool_directory = None
+        self.spooled = OrderedDict()
+        self.spooled_bytes = 0
+        self.spool_count = 0
+
+    # Function: open
+    # Description: maps the archive, loads or builds its member index and mounts it.
+    def open(self):
+        stat = os.stat(self.archive_path)
+        self.mtime_ns = stat.st_mtime_ns
+        self.members = self.load_index(stat) or self.build_index(stat)
+        self.file = open(self.archive_path, 'rb')
+        if stat.st_size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        mounted_archives[self.archive_path] = self
+        return self
+
+    def load_index(self, stat):
+        if self.index_path is None:
+            return None
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != ARCHIVE_INDEX_VERSION or data.get('archive') != self.archive_path or \
+                data.get('size') != stat.st_size or data.get('mtime_ns') != stat.st_mtime_ns:
+            return None
+        return data['members']
+
+    # Function: build_index
+    # Description: lists the jpg and avi members as name: [data offset, stored size, size, compression].
+    # Only uncompressed tar files can be read in place; compressed ones raise a ValueError.
+    def build_index(self, stat):
+        members = {}
+        if zipfile.is_zipfile(self.archive_path):
+            with zipfile.ZipFile(self.archive_path) as archive, open(self.archive_path, 'rb') as f:
+                for info in archive.infolist():
+                    if info.is_dir() or info.flag_bits & 0x1 or not info.filename.endswith(('.avi', '.jpg')):
+                        continue
+                    # The data follows the local header, whose name and extra field lengths may differ from
+                    # the central directory's.
+                    f.seek(info.header_offset)
+                    header = struct.unpack('<4s2B4HL2L2H', f.read(30))
+                    members[info.filename] = [info.header_offset + 30 + header[10] + header[11], info.compress_size,
+                                              info.file_size, info.compress_type]
+        else:
+            try:
+                archive = tarfile.open(self.archive_path, 'r:')
+            except tarfile.ReadError:
+                raise ValueError(f"{self.archive_path} is a compressed tar file, which can't be read in place. "
+                                 f"Repack it as an uncompressed .tar or a .zip.")
+            with archive:
+                for member in archive:
+                    if member.isfile() and member.name.endswith(('.avi', '.jpg')):
+                        name = member.name[2:] if member.name.startswith('./') else member.name
+                        members[name] = [member.offset_data, member.size, member.size, ZIP_STORED]
+        if self.index_path is not None:
+            data = {'version': ARCHIVE_INDEX_VERSION, 'archive': self.archive_path, 'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns, 'members': members}
+            try:
+                with open(self.index_path + '.tmp', 'w') as f:
+                    json.dump(data, f, separators=(',', ':'))
+                os.replace(self.index_path + '.tmp', self.index_path)
+            except OSError as e:
+                print(f"Could not save the archive index {self.index_path}: {e}")
+        return members
+
+    # Function: member_name
+    # Description: the member name of a path below the archive path, or None if it isn't one.
+    def member_name(self, path):
+        path = os.path.abspath(path)
+        if not path.startswith(self.archive_path + os.sep):
+            return None
+        return path[len(self.archive_path) + 1:].replace(os.sep, '/')
+
+    # Function: sample_batches
+    # Description: the (directory, stem) pairs of the archive per folder, in the order iter_sample_batches would
+    # walk the same folders on disk: the natural order of the full folder paths.
+    def sample_batches(self):
+        from natsort import natsorted
+        folders = {}
+        for name in self.members:
+            if name.endswith('.avi') and name[:-4] + '.jpg' in self.members:
+                folder, _, stem = name[:-4].rpartition('/')
+                folders.setdefault(folder, []).append(stem)
+        directories = {os.path.join(self.archive_path, *folder.split('/')) if folder else self.archive_path: folder
+                       for folder in folders}
+        for directory in natsorted(directories):
+            yield [(directory, stem) for stem in natsorted(folders[directories[directory]])]
+
+    # Function: read
+    # Description: the bytes of a member (a memoryview into the map if it is stored as is), or None.
+    def read(self, name):
+        entry = self.members.get(name)
+        if entry is None or self.map is None:
+            return None
+        offset, stored_size, size, compression = entry
+        if compression == ZIP_STORED:
+            return memoryview(self.map)[offset:offset + size]
+        if compression == ZIP_DEFLATED:
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(self.map[offset:offset + stored_size])
+        with self.lock:
+            if self.zip_file is None:
+                self.zip_file = zipfile.ZipFile(self.archive_path)
+            return self.zip_file.read(name)
+
+    # Function: stat
+    # Description: a stat result for a member: its size and the archive's mtime, which is what the caches keyed
+    # by size and mtime (empty frame index, hashes) need. Raises FileNotFoundError like os.stat.
+    def stat(self, name):
+        entry = self.members.get(name)
+        if entry is None:
+            raise FileNotFoundError(name)
+        seconds = self.mtime_ns // 10 ** 9
+        return os.stat_result((0o100444, 0, 0, 1, 0, 0, entry[2], seconds, seconds, seconds,
+                               seconds, seconds, seconds, self.mtime_ns, self.mtime_ns, self.mtime_ns))
+
+    # Function: open_capture
+    # Description: a cv2.VideoCapture of an avi member, reading it from memory if OpenCV can. If a stream doesn't
+    # open but the spooled file does, streams aren't supported by this OpenCV and the spool is used from then on.
+    def open_capture(self, name):
+        import cv2
+        data = self.read(name)
+        if data is None:
+            return cv2.VideoCapture()
+        if self.streams_supported is not False:
+            try:
+                cap = StreamCapture(io.BytesIO(data))
+            except (TypeError, AttributeError, cv2.error):
+                cap = None
+            if cap is not None and cap.isOpened():
+                self.streams_supported = True
+                return cap
+        cap = cv2.VideoCapture(self.spool(name, data))
+        if cap.isOpened() and self.streams_supported is None:
+            self.streams_supported = False
+        return cap
+
+    # Function: spool
+    # Description: the path of a spooled copy of a member, written on first use and kept until it is the
+    # oldest of more than spool_bytes of spooled clips.
+    def spool(self, name, data):
+        with self.lock:
+            entry = self.spooled.get(name)
+            if entry is not None:
+                self.spooled.move_to_end(name)
+                return entry[0]
+            if self.spool_directory is None:
+                self.spool_directory = tempfile.mkdtemp(prefix='sortinghat_spool_',
+                                                        dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            self.spool_count += 1
+            path = os.path.join(self.spool_directory, f"{self.spool_count}_{os.path.basename(name)}")
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        with self.lock:
+            self.spooled[name] = (path, len(data))
+            self.spooled_bytes += len(data)
+            while self.spooled_bytes > self.spool_bytes and len(self.spooled) > 1:
+                old_path, old_size = self.spooled.popitem(last=False)[1]
+                self.spooled_bytes -= old_size
+                try:
+                    os.unlink(old_path)
+                except OSError:
+                    pass
+        return path
+
+    # Function: extract
+    # Description: writes a member to a file (through a temporary name, so a half-written file never shows up).
+    # The data is synced before the rename, so after a crash the file is either complete or not there at all.
+    # A file that is already there is left alone, so extracting again after an interruption is harmless.
+    # Returns whether the member exists.
+    def extract(self, name, destination_name):
+        if os.path.exists(destination_name):
+            return True
+        data = self.read(name)
+        if data is None:
+            return False
+        with open(destination_name + '.part', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(destination_name + '.part', destination_name)
+        return True
+
+    def close(self):
+        mounted_archives.pop(self.archive_path, None)
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # A clip still playing holds a view of the map; it goes when the file does.
+                pass
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.zip_file is not None:
+            self.zip_file.close()
+            self.zip_file = None
+        if self.spool_directory is not None:
+            shutil.rmtree(self.spool_directory, ignore_errors=True)
+            self.spool_directory = None
+            self.spooled.clear()
+            self.spooled_bytes = 0
+
+
+# Class: StreamCapture
+# Description: a cv2.VideoCapture reading from a file-like object. OpenCV doesn't keep the stream alive, and a
+# stream collected while the capture still reads from it crashes OpenCV, so this holds both and releases the
+# capture before letting go of the stream. Everything else is passed on to the capture.
+class StreamCapture():
+
+    def __init__(self, stream):
+        import cv2
+        self.cap = None
+        self.stream = stream
+        self.cap = cv2.VideoCapture(stream, cv2.CAP_FFMPEG, [])
+
+    def __getattr__(self, name):
+        return getattr(self.cap, name)
+
+    def release(self):
+        self.cap.release()
+
+    def __del__(self):
+        if self.cap is not None:
+            self.cap.release()
+
+
+# Class: ArchiveScanner
+# Description: a StreamingScanner over the member index of an archive instead of a directory tree. Archives
+# don't change while they are sorted, so there is nothing to watch.
+class ArchiveScanner(StreamingScanner):
+
+    def __init__(self, archive):
+        super(ArchiveScanner, self).__init__(archive.archive_path)
+        self.archive = archive
+
+    def run(self):
+        for batch in self.archive.sample_batches():
+            if self.stopped.is_set():
+                return
+            self.batches.put(batch)
+        self.finished.set()
+
+
+# Function: find_member
+# Description: the mounted archive a path lies in and the member name, or (None, None) for an ordinary path.
+def find_member(path):
+    for archive in list(mounted_archives.values()):
+        name = archive.member_name(path)
+        if name is not None:
+            return archive, name
+    return None, None
+
+
+# Function: read_image, open_capture, path_exists, path_stat
+# Description: cv2.imread, cv2.VideoCapture, os.path.exists and os.stat for sample paths that may lie in a
+# mounted archive.
+def read_image(image_name, flags=1):
+    import cv2
+    archive, name = find_member(image_name) if mounted_archives else (None, None)
+    if archive is None:
+        return cv2.imread(image_name, flags)
+    data = archive.read(name)
+    if data is None:
+        return None
+    import numpy as np
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+
+def open_capture(video_name):
+    import cv2
+    archive, name = find_member(video_name) if mounted_archives else (None, None)
+    if archive is None:
+        return cv2.VideoCapture(video_name)
+    return archive.open_capture(name)
+
+
+def path_exists(path):
+    archive, name = find_member(path) if mounted_archives else (None, None)
+    if archive is None:
+        return os.path.exists(path)
+    return name in archive.members
+
+
+def path_stat(path):
+    archive, name = find_member(path) if mounted_archives else (None, None)
+    if archive is None:
+        return os.stat(path)
+    return archive.stat(name)
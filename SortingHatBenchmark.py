@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import cv2
+import numpy as np
+
+
+# Function: stub_wx
+# Description: installs a stand-in for wx so LabGymSortingHat can be imported and driven without a display.
+# Every wx name is a class that accepts any arguments; bitmaps are built from a copy of the buffer, so the
+# compositing cost is still paid. A real wx that is already imported is left alone.
+def stub_wx():
+    if 'wx' in sys.modules:
+        return
+
+    class Stub():
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def __getattr__(self, name):
+            return Stub()
+
+        def __call__(self, *args, **kwargs):
+            return Stub()
+
+    class Bitmap(Stub):
+        @staticmethod
+        def FromBuffer(width, height, data):
+            return np.array(data, copy=True)
+
+    wx = types.ModuleType('wx')
+    wx.__getattr__ = lambda name: Stub
+    wx.Bitmap = Bitmap
+    wx.MessageBox = lambda *args, **kwargs: None
+    sys.modules['wx'] = wx
+
+
+# Function: write_clip
+# Description: writes a small MJPG avi of frame_count frames with a moving square, optionally with one all
+# black frame in the middle, and returns its bytes so it can be copied instead of encoded for every sample.
+def write_clip(path, frame_count=16, size=(96, 72), empty_frame=False):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, size)
+    for i in range(frame_count):
+        frame = np.full((size[1], size[0], 3), 60, dtype=np.uint8)
+        if empty_frame and i == frame_count // 2:
+            frame[:] = 0
+        else:
+            cv2.rectangle(frame, (i * 3, 10), (i * 3 + 20, 30), (255, 255, 255), -1)
+        writer.write(frame)
+    writer.release()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# Function: generate_tree
+# Description: builds a synthetic LabGym output of sample_count avi/jpg pairs: one folder per video with
+# samples_per_folder pairs each, grouped under a folder per animal, with LabGym style names
+# (video_<n>_len<frames>) and every empty_every-th clip containing an empty frame.
+def generate_tree(root, sample_count, samples_per_folder=100, folders_per_group=10, empty_every=10):
+    os.makedirs(root, exist_ok=True)
+    clean = write_clip(os.path.join(root, 'clean.tmp.avi'))
+    empty = write_clip(os.path.join(root, 'empty.tmp.avi'), empty_frame=True)
+    os.remove(os.path.join(root, 'clean.tmp.avi'))
+    os.remove(os.path.join(root, 'empty.tmp.avi'))
+    _, image = cv2.imencode('.jpg', np.full((72, 96, 3), 120, dtype=np.uint8))
+    image = image.tobytes()
+    for i in range(sample_count):
+        folder_number = i // samples_per_folder
+        directory = os.path.join(root, f"animal{folder_number // folders_per_group}", f"video{folder_number}")
+        if i % samples_per_folder == 0:
+            os.makedirs(directory, exist_ok=True)
+        stem = f"video{folder_number}_{i % samples_per_folder}_len16"
+        with open(os.path.join(directory, stem + '.avi'), 'wb') as f:
+            f.write(empty if empty_every and i % empty_every == empty_every - 1 else clean)
+        with open(os.path.join(directory, stem + '.jpg'), 'wb') as f:
+            f.write(image)
+
+
+# Function: timed
+# Description: runs a function and returns (seconds, result).
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+# Function: benchmark_size
+# Description: runs every benchmark on a fresh synthetic tree of sample_count samples and returns the timings.
+# The per-sample stages (empty check, compositing, moves) run on the first visit_count samples only, so the
+# large trees mostly measure how scanning scales.
+def benchmark_size(work_directory, sample_count, visit_count=200, display_sizes=(300, 300)):
+    from LabGymSortingHat import SortingHat
+    from SortingHatVideo import fit_labels, label_overlay
+
+    input_directory = os.path.join(work_directory, f"input_{sample_count}")
+    output_directory = os.path.join(work_directory, f"output_{sample_count}")
+    results = {'samples': sample_count}
+    results['generate_seconds'], _ = timed(generate_tree, input_directory, sample_count)
+
+    categories = ['junk', 'curling', 'crawling', 'immobile']
+    mapping = ['0', '1', '2', '3']
+    hat = SortingHat()
+    hat.resume_session = False
+    hat.input_image_directory = input_directory
+    hat.output_image_directory = output_directory
+
+    # Scanning: the full scan with its natural sort, then prepare_hat up to the first sample on screen.
+    results['scan_seconds'], samples = timed(hat.scan_samples)
+    results['scan_samples_per_second'] = len(samples) / results['scan_seconds']
+    results['prepare_hat_seconds'], _ = timed(hat.prepare_hat, categories, mapping, input_directory,
+                                              output_directory, True, display_sizes)
+    hat.poll_scanner(wait=True)
+    while not hat.scan_complete:
+        time.sleep(0.01)
+        hat.poll_scanner()
+
+    # The label fitting, cold and then memoised.
+    fit_labels.cache_clear()
+    label_overlay.cache_clear()
+    results['scale_text_cold_seconds'], _ = timed(hat.scale_text)
+    results['scale_text_warm_seconds'], _ = timed(hat.scale_text)
+
+    # Visiting samples: update_image_pointer decodes and checks for empty frames (dropping the empty ones),
+    # load_new_video turns the composed frames into bitmaps. The prefetcher is bypassed so every visit is cold.
+    hat.prefetcher.radius = 0
+    hat.empty_index.entries = {}
+    pointer_seconds = 0
+    load_seconds = 0
+    visited = 0
+    hat.current_index = 0
+    while visited < visit_count and hat.current_index < len(hat.behavior_sample_paths):
+        seconds, _ = timed(hat.update_image_pointer)
+        pointer_seconds += seconds
+        seconds, _ = timed(hat.load_new_video)
+        load_seconds += seconds
+        visited += 1
+        hat.current_index += 1
+    results['visited_samples'] = visited
+    results['update_image_pointer_ms'] = pointer_seconds / max(visited, 1) * 1000
+    results['load_new_video_ms'] = load_seconds / max(visited, 1) * 1000
+    results['dropped_empty_samples'] = sample_count - len(hat.behavior_sample_paths)
+
+    # Moves: sort and undo through the background mover, timing both the key presses and the moves themselves.
+    move_count = min(visit_count, len(hat.behavior_sample_paths))
+    hat.current_index = 0
+    start = time.perf_counter()
+    for i in range(move_count):
+        hat.sort_sample(i % len(categories))
+    queued = time.perf_counter() - start
+    hat.mover.flush()
+    results['sort_queue_per_second'] = move_count / queued if queued else 0
+    results['sort_moves_per_second'] = move_count / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for i in range(move_count):
+        hat.undo()
+    hat.mover.flush()
+    results['undo_moves_per_second'] = move_count / (time.perf_counter() - start)
+    results['cache_stats'] = hat.cache_stats()
+
+    hat.prefetcher.shutdown()
+    hat.thumbnail_executor.shutdown(wait=False)
+    hat.suggester.close()
+    hat.close_session()
+    shutil.rmtree(input_directory, ignore_errors=True)
+    shutil.rmtree(output_directory, ignore_errors=True)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Run the benchmarks from the command line, e.g.
+# python SortingHatBenchmark.py --sizes 1000 10000 --output benchmark.json
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark LabGymSortingHat on synthetic LabGym output.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='numbers of samples to generate and benchmark')
+    parser.add_argument('--visits', type=int, default=200, help='samples to visit, sort and undo per size')
+    parser.add_argument('--output', default='sortinghat_benchmark.json', help='json file to write the results to')
+    parser.add_argument('--work-directory', default=None, help='where to generate the samples (default: a temp dir)')
+    args = parser.parse_args()
+
+    stub_wx()
+    work_directory = args.work_directory or tempfile.mkdtemp(prefix='sortinghat_benchmark_')
+    report = {'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'opencv': cv2.__version__, 'platform': platform.platform(),
+              'results': []}
+    for size in args.sizes:
+        print(f"Benchmarking {size} samples...")
+        results = benchmark_size(work_directory, size, args.visits)
+        report['results'].append(results)
+        print(json.dumps(dict((key, value) for key, value in results.items() if key != 'cache_stats'), indent=1))
+    if not args.work_directory:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Wrote {args.output}")
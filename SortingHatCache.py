@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+
+
+# Class: FrameCache
+# Description: a least recently used cache of frame stacks (decoded clips, bitmaps, ...) limited by the number
+# of bytes it holds rather than the number of entries. The caller says how big each value is when it is put in.
+# A value larger than the whole budget isn't cached at all; put returns False so the caller can stream instead.
+# It is shared between the UI thread and the prefetch workers, so every method takes the lock.
+class FrameCache():
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # Function: get
+    # Description: returns the cached value and marks it as most recently used, or None (counted as a miss).
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # Function: put
+    # Description: caches a value of nbytes, evicting the least recently used entries until it fits.
+    def put(self, key, value, nbytes):
+        with self.lock:
+            self.discard_locked(key)
+            if nbytes > self.budget_bytes:
+                return False
+            self.entries[key] = (value, nbytes)
+            self.resident_bytes += nbytes
+            while self.resident_bytes > self.budget_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.resident_bytes -= evicted_bytes
+                self.evictions += 1
+            return True
+
+    def discard(self, key):
+        with self.lock:
+            self.discard_locked(key)
+
+    def discard_locked(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.resident_bytes -= entry[1]
+
+    # Function: discard_where
+    # Description: drops every entry whose key matches a predicate, e.g. all entries of one sample.
+    def discard_where(self, predicate):
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.discard_locked(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.resident_bytes = 0
+
+    # Function: stats
+    # Description: the hit/miss counts and the resident size, for logging and tuning the budget.
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'entries': len(self.entries),
+                    'resident_bytes': self.resident_bytes, 'budget_bytes': self.budget_bytes}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
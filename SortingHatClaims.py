@@ -0,0 +1,389 @@
+import os
+import json
+import time
+import uuid
+import socket
+import getpass
+import hashlib
+import argparse
+import random
+import shutil
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+
+# The claims live in the input directory, which is what the SortingHats sharing it have in common.
+CLAIMS_DIRECTORY_NAME = '.sortinghat_claims'
+
+
+def default_owner():
+    try:
+        user = getpass.getuser()
+    except (OSError, KeyError):
+        user = 'unknown'
+    return f"{user}@{socket.gethostname()}"
+
+
+# Function: process_alive
+# Description: whether a process of this machine is still running. Only asked on POSIX, where signal 0 just
+# checks; anywhere else the process is assumed to be alive and its claims simply wait for the lease to run out.
+def process_alive(pid):
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+# Class: ClaimManager
+# Description: hands out the samples of one input directory to several SortingHats through files in a shared
+# claims directory, with nothing but the file system to coordinate them. The first SortingHat to scan a folder
+# cuts its samples into chunks of chunk_size and publishes them in a manifest; everyone else uses that manifest,
+# so they all agree on the chunks even though their own listings miss whatever was sorted before they scanned.
+# Samples that show up in a folder after its manifest was written (watch_input) each make a chunk of their own.
+# Chunks are named after the folder (relative to the input directory) and their stems.
+# A chunk is claimed by creating <chunk>.claim<n> with O_EXCL, where n is one more than the newest claim of the
+# chunk so far, so only one SortingHat can get each generation. The claim is a lease: its owner touches it every
+# lease_seconds / 4. A claim is free to be taken over (by creating the next generation) once it wasn't touched
+# for lease_seconds, its process on this machine is gone or its owner released it. Claims are never renamed or
+# replaced, so taking over can't race with a fresh claim. A finished chunk gets a <chunk>.done marker.
+class ClaimManager():
+
+    def __init__(self, input_directory, owner=None, chunk_size=200, lease_seconds=120, claim_ahead=20,
+                 retry_seconds=10):
+        self.input_directory = input_directory
+        self.claims_directory = os.path.join(input_directory, CLAIMS_DIRECTORY_NAME)
+        self.owner = owner or default_owner()
+        self.chunk_size = chunk_size
+        self.lease_seconds = lease_seconds
+        self.claim_ahead = claim_ahead
+        self.retry_seconds = retry_seconds
+        # The token tells this SortingHat's claims apart from those of another one run by the same owner.
+        self.token = uuid.uuid4().hex
+        self.chunks = OrderedDict()
+        self.manifests = {}
+        self.held = {}
+        self.generations = {}
+        self.skipped = {}
+        self.last_renewal = 0
+
+    def start(self):
+        os.makedirs(self.claims_directory, exist_ok=True)
+
+    # Function: private_name
+    # Description: a file name of the output directory made unique to this owner, for the files (like the move
+    # log) that SortingHats sharing an output directory must not share.
+    def private_name(self, name):
+        return name + '.' + ''.join(c if c.isalnum() or c in '-_.' else '_' for c in self.owner)
+
+    def relative_directory(self, directory):
+        return os.path.relpath(directory, self.input_directory).replace(os.sep, '/')
+
+    def chunk_key(self, directory, stems):
+        return hashlib.sha1(f"{self.relative_directory(directory)}\0{stems[0]}\0{len(stems)}".encode()).hexdigest()[:24]
+
+    def claim_path(self, key, generation):
+        return os.path.join(self.claims_directory, f"{key}.claim{generation}")
+
+    def done_path(self, key):
+        return os.path.join(self.claims_directory, key + '.done')
+
+    # Function: manifest
+    # Description: the chunks (lists of stems) of a folder. They are read from the folder's manifest, or cut from
+    # stems and published as its manifest if there is none yet. The manifest is written under a temporary name
+    # and hard linked into place, which fails if someone else published theirs first; that one is used then.
+    def manifest(self, directory, stems):
+        chunks = self.manifests.get(directory)
+        if chunks is not None:
+            return chunks
+        name = hashlib.sha1(self.relative_directory(directory).encode()).hexdigest()[:24]
+        path = os.path.join(self.claims_directory, name + '.manifest')
+        if not os.path.exists(path):
+            temporary_path = f"{path}.{self.token}.tmp"
+            with open(temporary_path, 'w') as f:
+                json.dump([stems[start:start + self.chunk_size] for start in range(0, len(stems), self.chunk_size)],
+                          f)
+            try:
+                os.link(temporary_path, path)
+            except FileExistsError:
+                pass
+            except OSError:
+                # No hard links on this file system; a rename may replace a manifest published a moment ago.
+                if not os.path.exists(path):
+                    os.replace(temporary_path, path)
+            if os.path.exists(temporary_path):
+                os.unlink(temporary_path)
+        with open(path, 'r') as f:
+            chunks = self.manifests[directory] = json.load(f)
+        return chunks
+
+    # Function: add_batch
+    # Description: turns the stems the scanner found in one folder into the chunks that can be claimed, each
+    # holding only the stems that were found (the rest were sorted already).
+    def add_batch(self, directory, stems):
+        found = set(stems)
+        listed = set()
+        chunks = []
+        for chunk in self.manifest(directory, stems):
+            listed.update(chunk)
+            chunks.append((self.chunk_key(directory, chunk), [stem for stem in chunk if stem in found]))
+        chunks.extend((self.chunk_key(directory, [stem]), [stem]) for stem in stems if stem not in listed)
+        for key, chunk in chunks:
+            if chunk and key not in self.held:
+                self.chunks.setdefault(key, (directory, chunk))
+
+    # Function: claim_next
+    # Description: claims the first chunk no one else holds and returns (key, directory, stems), or None.
+    # Chunks found claimed by someone else are only tried again after retry_seconds.
+    def claim_next(self):
+        now = time.time()
+        for key in list(self.chunks):
+            if now - self.skipped.get(key, 0) < self.retry_seconds:
+                continue
+            state = self.try_claim(key)
+            if state == 'claimed':
+                self.held[key] = self.chunks.pop(key)
+                self.skipped.pop(key, None)
+                return (key,) + self.held[key]
+            if state == 'done':
+                del self.chunks[key]
+                self.skipped.pop(key, None)
+            else:
+                self.skipped[key] = now
+        return None
+
+    # Function: newest_generation
+    # Description: the generation of the newest claim of a chunk, or -1 if it was never claimed.
+    def newest_generation(self, key):
+        generation = 0
+        while os.path.exists(self.claim_path(key, generation)):
+            generation += 1
+        return generation - 1
+
+    # Function: try_claim
+    # Description: tries to claim a chunk. Returns 'claimed', 'taken' or 'done'.
+    def try_claim(self, key):
+        if os.path.exists(self.done_path(key)):
+            return 'done'
+        newest = self.newest_generation(key)
+        if newest >= 0 and not self.claim_is_free(self.claim_path(key, newest)):
+            return 'taken'
+        path = self.claim_path(key, newest + 1)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return 'taken'
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'owner': self.owner, 'host': socket.gethostname(), 'pid': os.getpid(),
+                       'token': self.token, 'claimed': time.time()}, f)
+        self.generations[key] = newest + 1
+        # The chunk may have been finished between checking for its done marker and claiming it.
+        if os.path.exists(self.done_path(key)):
+            self.release_claim(key)
+            return 'done'
+        if newest >= 0:
+            print(f"Took over chunk {key} from an expired or released claim.")
+        return 'claimed'
+
+    # Function: claim_is_free
+    # Description: whether a claim was released, wasn't touched for lease_seconds or belongs to a process of
+    # this machine that is gone.
+    def claim_is_free(self, path):
+        try:
+            stat = os.stat(path)
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return True
+        except (OSError, ValueError):
+            # A claim that is still being written; the lease alone decides.
+            data = {}
+        if data.get('released') or time.time() - stat.st_mtime > self.lease_seconds:
+            return True
+        return data.get('host') == socket.gethostname() and isinstance(data.get('pid'), int) and \
+            data['pid'] != os.getpid() and not process_alive(data['pid'])
+
+    # Function: owns
+    # Description: whether this SortingHat's claim on a chunk is still the newest one.
+    def owns(self, key):
+        generation = self.generations.get(key)
+        if generation is None or os.path.exists(self.claim_path(key, generation + 1)):
+            return False
+        try:
+            with open(self.claim_path(key, generation), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return data.get('token') == self.token and not data.get('released')
+
+    # Function: renew
+    # Description: touches the claims held, at most every lease_seconds / 4. Returns the keys of chunks whose
+    # claim was lost in the meantime (e.g. after the computer slept through the lease), which are given up.
+    def renew(self, force=False):
+        now = time.time()
+        if not force and now - self.last_renewal < self.lease_seconds / 4:
+            return []
+        self.last_renewal = now
+        lost = []
+        for key in list(self.held):
+            if self.owns(key):
+                try:
+                    os.utime(self.claim_path(key, self.generations[key]))
+                    continue
+                except OSError:
+                    pass
+            lost.append(key)
+            del self.held[key]
+            print(f"Lost the claim on chunk {key}; its samples are left to whoever holds it now.")
+        return lost
+
+    # Function: finish
+    # Description: marks a held chunk as done, so it is never handed out again, and clears away its claims.
+    def finish(self, key):
+        self.held.pop(key, None)
+        generation = self.generations.pop(key, None)
+        try:
+            with open(self.done_path(key), 'w') as f:
+                json.dump({'owner': self.owner, 'finished': time.time()}, f)
+        except OSError as e:
+            print(f"Could not mark chunk {key} as done: {e}")
+            return
+        for older in range(generation + 1 if generation is not None else 0):
+            try:
+                os.unlink(self.claim_path(key, older))
+            except OSError:
+                pass
+
+    # Function: release_claim
+    # Description: marks this SortingHat's claim on a chunk as released. The file is rewritten under a temporary
+    # name and renamed over itself, which is safe since no one else ever writes to that generation.
+    def release_claim(self, key):
+        generation = self.generations.pop(key, None)
+        if generation is None:
+            return
+        path = self.claim_path(key, generation)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'owner': self.owner, 'token': self.token, 'released': True}, f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass
+
+    # Function: release
+    # Description: gives up the claims still held (e.g. when the window is closed) so others can take them
+    # over right away instead of waiting for the lease to run out.
+    def release(self):
+        for key in list(self.held):
+            if self.owns(key):
+                self.release_claim(key)
+        self.held.clear()
+
+    # Function: outstanding
+    # Description: the number of chunks held or still to be claimed (some of which may be held by others).
+    def outstanding(self):
+        return len(self.held) + len(self.chunks)
+
+
+# Function: simulate_worker
+# Description: one simulated annotator: an engine in claim mode that sorts whatever it is handed into random
+# categories (undoing now and then) until nothing is left. With crash_after, it dies without releasing its
+# claims after that many sorts, to exercise the lease expiry.
+def simulate_worker(input_directory, output_directory, owner, categories, chunk_size, lease_seconds, crash_after,
+                    seed):
+    from SortingHatEngine import SortingHatEngine
+
+    rng = random.Random(seed)
+    engine = SortingHatEngine()
+    engine.resume_session = False
+    engine.background_moves = True
+    engine.claims = ClaimManager(input_directory, owner, chunk_size, lease_seconds, claim_ahead=chunk_size // 2,
+                                 retry_seconds=lease_seconds / 4)
+    engine.prepare(categories, [str(i) for i in range(len(categories))], input_directory, output_directory)
+    sorted_count = 0
+    while True:
+        engine.poll_scanner()
+        if not engine.behavior_sample_paths:
+            if engine.scan_complete and not engine.claims.outstanding():
+                break
+            time.sleep(0.05)
+            continue
+        sample = engine.behavior_sample_paths[0]
+        engine.current_index = 0
+        engine.mover.wait_for(sample)
+        if not os.path.exists(os.path.join(sample[0], sample[1] + '.avi')):
+            # Left behind by a crashed annotator who had already sorted it.
+            engine.drop_sample(0)
+            continue
+        engine.sort_sample(rng.randrange(len(categories)))
+        sorted_count += 1
+        if rng.random() < 0.1:
+            engine.undo()
+        if crash_after and sorted_count == crash_after:
+            engine.mover.flush()
+            os._exit(1)
+    engine.close_session()
+    print(f"{owner} sorted {sorted_count} samples")
+
+
+# Function: simulate
+# Description: runs several simulated annotators as separate processes on one input directory and checks that
+# every sample pair ended up in exactly one category, whole. Returns True if it did.
+def simulate(input_directory, output_directory, workers=4, chunk_size=50, lease_seconds=4, crash=True):
+    categories = ['a', 'b', 'c']
+    stems_before = set(name[:-4] for root, dirs, files in os.walk(input_directory) for name in files
+                       if name.endswith('.avi'))
+    processes = []
+    for i in range(workers):
+        crash_after = chunk_size // 2 if crash and i == 0 else 0
+        process = multiprocessing.Process(target=simulate_worker,
+                                          args=(input_directory, output_directory, f"worker{i}", categories,
+                                                chunk_size, lease_seconds, crash_after, i))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    found = {}
+    for category in categories:
+        for name in os.listdir(os.path.join(output_directory, 'categories', category)):
+            found.setdefault(name, []).append(category)
+    left = [name for root, dirs, files in os.walk(input_directory) for name in files
+            if name.endswith('.avi') or name.endswith('.jpg')]
+    duplicated = [name for name, places in found.items() if len(places) > 1]
+    split = [stem for stem in stems_before if found.get(stem + '.avi') != found.get(stem + '.jpg')]
+    missing = [stem for stem in stems_before if stem + '.avi' not in found]
+    print(f"{len(stems_before)} samples: {len(missing)} not sorted ({len(left)} files left in the input), "
+          f"{len(duplicated)} files in more than one category, {len(split)} pairs split up.")
+    return not missing and not duplicated and not split
+
+
+# Try the claims out with several processes on one machine, e.g.
+# python SortingHatClaims.py --generate 2000 --workers 4
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate several annotators sorting one input directory.')
+    parser.add_argument('work_directory', nargs='?', default=None,
+                        help='an empty directory to put the input and output directories in (default: a temp dir)')
+    parser.add_argument('--generate', type=int, default=1000, help='number of synthetic samples to generate')
+    parser.add_argument('--workers', type=int, default=4, help='number of annotator processes')
+    parser.add_argument('--chunk-size', type=int, default=50, help='samples per claimed chunk')
+    parser.add_argument('--lease-seconds', type=float, default=4, help='lease of a claim')
+    parser.add_argument('--no-crash', action='store_true', help="don't let the first annotator crash")
+    args = parser.parse_args()
+    # The simulation moves every file it finds, so it never runs where there is anything else.
+    if args.work_directory and os.path.isdir(args.work_directory) and os.listdir(args.work_directory):
+        parser.error(f"{args.work_directory} is not empty.")
+
+    from SortingHatBenchmark import generate_tree
+
+    work_directory = args.work_directory or tempfile.mkdtemp(prefix='sortinghat_claims_')
+    simulation_input = os.path.join(work_directory, 'input')
+    simulation_output = os.path.join(work_directory, 'output')
+    generate_tree(simulation_input, args.generate, empty_every=0)
+    ok = simulate(simulation_input, simulation_output, args.workers, args.chunk_size, args.lease_seconds,
+                  not args.no_crash)
+    if not args.work_directory:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    print("OK" if ok else "FAILED")
@@ -0,0 +1,228 @@
+import os
+import cv2
+import json
+import argparse
+import threading
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from SortingHatArchive import open_capture, read_image
+from SortingHatProxy import proxy_key
+from SortingHatScanner import iter_samples
+
+# The hash cache lives next to the LabGym output, like the empty frame index. It is keyed like the proxies
+# (stem, size and mtime), so hashes stay valid when samples are moved into category folders.
+HASH_FILE_NAME = '.sortinghat_hashes.json'
+HASH_VERSION = 1
+HASH_SIZE = 8
+# The sample hash is the jpg hash followed by the hashes of KEYFRAMES frames of the avi (first, middle, last).
+KEYFRAMES = 3
+
+
+# Function: dhash_stack
+# Description: difference hashes of a (n, height, width) or (n, height, width, 3) stack of images, vectorised:
+# every image is shrunk to (HASH_SIZE + 1) x HASH_SIZE and each bit says whether a pixel is brighter than its
+# left neighbour. Returns n unsigned 64 bit integers.
+def dhash_stack(images):
+    small = np.empty((len(images), HASH_SIZE, HASH_SIZE + 1), dtype=np.float32)
+    for i, image in enumerate(images):
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        cv2.resize(image.astype(np.float32), (HASH_SIZE + 1, HASH_SIZE), dst=small[i], interpolation=cv2.INTER_AREA)
+    bits = (small[:, :, 1:] > small[:, :, :-1]).reshape(len(images), -1)
+    return np.packbits(bits, axis=1).view('>u8')[:, 0]
+
+
+# Function: read_keyframes
+# Description: the first, middle and last frame of an avi (KEYFRAMES evenly spaced frames), or None.
+def read_keyframes(video_name):
+    cap = open_capture(video_name)
+    if not cap.isOpened():
+        return None
+    frame_count = max(1, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+    wanted = sorted(set(int(round(i * (frame_count - 1) / max(1, KEYFRAMES - 1))) for i in range(KEYFRAMES)))
+    frames = []
+    position = 0
+    last = None
+    for target in wanted:
+        while position < target and cap.grab():
+            position += 1
+        ok, frame = cap.read()
+        if not ok:
+            break
+        position += 1
+        last = frame
+        frames.append(frame)
+    cap.release()
+    if last is None:
+        return None
+    # Clips shorter than reported repeat their last frame, so every hash has the same length.
+    return frames + [last] * (KEYFRAMES - len(frames))
+
+
+# Function: hash_sample
+# Description: the perceptual hash of a sample as a hex string: its jpg and its avi keyframes, or None if either
+# can't be read.
+def hash_sample(video_name):
+    image = read_image(video_name[:-4] + '.jpg', cv2.IMREAD_GRAYSCALE)
+    keyframes = read_keyframes(video_name)
+    if image is None or keyframes is None:
+        return None
+    hashes = dhash_stack([image] + keyframes)
+    return ''.join(f"{int(h):016x}" for h in hashes)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+# Class: BKTree
+# Description: a Burkhard-Keller tree over Hamming distance, for finding every hash within a radius of another
+# without comparing against all of them. Each node is [hash, value, {distance: child}].
+class BKTree():
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, item_hash, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [item_hash, value, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(item_hash, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [item_hash, value, {}]
+                return
+            node = child
+
+    # Function: search
+    # Description: returns (distance, value) of every hash within radius of item_hash, nearest first.
+    def search(self, item_hash, radius):
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(item_hash, node[0])
+            if distance <= radius:
+                found.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return sorted(found)
+
+    def __len__(self):
+        return self.size
+
+
+# Function: cluster_hashes
+# Description: groups near-duplicate hashes. Samples are taken in order; each one joins the cluster of the
+# nearest cluster leader within radius bits, or starts a new cluster as its leader. Comparing against leaders
+# only keeps long chains of slightly different samples from merging into one huge cluster.
+# hashes may contain None for samples that couldn't be hashed; they end up alone.
+# Returns a list of clusters, each a list of indices into hashes in order.
+def cluster_hashes(hashes, radius=20):
+    leaders = BKTree()
+    clusters = []
+    for i, item_hash in enumerate(hashes):
+        if item_hash is None:
+            clusters.append([i])
+            continue
+        value = int(item_hash, 16)
+        nearest = leaders.search(value, radius)
+        if nearest:
+            clusters[nearest[0][1]].append(i)
+        else:
+            leaders.add(value, len(clusters))
+            clusters.append([i])
+    return clusters
+
+
+# Class: HashCache
+# Description: the sample hashes computed so far, saved in the input directory so reruns only hash new or
+# changed samples.
+class HashCache():
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == HASH_VERSION:
+            self.entries = data.get('entries', {})
+
+    def save(self):
+        with self.lock:
+            data = {'version': HASH_VERSION, 'entries': dict(self.entries)}
+        try:
+            with open(self.cache_path + '.tmp', 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(self.cache_path + '.tmp', self.cache_path)
+        except OSError as e:
+            print(f"Could not save the hash cache {self.cache_path}: {e}")
+
+    def lookup(self, video_name):
+        key = proxy_key(video_name)
+        return self.entries.get(key) if key is not None else None
+
+    def record(self, video_name, sample_hash):
+        key = proxy_key(video_name)
+        if key is not None and sample_hash is not None:
+            with self.lock:
+                self.entries[key] = sample_hash
+
+
+# Function: hash_samples
+# Description: the hashes of a list of avi files, taking what it can from the cache and computing the rest on
+# a pool (a process pool by default; the GUI passes a thread pool). Returns the hashes in order.
+def hash_samples(video_names, cache=None, workers=None, executor_class=ProcessPoolExecutor, chunksize=16):
+    hashes = [cache.lookup(video_name) if cache is not None else None for video_name in video_names]
+    missing = [i for i in range(len(video_names)) if hashes[i] is None]
+    if missing:
+        with executor_class(max_workers=workers) as pool:
+            names = [video_names[i] for i in missing]
+            if executor_class is ProcessPoolExecutor:
+                results = pool.map(hash_sample, names, chunksize=chunksize)
+            else:
+                results = pool.map(hash_sample, names)
+            for i, sample_hash in zip(missing, results):
+                hashes[i] = sample_hash
+                if cache is not None:
+                    cache.record(video_names[i], sample_hash)
+        if cache is not None:
+            cache.save()
+    return hashes
+
+
+# Find the near-duplicates from the command line, e.g. python SortingHatDuplicates.py /path/to/labgym/output
+# This fills the hash cache, so clustering in the GUI afterwards is quick.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hash LabGym samples and report clusters of near-duplicates.')
+    parser.add_argument('input_directory', help='directory holding the LabGym avi/jpg samples')
+    parser.add_argument('--workers', type=int, default=None, help='number of hashing processes')
+    parser.add_argument('--radius', type=int, default=20,
+                        help=f"most differing bits (of {HASH_SIZE ** 2 * (KEYFRAMES + 1)}) for near-duplicates")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    samples = list(iter_samples(args.input_directory))
+    video_names = [os.path.join(root, stem + '.avi') for root, stem in samples]
+    hash_cache = HashCache(os.path.join(args.input_directory, HASH_FILE_NAME))
+    hash_cache.load()
+    sample_hashes = hash_samples(video_names, hash_cache, args.workers)
+    hash_seconds = time.perf_counter() - start
+    sample_clusters = [cluster for cluster in cluster_hashes(sample_hashes, args.radius) if len(cluster) > 1]
+    print(f"Hashed {len(samples)} samples in {hash_seconds:.1f}s and clustered them in "
+          f"{time.perf_counter() - start - hash_seconds:.1f}s: {len(sample_clusters)} clusters of near-duplicates "
+          f"holding {sum(len(cluster) for cluster in sample_clusters)} samples.")
+    for cluster in sorted(sample_clusters, key=len, reverse=True)[:10]:
+        print(f"  {len(cluster)} samples, e.g. {samples[cluster[0]][1]}")
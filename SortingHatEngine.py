@@ -0,0 +1,784 @@
+import os
+import csv
+import json
+import shutil
+import time
+import argparse
+from array import array
+from SortingHatArchive import ARCHIVE_INDEX_FILE_NAME, ArchiveScanner, ArchiveSource, is_archive
+from SortingHatLabels import LABELS_FILE_NAME, LabelStore, commit_labels
+from SortingHatRegistry import SampleRegistry, UndoStack
+from SortingHatScanner import StreamingScanner, iter_samples
+from SortingHatMetrics import metrics
+from SortingHatMover import MOVES_FILE_NAME, PairMover
+
+# The session snapshot and its journal live in the output directory, next to the categories they describe.
+SESSION_FILE_NAME = '.sortinghat_session.json'
+JOURNAL_FILE_NAME = '.sortinghat_session.journal'
+SESSION_VERSION = 2
+
+
+# Class: SortingHatEngine
+# Description: the display independent part of the SortingHat: finding the samples, mapping behaviors to keys
+# and category directories, and moving sample pairs in and out of those directories (with undo and redo).
+# behavior_sample_paths is a SampleRegistry; indexing it by current_index gives the (directory, stem) sample.
+# It imports neither wx nor cv2, so it can be used from scripts and the command line without a display.
+class SortingHatEngine():
+
+    # Set up the variables we need for the engine.
+    def __init__(self):
+        self.behavior_names = []
+        self.behavior_key_mapping = []
+        self.input_image_directory = None
+        self.output_image_directory = None
+        self.undo_key = None
+        self.behavior_sample_paths = None
+        self.category_directories = None
+        self.category_strings = None
+        self.undo_stack = UndoStack()
+        self.redo_stack = UndoStack()
+        self.current_index = 0
+        # Resume from the session saved in the output directory instead of scanning the input directory again.
+        # Every action is appended to a journal, which is folded into the snapshot every session_compact_every entries.
+        self.resume_session = True
+        self.session_compact_every = 500
+        self.session_generation = 0
+        self.journal_file = None
+        self.journal_entries = 0
+        # The input directory is scanned on a background thread while sorting already goes on. With watch_input,
+        # the scanner keeps polling for sample pairs LabGym writes later and appends them to the samples to sort.
+        self.scanner = None
+        self.scan_complete = True
+        self.watch_input = False
+        self.watch_interval = 5
+        # With background_moves, sample pairs are moved by a PairMover thread in the order they were sorted,
+        # so a key press doesn't wait for the file system. Pending moves are finished when the session is closed.
+        self.background_moves = False
+        self.mover = None
+        # Moves the mover reported as failed, waiting for the sample's other queued moves to finish.
+        self.failed_moves = []
+        # Clusters of near-duplicate samples as lists of sample ids, and the cluster of each clustered sample id.
+        self.cluster_members = []
+        self.sample_clusters = {}
+        # With claims (a ClaimManager), several SortingHats sort one input directory together. Only the samples
+        # of the chunks claimed here are added to the samples to sort, and chunk_samples holds their sample ids.
+        # Sessions aren't kept in this mode: a restarted SortingHat claims afresh.
+        self.claims = None
+        self.chunk_samples = {}
+        # With defer_moves, sorting a sample only records its label in a LabelStore in the output directory and
+        # commit_labels moves the labelled samples into their category folders in bulk. Closing the session only
+        # does so with commit_on_close, or with claims, since the other SortingHats can't see this one's labels
+        # once its chunks are released. Otherwise the labels wait for the next commit. With keep_input,
+        # committing hard links the files instead, leaving the input as it was.
+        self.defer_moves = False
+        self.keep_input = False
+        self.commit_on_close = False
+        self.label_store = None
+        # When the input is a zip or tar archive (an ArchiveSource), the samples are read from it in place.
+        # Archives are always sorted with defer_moves; committing extracts the labelled samples.
+        self.archive = None
+
+    # Function: prepare
+    # Description: fill in the engine variables, map the behaviors to keys and create the category directories.
+    # Returns False, after saying why, if the input is an archive that can't be read in place.
+    def prepare(self, behavior_names=[], behavior_key_mapping=[], input_image_directory='',
+                output_image_directory=os.getcwd(), undo_key='u'):
+        self.behavior_names = behavior_names
+        self.behavior_key_mapping = behavior_key_mapping
+        self.input_image_directory = input_image_directory
+        self.output_image_directory = output_image_directory
+        self.undo_key = undo_key
+        if self.archive is None and is_archive(self.input_image_directory):
+            os.makedirs(self.output_image_directory, exist_ok=True)
+            try:
+                self.archive = ArchiveSource(self.input_image_directory,
+                                             os.path.join(self.output_image_directory,
+                                                          ARCHIVE_INDEX_FILE_NAME)).open()
+            except ValueError as e:
+                print(e)
+                self.behavior_sample_paths = SampleRegistry()
+                return False
+            if self.claims is not None:
+                print("Sharing needs an input directory; the archive is sorted without claims.")
+                self.claims = None
+            self.defer_moves = True
+        if self.claims is not None:
+            self.claims.start()
+        if self.defer_moves and self.label_store is None:
+            # SortingHats sharing the output directory each keep their own label store.
+            os.makedirs(self.output_image_directory, exist_ok=True)
+            labels_file_name = LABELS_FILE_NAME if self.claims is None else self.claims.private_name(LABELS_FILE_NAME)
+            self.label_store = LabelStore(os.path.join(self.output_image_directory, labels_file_name),
+                                          self.input_image_directory)
+        if self.background_moves and self.mover is None:
+            # Started before the session is loaded: moves a crash left unfinished are completed first.
+            # SortingHats sharing the output directory each keep their own move log.
+            os.makedirs(self.output_image_directory, exist_ok=True)
+            moves_file_name = MOVES_FILE_NAME if self.claims is None else self.claims.private_name(MOVES_FILE_NAME)
+            self.mover = PairMover(os.path.join(self.output_image_directory, moves_file_name))
+            self.mover.start()
+        resumed = self.resume_session and self.claims is None and self.load_session()
+        if not resumed:
+            self.behavior_sample_paths = SampleRegistry()
+            self.undo_stack = UndoStack()
+            self.redo_stack = UndoStack()
+            self.current_index = 0
+            self.scan_complete = False
+        if not self.scan_complete or self.watch_input:
+            # Without a session, wait only for the first directory with samples so it can be shown right away.
+            self.start_scanner(wait=not resumed)
+        self.category_directories = []
+        self.category_strings = []
+        for i in range(len(self.behavior_names)):
+            self.category_strings.append((self.behavior_key_mapping[i]) + ': ' + self.behavior_names[i])
+            self.category_directories.append(self.make_category_directory(self.behavior_names[i]))
+        self.category_strings.append("u: Undo")
+        if self.behavior_sample_paths:
+            self.save_session()
+        return True
+
+    # Function: scan_samples
+    # Description: finds every (directory, stem) sample pair below the input directory in natural sort order,
+    # skipping the categories folder in case the output directory is inside the input directory.
+    def scan_samples(self):
+        return list(iter_samples(self.input_image_directory, self.scan_exclude()))
+
+    def scan_exclude(self):
+        return [os.path.join(self.output_image_directory, 'categories')]
+
+    def start_scanner(self, wait=False):
+        if self.archive is not None:
+            self.scanner = ArchiveScanner(self.archive)
+        else:
+            self.scanner = StreamingScanner(self.input_image_directory, self.scan_exclude(), self.watch_input,
+                                            self.watch_interval)
+        self.scanner.start()
+        self.poll_scanner(wait)
+
+    # Function: poll_scanner
+    # Description: appends the samples the background scanner found since the last call to the samples to sort,
+    # skipping any that are already known (e.g. from a resumed session) or labelled but not committed yet.
+    # Returns the number of samples added.
+    # In claim mode, the samples found are only cut into chunks; see update_claims for what gets added.
+    def poll_scanner(self, wait=False):
+        added = 0
+        while self.scanner is not None:
+            for batch in self.scanner.get_batches(wait):
+                if self.label_store is not None:
+                    labelled = self.label_store.labelled_stems(batch[0][0])
+                    batch = [sample for sample in batch if sample[1] not in labelled]
+                    if not batch:
+                        continue
+                if self.claims is not None:
+                    self.claims.add_batch(batch[0][0], [stem for root, stem in batch])
+                    continue
+                stems = [stem for root, stem in batch if self.behavior_sample_paths.find((root, stem)) is None]
+                for stem in stems:
+                    self.behavior_sample_paths.append((batch[0][0], stem))
+                if stems:
+                    self.journal('a', batch[0][0], stems)
+                    added += len(stems)
+            if not self.scan_complete and self.scanner.finished.is_set() and self.scanner.batches.empty():
+                self.scan_complete = True
+                if not self.watch_input:
+                    self.scanner = None
+                if self.journal_file is not None:
+                    self.save_session()
+            added += self.update_claims()
+            # The first chunks found may all be claimed by others already, so wait on for one of our own.
+            if not wait or self.claims is None or self.behavior_sample_paths or self.scan_complete:
+                return added
+        return added + self.update_claims()
+
+    # Function: update_claims
+    # Description: the claim mode bookkeeping: settles the chunks held (see settle_claims) and claims more
+    # chunks while fewer than claims.claim_ahead samples are left to sort. Returns the number of samples added.
+    def update_claims(self):
+        if self.claims is None:
+            return 0
+        samples = self.behavior_sample_paths
+        remaining = self.settle_claims()
+        added = 0
+        while remaining < self.claims.claim_ahead:
+            chunk = self.claims.claim_next()
+            if chunk is None:
+                break
+            key, directory, stems = chunk
+            self.chunk_samples[key] = array('i', [samples.append((directory, stem)) for stem in stems
+                                                  if samples.find((directory, stem)) is None])
+            remaining += len(self.chunk_samples[key])
+            added += len(self.chunk_samples[key])
+        if self.current_index >= len(samples):
+            self.current_index = max(len(samples) - 1, 0)
+        return added
+
+    # Function: settle_claims
+    # Description: renews the leases, marks chunks whose samples are all sorted as done and drops the samples
+    # of chunks whose claim was lost, without claiming anything new. Returns the number of samples left to sort
+    # in the chunks still held.
+    def settle_claims(self, force=False):
+        samples = self.behavior_sample_paths
+        for key in self.claims.renew(force):
+            for sample_id in self.chunk_samples.pop(key, ()):
+                if samples.alive[sample_id]:
+                    if samples.position_of(sample_id) < self.current_index:
+                        self.current_index -= 1
+                    samples.remove_id(sample_id)
+        remaining = 0
+        for key, sample_ids in list(self.chunk_samples.items()):
+            alive = sum(samples.alive[sample_id] for sample_id in sample_ids)
+            if not alive and key in self.claims.held:
+                self.claims.finish(key)
+                del self.chunk_samples[key]
+            remaining += alive
+        return remaining
+
+    def stop_scanner(self):
+        if self.scanner is not None:
+            self.scanner.stop()
+            self.scanner = None
+
+    # Function: sidecar_directory
+    # Description: where the caches that belong with the input (empty frame index, hashes) are kept: the input
+    # directory itself, or the output directory if the input is an archive, which is never written to.
+    def sidecar_directory(self):
+        return self.output_image_directory if self.archive is not None else self.input_image_directory
+
+    def make_category_directory(self, behavior_name):
+        category_directory = os.path.join(self.output_image_directory, 'categories', behavior_name)
+        if not os.path.exists(category_directory):
+            os.makedirs(category_directory)
+        return category_directory
+
+    # Function: category_for_key
+    # Description: returns the category index mapped to a key, or None if the key isn't mapped.
+    def category_for_key(self, key):
+        if key in self.behavior_key_mapping:
+            return self.behavior_key_mapping.index(key)
+        return None
+
+    def is_category_directory(self, directory):
+        return os.path.abspath(directory).startswith(
+            os.path.abspath(os.path.join(self.output_image_directory, 'categories')) + os.sep)
+
+    # Function: move_sample_pair
+    # Description: moves a sample pair now, or queues the move on the background mover if there is one.
+    # With defer_moves, sorting a sample only labels it, and undoing it deletes the label. A sample committed
+    # already is moved back, or its copies are removed if the input still has it (archives and keep_input).
+    def move_sample_pair(self, source_directory, destination_directory, stem):
+        if self.label_store is not None:
+            if not self.is_category_directory(source_directory):
+                self.label_store.record(source_directory, stem, os.path.basename(destination_directory))
+                return
+            if not self.label_store.remove(destination_directory, stem):
+                return
+            if self.archive is not None or self.keep_input:
+                for extension in ('.avi', '.jpg'):
+                    try:
+                        os.unlink(os.path.join(source_directory, stem + extension))
+                    except FileNotFoundError:
+                        pass
+                return
+        if self.mover is not None:
+            with metrics.stage('move_queue'):
+                self.mover.submit(source_directory, destination_directory, stem)
+        else:
+            with metrics.stage('move_pair'):
+                move_pair(source_directory, destination_directory, stem)
+
+    # Function: pending_moves
+    # Description: the number of pair moves still queued on the background mover.
+    def pending_moves(self):
+        return self.mover.depth() if self.mover is not None else 0
+
+    # Function: poll_failed_moves
+    # Description: puts the samples whose background move failed back where their files actually are. A sample
+    # still in the input is restored to the samples to sort and its undo entry dropped; one that is still in
+    # its category folder (a failed undo) is taken out again and can be undone once more. A sample whose files
+    # are gone altogether just loses its undo entry. The current sample stays the same. A failed move is only
+    # looked at once no other move of its sample is queued. Returns the (sample, category directory, sorted) of
+    # every sample put right, sorted being False for those restored, and saves the session if there were any.
+    def poll_failed_moves(self):
+        mover = self.mover
+        if mover is not None:
+            while not mover.failures.empty():
+                self.failed_moves.append(mover.failures.get())
+        samples = self.behavior_sample_paths
+        changes = []
+        waiting = []
+        for source_directory, destination_directory, stem, error in self.failed_moves:
+            if mover is not None and ((source_directory, stem) in mover.pending or
+                                      (destination_directory, stem) in mover.pending):
+                waiting.append((source_directory, destination_directory, stem, error))
+                continue
+            if self.is_category_directory(source_directory):
+                input_directory, category_directory = destination_directory, source_directory
+            else:
+                input_directory, category_directory = source_directory, destination_directory
+            sample_id = samples.find((input_directory, stem)) if samples is not None else None
+            if sample_id is None:
+                continue
+            current_id = samples.sample_id(self.current_index) if samples else None
+            in_input = os.path.exists(os.path.join(input_directory, stem + '.avi'))
+            in_category = os.path.exists(os.path.join(category_directory, stem + '.avi'))
+            if in_input and not samples.alive[sample_id]:
+                samples.restore(sample_id)
+                self.undo_stack.discard(sample_id)
+                changes.append(((input_directory, stem), category_directory, False))
+                print(f"{os.path.join(input_directory, stem)} couldn't be sorted and is back in the samples to sort.")
+            elif not in_input and samples.alive[sample_id]:
+                samples.remove_id(sample_id)
+                self.redo_stack.discard(sample_id)
+                if in_category:
+                    self.undo_stack.push(sample_id, samples.intern_directory(category_directory),
+                                         samples.position_of(sample_id))
+                    changes.append(((input_directory, stem), category_directory, True))
+                print(f"{os.path.join(input_directory, stem)} couldn't be moved back from {category_directory}.")
+            elif not in_input and not in_category:
+                self.undo_stack.discard(sample_id)
+            if current_id is not None and samples.alive[current_id]:
+                self.current_index = samples.position_of(current_id)
+            self.current_index = max(min(self.current_index, len(samples) - 1), 0)
+        self.failed_moves = waiting
+        if changes:
+            self.save_session()
+        return changes
+
+    # Function: sort_sample
+    # Description: moves the current sample pair into the category directory, records it for undo and
+    # removes it from the samples still to sort.
+    def sort_sample(self, category_index):
+        sample = self.behavior_sample_paths[self.current_index]
+        self.move_sample_pair(sample[0], self.category_directories[category_index], sample[1])
+        self.record_sort(self.current_index, self.category_directories[category_index])
+        self.journal('s', self.current_index, self.category_directories[category_index])
+        self.update_claims()
+        return sample
+
+    # Function: sort_samples
+    # Description: sorts the samples at several positions into one category as a single action, so one undo
+    # brings them all back. Afterwards the current sample is the one following the first of them.
+    def sort_samples(self, positions, category_index):
+        positions = sorted(set(positions), reverse=True)
+        if len(positions) == 1:
+            self.current_index = positions[0]
+            return [self.sort_sample(category_index)]
+        group = self.undo_stack.new_group()
+        category_directory = self.category_directories[category_index]
+        samples = []
+        # From the back, so sorting one sample doesn't shift the positions of the others.
+        for position in positions:
+            sample = self.behavior_sample_paths[position]
+            self.move_sample_pair(sample[0], category_directory, sample[1])
+            self.record_sort(position, category_directory, group)
+            self.journal('s', position, category_directory, group)
+            samples.append(sample)
+        self.update_claims()
+        return samples
+
+    # Function: cluster_positions
+    # Description: the positions of the samples still to sort in the cluster of the sample at a position
+    # (just that position if it isn't clustered).
+    def cluster_positions(self, position):
+        samples = self.behavior_sample_paths
+        cluster = self.sample_clusters.get(samples.sample_id(position))
+        if cluster is None:
+            return [position]
+        return [samples.position_of(sample_id) for sample_id in self.cluster_members[cluster]
+                if samples.alive[sample_id]]
+
+    # Function: sort_cluster
+    # Description: sorts the current sample together with the rest of its cluster, as one undoable action.
+    def sort_cluster(self, category_index):
+        return self.sort_samples(self.cluster_positions(self.current_index), category_index)
+
+    # Function: regroup_samples
+    # Description: reorders the samples so the members of each group (lists of sample ids) follow each other,
+    # in their natural order, at the place of the first of them. Everything else keeps its order. Sample ids
+    # are positions in that order, so the registry is rebuilt and the undo/redo history remapped to the new ids.
+    # The session is saved right away since the journal refers to the new ids from here on.
+    # Known clusters and claimed chunks keep their members. Returns the array mapping old sample ids to new ones.
+    def regroup_samples(self, groups):
+        samples = self.behavior_sample_paths
+        anchors = list(range(len(samples.alive)))
+        for group in groups:
+            first = min(group)
+            for sample_id in group:
+                anchors[sample_id] = first
+        order = sorted(range(len(anchors)), key=lambda sample_id: (anchors[sample_id], sample_id))
+        new_ids = array('i', bytes(4 * len(order)))
+        regrouped = SampleRegistry()
+        regrouped.directories = list(samples.directories)
+        regrouped.directory_ids = dict(samples.directory_ids)
+        for new_id, old_id in enumerate(order):
+            new_ids[old_id] = new_id
+            regrouped.sample_directories.append(samples.sample_directories[old_id])
+            regrouped.stems.append(samples.stems[old_id])
+            regrouped.alive.append(samples.alive[old_id])
+        regrouped.rebuild()
+        current_id = samples.sample_id(self.current_index) if samples else None
+        for stack in (self.undo_stack, self.redo_stack):
+            for i in range(len(stack)):
+                stack.sample_ids[i] = new_ids[stack.sample_ids[i]]
+        self.cluster_members = [sorted(new_ids[sample_id] for sample_id in members) for members in self.cluster_members]
+        self.sample_clusters = dict((new_ids[sample_id], i) for sample_id, i in self.sample_clusters.items())
+        self.chunk_samples = dict((key, array('i', [new_ids[sample_id] for sample_id in sample_ids]))
+                                  for key, sample_ids in self.chunk_samples.items())
+        self.behavior_sample_paths = regrouped
+        if current_id is not None:
+            self.current_index = regrouped.position_of(new_ids[current_id])
+        self.save_session()
+        return new_ids
+
+    # Function: set_clusters
+    # Description: brings the samples of each cluster (lists of sample ids) together in the order and remembers
+    # the clusters for cluster_positions.
+    def set_clusters(self, clusters):
+        clusters = [cluster for cluster in clusters if len(cluster) > 1]
+        new_ids = self.regroup_samples(clusters)
+        self.cluster_members = [sorted(new_ids[sample_id] for sample_id in cluster) for cluster in clusters]
+        self.sample_clusters = dict((sample_id, i) for i, cluster in enumerate(self.cluster_members)
+                                    for sample_id in cluster)
+
+    # Function: undo
+    # Description: moves the last sorted pair (or group of pairs) back to where it came from, puts it back in its
+    # old place in the samples to sort and makes it the current sample. Returns the current sample, or None if
+    # there is nothing to undo.
+    def undo(self):
+        if not self.undo_stack:
+            return None
+        for i in range(1, self.undo_stack.group_size() + 1):
+            sample_id, category = self.undo_stack.sample_ids[-i], self.undo_stack.categories[-i]
+            sample = self.behavior_sample_paths.sample(sample_id)
+            self.move_sample_pair(self.behavior_sample_paths.directories[category], sample[0], sample[1])
+        self.record_undo()
+        self.journal('u')
+        return self.behavior_sample_paths[self.current_index]
+
+    # Function: redo
+    # Description: sorts the last undone sample (or group) into the same category again. Returns the last of
+    # them, or None.
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        for i in range(1, self.redo_stack.group_size() + 1):
+            sample_id, category = self.redo_stack.sample_ids[-i], self.redo_stack.categories[-i]
+            sample = self.behavior_sample_paths.sample(sample_id)
+            self.move_sample_pair(sample[0], self.behavior_sample_paths.directories[category], sample[1])
+        self.record_redo()
+        self.journal('y')
+        self.update_claims()
+        return sample
+
+    # Function: record_sort, record_undo, record_redo
+    # Description: the bookkeeping of sort_sample, undo and redo without any file moves. They are also
+    # used to replay the session journal, so the two can't drift apart. Undo and redo take a whole group at once.
+    def record_sort(self, position, category_directory, group=0):
+        sample_id = self.behavior_sample_paths.remove_at(position)
+        self.undo_stack.push(sample_id, self.behavior_sample_paths.intern_directory(category_directory), position,
+                             group)
+        self.redo_stack.clear()
+        self.current_index = position
+
+    def record_undo(self):
+        sample_ids = []
+        for _ in range(self.undo_stack.group_size()):
+            sample_id, category, position, group = self.undo_stack.pop()
+            self.behavior_sample_paths.restore(sample_id)
+            self.redo_stack.push(sample_id, category, position, group)
+            sample_ids.append(sample_id)
+        self.current_index = self.behavior_sample_paths.position_of(min(sample_ids))
+
+    def record_redo(self):
+        positions = []
+        for _ in range(self.redo_stack.group_size()):
+            sample_id, category, position, group = self.redo_stack.pop()
+            position = self.behavior_sample_paths.position_of(sample_id)
+            self.behavior_sample_paths.remove_id(sample_id)
+            self.undo_stack.push(sample_id, category, position, group)
+            positions.append(position)
+        self.current_index = min(positions)
+
+    # Function: drop_sample
+    # Description: removes a sample that can't be sorted (missing or empty) from the samples to sort.
+    def drop_sample(self, index):
+        sample = self.behavior_sample_paths.pop(index)
+        self.journal('r', index)
+        return sample
+
+    def set_current_index(self, index):
+        self.current_index = index
+        self.journal('i', index)
+
+    # Function: save_session
+    # Description: writes the sample registry (with the ids of the samples already sorted or dropped), the current
+    # index and the undo/redo history to the session file and starts a new journal. Directories are stored once
+    # and referred to by number to keep the file small. The generation number ties the journal to its snapshot,
+    # so a journal left over from a crash between writing the two is ignored rather than replayed onto the
+    # wrong snapshot.
+    def save_session(self):
+        if self.claims is not None:
+            return
+        samples = self.behavior_sample_paths
+        self.session_generation += 1
+        data = {'version': SESSION_VERSION, 'generation': self.session_generation,
+                'input_image_directory': os.path.abspath(self.input_image_directory),
+                'directories': samples.directories,
+                'samples': [[directory, stem] for directory, stem in zip(samples.sample_directories, samples.stems)],
+                'removed': samples.removed_ids(), 'current_index': self.current_index,
+                'scan_complete': self.scan_complete,
+                'undo': [list(entry) for entry in self.undo_stack],
+                'redo': [list(entry) for entry in self.redo_stack]}
+        session_path = os.path.join(self.output_image_directory, SESSION_FILE_NAME)
+        try:
+            os.makedirs(self.output_image_directory, exist_ok=True)
+            with open(session_path + '.tmp', 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(session_path + '.tmp', session_path)
+            if self.journal_file is not None:
+                self.journal_file.close()
+            self.journal_file = open(os.path.join(self.output_image_directory, JOURNAL_FILE_NAME), 'w')
+            self.journal_file.write(json.dumps({'generation': self.session_generation}) + '\n')
+            self.journal_file.flush()
+        except OSError as e:
+            print(f"Could not save the session in {self.output_image_directory}: {e}")
+            self.journal_file = None
+        self.journal_entries = 0
+
+    # Function: journal
+    # Description: appends one action to the session journal. Actions are recorded once their file moves were
+    # done or, with the background mover, logged in its move journal, which completes them after a crash.
+    def journal(self, *entry):
+        if self.journal_file is None:
+            return
+        try:
+            self.journal_file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.journal_file.flush()
+        except OSError as e:
+            print(f"Could not write to the session journal: {e}")
+            return
+        self.journal_entries += 1
+        if self.journal_entries >= self.session_compact_every:
+            self.save_session()
+
+    # Function: load_session
+    # Description: restores the samples to sort, the current index and the undo/redo history from the session
+    # file of the same input directory and replays the journal on top of it. The samples aren't checked here;
+    # anything that disappeared in the meantime is dropped when it comes up. Returns False if there is no
+    # usable session (or nothing left in it), in which case the input directory has to be scanned.
+    def load_session(self):
+        try:
+            with open(os.path.join(self.output_image_directory, SESSION_FILE_NAME), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('version') != SESSION_VERSION or \
+                data.get('input_image_directory') != os.path.abspath(self.input_image_directory):
+            return False
+        samples = SampleRegistry()
+        for directory in data['directories']:
+            samples.intern_directory(directory)
+        for directory, stem in data['samples']:
+            samples.sample_directories.append(directory)
+            samples.stems.append(stem)
+            samples.alive.append(1)
+        for sample_id in data['removed']:
+            samples.alive[sample_id] = 0
+        samples.rebuild()
+        self.behavior_sample_paths = samples
+        self.undo_stack = UndoStack()
+        self.redo_stack = UndoStack()
+        for entry in data['undo']:
+            self.undo_stack.push(*entry)
+        for entry in data['redo']:
+            self.redo_stack.push(*entry)
+        self.current_index = data['current_index']
+        self.scan_complete = data.get('scan_complete', True)
+        self.session_generation = data['generation']
+        self.replay_journal()
+        if not self.behavior_sample_paths and self.scan_complete:
+            return False
+        self.current_index = max(min(self.current_index, len(self.behavior_sample_paths) - 1), 0)
+        return True
+
+    # Function: replay_journal
+    # Description: applies the journalled actions to the samples and undo history. No files are moved,
+    # that already happened when the actions were taken (or when the mover recovered its unfinished moves).
+    def replay_journal(self):
+        try:
+            with open(os.path.join(self.output_image_directory, JOURNAL_FILE_NAME), 'r') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        try:
+            if not lines or json.loads(lines[0]).get('generation') != self.session_generation:
+                return
+            for line in lines[1:]:
+                entry = json.loads(line)
+                if entry[0] == 's':
+                    self.record_sort(*entry[1:])
+                elif entry[0] == 'u':
+                    self.record_undo()
+                elif entry[0] == 'y':
+                    self.record_redo()
+                elif entry[0] == 'r':
+                    self.behavior_sample_paths.remove_at(entry[1])
+                elif entry[0] == 'i':
+                    self.current_index = entry[1]
+                elif entry[0] == 'a':
+                    for stem in entry[2]:
+                        self.behavior_sample_paths.append((entry[1], stem))
+        except (ValueError, IndexError):
+            # A line cut short by a crash ends the replay; everything before it still counts.
+            return
+
+    # Function: commit_labels
+    # Description: moves (or extracts, or links) the samples labelled since the last commit into their category
+    # folders. Returns the summary of SortingHatLabels.commit_labels, or None without defer_moves.
+    def commit_labels(self, progress=True):
+        if self.label_store is None or not self.label_store.pending:
+            return None
+        # Samples undone after an earlier commit may still be on their way back to the input.
+        if self.mover is not None:
+            self.mover.flush()
+        with metrics.stage('commit_labels'):
+            return commit_labels(self.label_store, os.path.join(self.output_image_directory, 'categories'),
+                                 self.keep_input, progress=progress)
+
+    # Function: pending_labels
+    # Description: the number of labelled samples not committed yet.
+    def pending_labels(self):
+        return self.label_store.pending if self.label_store is not None else 0
+
+    def close_session(self):
+        self.stop_scanner()
+        if self.mover is not None:
+            self.mover.close()
+            self.poll_failed_moves()
+            self.mover = None
+        if self.commit_on_close or self.claims is not None:
+            summary = self.commit_labels()
+            if summary is not None:
+                print(f"Committed {summary['committed']} labelled samples, {summary['failed']} failed.")
+        elif self.pending_labels():
+            print(f"{self.pending_labels()} labelled samples are not committed yet. Commit them with ctrl+s next "
+                  f"time or with python SortingHatLabels.py {self.output_image_directory}")
+        # Chunks left half done go back to the others once the moves are finished. Nothing new is claimed here.
+        if self.claims is not None:
+            self.settle_claims(force=True)
+            self.claims.release()
+        if self.journal_file is not None:
+            self.save_session()
+            self.journal_file.close()
+            self.journal_file = None
+        if self.label_store is not None:
+            self.label_store.close()
+            self.label_store = None
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    # Function: apply_labels
+    # Description: sorts every sample whose stem has a label in one pass over the samples.
+    # labels maps sample stems to behavior names; behaviors without a category directory get one.
+    # These moves are not added to the undo list. With dry_run, nothing is moved or created.
+    # Returns a summary dictionary with the counts and the elapsed time.
+    def apply_labels(self, labels, dry_run=False):
+        start = time.perf_counter()
+        category_directories = dict(zip(self.behavior_names, self.category_directories or []))
+        samples = self.behavior_sample_paths
+        summary = {'moved': 0, 'failed': 0, 'unlabelled': 0, 'unmatched': 0, 'categories': {}}
+        matched_stems = set()
+        for sample_id in range(len(samples.alive)):
+            if not samples.alive[sample_id]:
+                continue
+            sample = samples.sample(sample_id)
+            behavior = labels.get(sample[1])
+            if behavior is None:
+                summary['unlabelled'] += 1
+                continue
+            matched_stems.add(sample[1])
+            if behavior not in category_directories:
+                if dry_run:
+                    category_directories[behavior] = os.path.join(self.output_image_directory, 'categories',
+                                                                  behavior)
+                else:
+                    category_directories[behavior] = self.make_category_directory(behavior)
+            if not dry_run:
+                try:
+                    move_pair(sample[0], category_directories[behavior], sample[1])
+                except OSError as e:
+                    print(f"Could not move {os.path.join(sample[0], sample[1])}: {e}")
+                    summary['failed'] += 1
+                    continue
+                samples.remove_id(sample_id)
+            summary['moved'] += 1
+            summary['categories'][behavior] = summary['categories'].get(behavior, 0) + 1
+        summary['unmatched'] = len(set(labels) - matched_stems)
+        if not dry_run:
+            self.current_index = min(self.current_index, max(len(samples) - 1, 0))
+        summary['seconds'] = time.perf_counter() - start
+        return summary
+
+
+# Function: move_pair
+# Description: moves the jpg and avi of a sample from one directory to another.
+def move_pair(source_directory, destination_directory, stem):
+    # The avi first, see PairMover.rename_pair.
+    for extension in (".avi", ".jpg"):
+        shutil.move(os.path.join(source_directory, stem + extension),
+                    os.path.join(destination_directory, stem + extension))
+
+
+# Function: load_labels
+# Description: reads a sample stem -> behavior mapping from a csv file (stem,behavior per row, with an optional
+# header) or from a json file (either an object of stem: behavior or a list of [stem, behavior] pairs).
+# A stem may also be given as a file name; the .avi/.jpg extension is stripped.
+def load_labels(labels_path):
+    if labels_path.lower().endswith('.json'):
+        with open(labels_path, 'r') as f:
+            data = json.load(f)
+        pairs = data.items() if isinstance(data, dict) else data
+    else:
+        with open(labels_path, 'r', newline='') as f:
+            pairs = [row[:2] for row in csv.reader(f) if len(row) >= 2]
+        if pairs and [value.strip().lower() for value in pairs[0]] in (['stem', 'category'],
+                                                                             ['stem', 'behavior']):
+            pairs = pairs[1:]
+    labels = {}
+    for stem, behavior in pairs:
+        stem = str(stem).strip()
+        if stem.endswith('.avi') or stem.endswith('.jpg'):
+            stem = stem[:-4]
+        labels[stem] = str(behavior).strip()
+    return labels
+
+
+# Run the bulk labelling from the command line, e.g.
+# python SortingHatEngine.py --input /path/to/labgym/output --output /path/to/sorted --labels labels.csv
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sort LabGym samples into category folders from a label file.')
+    parser.add_argument('--input', required=True, help='directory holding the LabGym avi/jpg samples')
+    parser.add_argument('--output', required=True, help='directory the categories folder is created in')
+    parser.add_argument('--labels', required=True, help='csv or json file mapping sample stems to behaviors')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be moved')
+    args = parser.parse_args()
+
+    labels = load_labels(args.labels)
+    engine = SortingHatEngine()
+    scan_start = time.perf_counter()
+    engine.input_image_directory = args.input
+    engine.output_image_directory = args.output
+    engine.behavior_sample_paths = SampleRegistry(engine.scan_samples())
+    scan_seconds = time.perf_counter() - scan_start
+    summary = engine.apply_labels(labels, dry_run=args.dry_run)
+
+    print(f"Found {len(engine.behavior_sample_paths) + (0 if args.dry_run else summary['moved'])} samples "
+          f"in {scan_seconds:.2f}s")
+    for behavior, count in sorted(summary['categories'].items()):
+        print(f"  {behavior}: {count}")
+    verb = 'Would move' if args.dry_run else 'Moved'
+    rate = summary['moved'] / summary['seconds'] if summary['seconds'] > 0 else 0
+    print(f"{verb} {summary['moved']} samples in {summary['seconds']:.2f}s ({rate:.0f} samples/s). "
+          f"{summary['failed']} failed, {summary['unlabelled']} samples had no label, "
+          f"{summary['unmatched']} labels matched no sample.")
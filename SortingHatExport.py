@@ -0,0 +1,233 @@
+import os
+import json
+import mmap
+import tarfile
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# The export directory holds the shards (plain, uncompressed tar files, so the sample bytes sit in them as is)
+# and this index of where every sample is in them.
+EXPORT_INDEX_NAME = 'sortinghat_index.json'
+EXPORT_VERSION = 2
+
+
+# Function: list_sorted
+# Description: the complete sample pairs in the category folders of an output directory, in natural order per
+# category, as (category, stem, avi size, avi mtime_ns, jpg size, jpg mtime_ns) tuples.
+def list_sorted(categories_directory):
+    from natsort import natsorted
+    samples = []
+    try:
+        categories = natsorted(entry.name for entry in os.scandir(categories_directory) if entry.is_dir())
+    except OSError:
+        return samples
+    for category in categories:
+        stats = {}
+        with os.scandir(os.path.join(categories_directory, category)) as entries:
+            for entry in entries:
+                if entry.name.endswith('.avi') or entry.name.endswith('.jpg'):
+                    try:
+                        stats[entry.name] = entry.stat()
+                    except OSError:
+                        pass
+        for stem in natsorted(name[:-4] for name in stats if name.endswith('.avi')):
+            jpg = stats.get(stem + '.jpg')
+            if jpg is not None:
+                avi = stats[stem + '.avi']
+                samples.append((category, stem, avi.st_size, avi.st_mtime_ns, jpg.st_size, jpg.st_mtime_ns))
+    return samples
+
+
+# Function: pack_shard
+# Description: writes the pairs of samples ((category, stem, ...) tuples) into one tar shard as category/stem.jpg
+# and category/stem.avi and returns where their bytes ended up: (category, stem, jpg offset, jpg length, avi
+# offset, avi length) per sample. The shard is written under a temporary name first, so a half-written shard
+# never looks complete.
+def pack_shard(categories_directory, shard_path, samples):
+    with tarfile.open(shard_path + '.part', 'w') as tar:
+        for category, stem in ((sample[0], sample[1]) for sample in samples):
+            for extension in ('.jpg', '.avi'):
+                tar.add(os.path.join(categories_directory, category, stem + extension),
+                        f"{category}/{stem}{extension}", recursive=False)
+    # The data offsets are only known once the headers are written, so read them back.
+    locations = {}
+    with tarfile.open(shard_path + '.part', 'r') as tar:
+        for member in tar:
+            locations[member.name] = (member.offset_data, member.size)
+    os.replace(shard_path + '.part', shard_path)
+    return [(category, stem) + locations[f"{category}/{stem}.jpg"] + locations[f"{category}/{stem}.avi"]
+            for category, stem in ((sample[0], sample[1]) for sample in samples)]
+
+
+def load_index(export_directory):
+    try:
+        with open(os.path.join(export_directory, EXPORT_INDEX_NAME), 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if index.get('version') == EXPORT_VERSION else None
+
+
+# Function: export_samples
+# Description: packs the sorted samples of an output directory into tar shards of about shard_bytes each, on a
+# process pool, and writes the index: the category and shard names, and a compact row per sample of
+# [category id, stem, shard id, jpg offset, jpg length, avi offset, avi length, avi size, avi mtime_ns,
+# jpg mtime_ns]. Incrementally (the default), samples already exported to the same category with both files
+# unchanged (same size and mtime) are kept where they are and only the rest go into new shards. Samples no
+# longer there (undone or moved to another category) drop out of the index, and shards nothing refers to any
+# more are deleted. Returns a summary dictionary.
+def export_samples(output_directory, export_directory, shard_bytes=2 ** 30, workers=None, incremental=True):
+    start = time.perf_counter()
+    categories_directory = os.path.join(output_directory, 'categories')
+    os.makedirs(export_directory, exist_ok=True)
+    index = load_index(export_directory)
+    if index is None:
+        index = {'version': EXPORT_VERSION, 'categories': [], 'shards': [], 'samples': []}
+    elif not incremental:
+        # Everything is repacked; the old shards are deleted below since no sample refers to them any more.
+        index['samples'] = []
+    current = dict(((sample[0], sample[1]), sample) for sample in list_sorted(categories_directory))
+
+    kept = []
+    for row in index['samples']:
+        sample = current.get((index['categories'][row[0]], row[1]))
+        if sample is not None and sample[2:] == (row[7], row[8], row[4], row[9]):
+            kept.append(row)
+            del current[(sample[0], sample[1])]
+    new_samples = list(current.values())
+
+    # Fill the new shards in order, so each holds a run of neighbouring samples of a category.
+    groups = [[]]
+    group_bytes = 0
+    for sample in new_samples:
+        if groups[-1] and group_bytes + sample[2] + sample[4] > shard_bytes:
+            groups.append([])
+            group_bytes = 0
+        groups[-1].append(sample)
+        group_bytes += sample[2] + sample[4]
+    groups = [group for group in groups if group]
+    first_number = max([int(name[6:-4]) + 1 for name in index['shards']] + [0])
+    shard_names = [f"shard-{first_number + i:05d}.tar" for i in range(len(groups))]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(pack_shard, [categories_directory] * len(groups),
+                                [os.path.join(export_directory, name) for name in shard_names], groups))
+
+    categories = list(index['categories'])
+    shards = list(index['shards'])
+    for name, group, locations in zip(shard_names, groups, results):
+        shards.append(name)
+        for sample, location in zip(group, locations):
+            if sample[0] not in categories:
+                categories.append(sample[0])
+            kept.append([categories.index(sample[0]), sample[1], len(shards) - 1] + list(location[2:]) +
+                        [sample[2], sample[3], sample[5]])
+
+    # Renumber the shards still referred to. The others are deleted once the new index is in place, so the
+    # index never points at a missing shard.
+    used = sorted(set(row[2] for row in kept))
+    renumbered = dict((old, new) for new, old in enumerate(used))
+    for row in kept:
+        row[2] = renumbered[row[2]]
+    index = {'version': EXPORT_VERSION, 'categories': categories, 'shards': [shards[old] for old in used],
+             'samples': kept}
+    index_path = os.path.join(export_directory, EXPORT_INDEX_NAME)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(index_path + '.tmp', index_path)
+    for shard_id, name in enumerate(shards):
+        if shard_id not in renumbered:
+            try:
+                os.unlink(os.path.join(export_directory, name))
+            except OSError:
+                pass
+    return {'exported': len(new_samples), 'unchanged': len(kept) - len(new_samples), 'new_shards': len(groups),
+            'shards': len(index['shards']), 'seconds': time.perf_counter() - start}
+
+
+# Class: ShardReader
+# Description: reads exported samples straight out of the shards. Shards are memory-mapped when first used, so
+# read returns a zero-copy view of a file's bytes and only the pages actually touched are read from disk.
+class ShardReader():
+
+    def __init__(self, export_directory):
+        self.export_directory = export_directory
+        index = load_index(export_directory)
+        if index is None:
+            raise FileNotFoundError(f"No export index in {export_directory}")
+        self.categories = index['categories']
+        self.shards = index['shards']
+        self.rows = dict(((self.categories[row[0]], row[1]), row) for row in index['samples'])
+        self.maps = {}
+
+    # Function: samples
+    # Description: the (category, stem) samples of the export, optionally of one category only.
+    def samples(self, category=None):
+        return [key for key in self.rows if category is None or key[0] == category]
+
+    def shard(self, shard_id):
+        shard_map = self.maps.get(shard_id)
+        if shard_map is None:
+            with open(os.path.join(self.export_directory, self.shards[shard_id]), 'rb') as f:
+                shard_map = self.maps[shard_id] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return shard_map
+
+    # Function: read
+    # Description: a memoryview of the bytes of a sample's '.jpg' or '.avi' file.
+    def read(self, category, stem, extension='.avi'):
+        row = self.rows[(category, stem)]
+        offset, length = (row[3], row[4]) if extension == '.jpg' else (row[5], row[6])
+        return memoryview(self.shard(row[2]))[offset:offset + length]
+
+    # Function: image
+    # Description: the decoded jpg of a sample, as cv2.imread would return it.
+    def image(self, category, stem):
+        import cv2
+        import numpy as np
+        return cv2.imdecode(np.frombuffer(self.read(category, stem, '.jpg'), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    # Function: extract
+    # Description: writes the samples (of one category, or all) back out as category/stem.jpg and .avi files
+    # under a directory, e.g. for LabGym training on a machine the shards were copied to.
+    def extract(self, destination_directory, category=None):
+        samples = self.samples(category)
+        for sample_category, stem in samples:
+            os.makedirs(os.path.join(destination_directory, sample_category), exist_ok=True)
+            for extension in ('.jpg', '.avi'):
+                with open(os.path.join(destination_directory, sample_category, stem + extension), 'wb') as f:
+                    f.write(self.read(sample_category, stem, extension))
+        return len(samples)
+
+    def close(self):
+        for shard_map in self.maps.values():
+            shard_map.close()
+        self.maps.clear()
+
+    def __len__(self):
+        return len(self.rows)
+
+
+# Export from the command line, e.g. python SortingHatExport.py /path/to/output /path/to/export
+# Run it again after sorting more to add just the new samples; --extract unpacks an export on the other side.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the sorted samples into a few large indexed tar shards.')
+    parser.add_argument('output_directory', help='the LabGymSortingHat output directory (holding categories/), '
+                                                 'or with --extract the directory to unpack into')
+    parser.add_argument('export_directory', help='where the shards and their index go')
+    parser.add_argument('--shard-mb', type=float, default=1024, help='approximate size of each shard')
+    parser.add_argument('--workers', type=int, default=None, help='number of packing processes')
+    parser.add_argument('--full', action='store_true', help='repack everything instead of adding to the export')
+    parser.add_argument('--extract', action='store_true', help='unpack the export into output_directory')
+    args = parser.parse_args()
+
+    if args.extract:
+        reader = ShardReader(args.export_directory)
+        print(f"Extracted {reader.extract(args.output_directory)} samples to {args.output_directory}")
+        reader.close()
+    else:
+        summary = export_samples(args.output_directory, args.export_directory, int(args.shard_mb * 2 ** 20),
+                                 args.workers, not args.full)
+        print(f"Exported {summary['exported']} samples into {summary['new_shards']} new shards "
+              f"({summary['unchanged']} already exported, {summary['shards']} shards in all) "
+              f"in {summary['seconds']:.1f}s")
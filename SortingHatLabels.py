@@ -0,0 +1,215 @@
+import os
+import uuid
+import time
+import errno
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from SortingHatArchive import ARCHIVE_INDEX_FILE_NAME, ArchiveSource, find_member, is_archive
+from SortingHatMover import EXTENSIONS, copy_synced, fsync_directory
+
+# The label store lives in the output directory, next to the categories it is committed to.
+LABELS_FILE_NAME = '.sortinghat_labels.sqlite'
+
+
+# Class: LabelStore
+# Description: the sorting decisions of deferred mode, one row per sample in a SQLite database in WAL mode:
+# its directory and stem, the category name, when it was labelled, by which session, and whether its files
+# were moved into the category yet (committed). Labelling or unlabelling a sample is a single small transaction
+# appended to the write-ahead log, which SQLite only syncs to disk at checkpoints, so a key press never waits
+# on the sample files. Directories are stored as absolute paths. pending counts the rows not committed yet.
+class LabelStore():
+
+    def __init__(self, store_path, input_directory=None):
+        self.store_path = store_path
+        self.connection = sqlite3.connect(store_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS labels (directory TEXT NOT NULL, stem TEXT NOT NULL, '
+                                    'category TEXT NOT NULL, labelled REAL NOT NULL, session TEXT NOT NULL, '
+                                    'committed INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (directory, stem))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS labels_committed ON labels (committed)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sessions (session TEXT PRIMARY KEY, '
+                                    'input_directory TEXT, started REAL NOT NULL)')
+        self.session = uuid.uuid4().hex
+        if input_directory is not None:
+            with self.connection:
+                self.connection.execute('INSERT INTO sessions VALUES (?, ?, ?)',
+                                        (self.session, os.path.abspath(input_directory), time.time()))
+        self.pending = self.connection.execute('SELECT COUNT(*) FROM labels WHERE committed = 0').fetchone()[0]
+
+    def committed_state(self, directory, stem):
+        row = self.connection.execute('SELECT committed FROM labels WHERE directory = ? AND stem = ?',
+                                      (directory, stem)).fetchone()
+        return row[0] if row is not None else None
+
+    # Function: record
+    # Description: labels a sample with a category name, replacing any earlier label.
+    def record(self, directory, stem, category):
+        directory = os.path.abspath(directory)
+        if self.committed_state(directory, stem) != 0:
+            self.pending += 1
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?, 0)',
+                                    (directory, stem, category, time.time(), self.session))
+
+    # Function: remove
+    # Description: deletes the label of a sample (an undo). Returns True if it was committed already, so its
+    # files are in the category folder and have to be moved back.
+    def remove(self, directory, stem):
+        directory = os.path.abspath(directory)
+        committed = self.committed_state(directory, stem)
+        if committed == 0:
+            self.pending -= 1
+        with self.connection:
+            self.connection.execute('DELETE FROM labels WHERE directory = ? AND stem = ?', (directory, stem))
+        return bool(committed)
+
+    # Function: labelled_stems
+    # Description: the stems of a directory that have a label, committed or not.
+    def labelled_stems(self, directory):
+        return set(row[0] for row in self.connection.execute('SELECT stem FROM labels WHERE directory = ?',
+                                                             (os.path.abspath(directory),)))
+
+    # Function: pending_rows
+    # Description: the (directory, stem, category) of every label not committed yet, oldest first.
+    def pending_rows(self):
+        return self.connection.execute('SELECT directory, stem, category FROM labels WHERE committed = 0 '
+                                       'ORDER BY labelled').fetchall()
+
+    def mark_committed(self, rows):
+        with self.connection:
+            self.connection.executemany('UPDATE labels SET committed = 1 WHERE directory = ? AND stem = ?',
+                                        [(row[0], row[1]) for row in rows])
+        self.pending -= len(rows)
+
+    # Function: input_directory
+    # Description: the input directory (or archive) of the latest session, for committing from the command line.
+    def input_directory(self):
+        row = self.connection.execute('SELECT input_directory FROM sessions ORDER BY started DESC LIMIT 1').fetchone()
+        return row[0] if row is not None else None
+
+    def close(self):
+        # Fold the write-ahead log back into the database, so the output directory holds a single file again.
+        try:
+            self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error:
+            pass
+        self.connection.close()
+
+
+# Function: commit_sample
+# Description: puts the files of one labelled sample into its category folder. Samples of a mounted archive are
+# extracted. Otherwise each file is renamed, or hard linked with keep_input, falling back to a copy where the
+# category folder is on another file system (or hard links aren't supported). Files already in place are left
+# alone, so a commit interrupted by a crash can simply be run again. Returns True if the sample is in place.
+def commit_sample(row, categories_directory, keep_input=False):
+    directory, stem, category = row
+    destination_directory = os.path.join(categories_directory, category)
+    archive, _ = find_member(os.path.join(directory, stem + '.avi'))
+    # The avi first, like the mover, so a jpg in the category folder means its pair is complete.
+    for extension in reversed(EXTENSIONS):
+        source_name = os.path.join(directory, stem + extension)
+        destination_name = os.path.join(destination_directory, stem + extension)
+        if archive is not None:
+            if not archive.extract(archive.member_name(source_name), destination_name):
+                print(f"{source_name} is not in {archive.archive_path} any more")
+                return False
+            continue
+        if os.path.exists(destination_name):
+            if os.path.exists(source_name) and not os.path.samefile(source_name, destination_name):
+                print(f"Not committing {source_name}: {destination_name} is a different sample.")
+                return False
+            # Left behind by a commit that linked the files without keep_input (see below).
+            if os.path.exists(source_name) and not keep_input:
+                os.unlink(source_name)
+            continue
+        try:
+            if keep_input:
+                os.link(source_name, destination_name)
+            else:
+                os.rename(source_name, destination_name)
+        except FileNotFoundError:
+            print(f"Not committing {source_name}: it is gone.")
+            return False
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            copy_synced(source_name, destination_name + '.part')
+            os.replace(destination_name + '.part', destination_name)
+            if not keep_input:
+                os.unlink(source_name)
+    return True
+
+
+# Function: commit_labels
+# Description: materialises the labels not committed yet into the categories folder made by prepare_hat. The
+# samples are committed in batches of batch_size on a thread pool. After each batch the category folders are
+# synced and only then are its labels marked committed, so after a crash the rest is just committed again.
+# Returns a summary dictionary.
+def commit_labels(store, categories_directory, keep_input=False, workers=8, batch_size=256, progress=True):
+    start = time.perf_counter()
+    rows = store.pending_rows()
+    for category in set(row[2] for row in rows):
+        os.makedirs(os.path.join(categories_directory, category), exist_ok=True)
+    committed = 0
+    failed = 0
+
+    def commit(row):
+        try:
+            return commit_sample(row, categories_directory, keep_input)
+        except OSError as e:
+            print(f"Could not commit {os.path.join(row[0], row[1])} to {row[2]}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for first in range(0, len(rows), batch_size):
+            batch = rows[first:first + batch_size]
+            done = [row for row, ok in zip(batch, pool.map(commit, batch)) if ok]
+            for category in set(row[2] for row in done):
+                fsync_directory(os.path.join(categories_directory, category))
+            store.mark_committed(done)
+            committed += len(done)
+            failed += len(batch) - len(done)
+            if progress:
+                seconds = time.perf_counter() - start
+                print(f"Committed {committed + failed}/{len(rows)} samples "
+                      f"({(committed + failed) / seconds if seconds > 0 else 0:.0f} samples/s)")
+    return {'committed': committed, 'failed': failed, 'seconds': time.perf_counter() - start}
+
+
+# Commit the labels of an output directory from the command line, e.g. after the SortingHat was killed:
+# python SortingHatLabels.py /path/to/output
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move the samples labelled in deferred mode into their categories.')
+    parser.add_argument('output_directory', help='the LabGymSortingHat output directory holding the label store')
+    parser.add_argument('--keep-input', action='store_true', help='hard link the files instead of moving them')
+    parser.add_argument('--workers', type=int, default=8, help='number of threads moving files')
+    parser.add_argument('--status', action='store_true', help='only report how many labels are not committed')
+    args = parser.parse_args()
+
+    # SortingHats sharing the output directory each keep their own store, named after their owner.
+    store_names = sorted(name for name in os.listdir(args.output_directory) if name.startswith(LABELS_FILE_NAME)
+                         and not name.endswith(('-wal', '-shm', '-journal')))
+    if not store_names:
+        parser.error(f"There is no label store in {args.output_directory}")
+    for store_name in store_names:
+        label_store = LabelStore(os.path.join(args.output_directory, store_name))
+        if args.status:
+            print(f"{store_name}: {label_store.pending} labels are not committed yet.")
+            label_store.close()
+            continue
+        # Samples labelled from an archive are extracted from it.
+        input_directory = label_store.input_directory()
+        archive_source = None
+        if input_directory is not None and is_archive(input_directory):
+            archive_source = ArchiveSource(input_directory,
+                                           os.path.join(args.output_directory, ARCHIVE_INDEX_FILE_NAME)).open()
+        summary = commit_labels(label_store, os.path.join(args.output_directory, 'categories'), args.keep_input,
+                                args.workers)
+        if archive_source is not None:
+            archive_source.close()
+        label_store.close()
+        print(f"{store_name}: committed {summary['committed']} samples in {summary['seconds']:.1f}s, "
+              f"{summary['failed']} failed.")
@@ -0,0 +1,160 @@
+import os
+import csv
+import json
+import time
+import bisect
+import cProfile
+import pstats
+import threading
+from contextlib import nullcontext
+
+# Histogram bucket upper bounds in milliseconds; anything slower lands in the last, open-ended bucket.
+BUCKET_BOUNDS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# What stage returns while metrics are off; nullcontext holds no state, so one instance serves every call.
+NO_STAGE = nullcontext()
+
+
+# Class: Histogram
+# Description: durations of one stage: a count per bucket plus count, total, min and max.
+class Histogram():
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, milliseconds):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.minimum = milliseconds if self.minimum is None else min(self.minimum, milliseconds)
+        self.maximum = milliseconds if self.maximum is None else max(self.maximum, milliseconds)
+
+    # Function: percentile
+    # Description: the upper bound of the bucket holding the given percentile (the maximum for the last bucket).
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100
+        seen = 0
+        for i, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= wanted:
+                return min(BUCKET_BOUNDS_MS[i], self.maximum) if i < len(BUCKET_BOUNDS_MS) else self.maximum
+        return self.maximum
+
+    def summary(self):
+        return {'count': self.count, 'mean_ms': self.total / self.count if self.count else None,
+                'min_ms': self.minimum, 'max_ms': self.maximum,
+                'p50_ms': self.percentile(50), 'p90_ms': self.percentile(90), 'p99_ms': self.percentile(99),
+                'buckets': dict(zip([str(bound) for bound in BUCKET_BOUNDS_MS] + ['inf'], self.buckets))}
+
+
+# Class: Stage
+# Description: times a with-block into a histogram of the metrics it came from.
+class Stage():
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+# Class: Metrics
+# Description: in-memory histograms of how long the stages of the hot path take (decode, compose, bitmaps,
+# moves, scanning, painting, ...) and of the latency from a key press to the first paint after it.
+# While disabled, stage() hands out one shared do-nothing context and mark/finish return straight away, so the
+# instrumentation can stay in place. Stages run on worker threads too, so recording takes a lock.
+class Metrics():
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.marks = {}
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.started = time.time()
+
+    def enable(self):
+        self.enabled = True
+
+    # Function: stage
+    # Description: a context manager timing its block as the named stage, e.g. with metrics.stage('decode'): ...
+    def stage(self, name):
+        if not self.enabled:
+            return NO_STAGE
+        return Stage(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds * 1000)
+
+    # Function: mark, finish
+    # Description: measure a latency across events: mark notes when it started (e.g. a key press) and the
+    # first finish afterwards (e.g. the next paint) records the time since then under the given name.
+    def mark(self, name):
+        if self.enabled:
+            self.marks[name] = time.perf_counter()
+
+    def finish(self, name, mark_name):
+        if self.enabled:
+            start = self.marks.pop(mark_name, None)
+            if start is not None:
+                self.record(name, time.perf_counter() - start)
+
+    def summary(self):
+        with self.lock:
+            return dict((name, histogram.summary()) for name, histogram in sorted(self.histograms.items()))
+
+    # Function: dump
+    # Description: writes the histograms to <prefix>.json and a one line per stage <prefix>.csv and returns
+    # the json path.
+    def dump(self, prefix):
+        summary = self.summary()
+        with open(prefix + '.json', 'w') as f:
+            json.dump({'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                       'dumped': time.strftime('%Y-%m-%dT%H:%M:%S'), 'bucket_bounds_ms': BUCKET_BOUNDS_MS,
+                       'stages': summary}, f, indent=1)
+        with open(prefix + '.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage', 'count', 'mean_ms', 'min_ms', 'max_ms', 'p50_ms', 'p90_ms', 'p99_ms'])
+            for name, stage in summary.items():
+                writer.writerow([name] + [stage[key] for key in ('count', 'mean_ms', 'min_ms', 'max_ms',
+                                                                 'p50_ms', 'p90_ms', 'p99_ms')])
+        return prefix + '.json'
+
+    # Function: start_profile, stop_profile
+    # Description: the opt-in cProfile mode. stop_profile writes the raw profile to path (for snakeviz and the
+    # like) and prints the top functions by cumulative time. Only the thread that started it is profiled.
+    def start_profile(self):
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop_profile(self, path, top=25):
+        if self.profiler is None:
+            return None
+        self.profiler.disable()
+        self.profiler.dump_stats(path)
+        pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(top)
+        self.profiler = None
+        return path
+
+
+# The instance the modules of the SortingHat record into. Set SORTINGHAT_METRICS=1 to record from the start
+# and SORTINGHAT_PROFILE=1 to profile the UI thread as well.
+metrics = Metrics(enabled=os.environ.get('SORTINGHAT_METRICS', '') not in ('', '0'))
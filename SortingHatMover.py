@@ -0,0 +1,324 @@
+import os
+import json
+import errno
+import queue
+import shutil
+import threading
+from SortingHatMetrics import metrics
+
+# The move log lives in the output directory. Every pair move is logged before it is queued and marked done
+# once both files arrived (or failed, leaving the pair where it was), so moves interrupted by a crash are finished
+# the next time the mover starts.
+MOVES_FILE_NAME = '.sortinghat_moves.journal'
+EXTENSIONS = (".jpg", ".avi")
+
+
+# Function: fsync_directory
+# Description: makes a rename or unlink in a directory durable. Not every platform can open directories.
+def fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Function: copy_synced
+# Description: copies a file and syncs the copy to disk. copy2 keeps the mtime, which the empty frame index and
+# the proxies are validated against, so a sample copied across file systems doesn't have to be checked again.
+def copy_synced(source_name, destination_name):
+    shutil.copy2(source_name, destination_name)
+    with open(destination_name, 'rb+') as f:
+        os.fsync(f.fileno())
+
+
+# Class: PairMover
+# Description: moves jpg/avi pairs on a background thread, in exactly the order they were submitted, so a sort
+# followed by its undo always ends up where it should. Moves within one filesystem are plain os.rename calls.
+# Moves across filesystems are done in batches: all files are copied to a temporary name and fsynced, renamed
+# into place, and only then are the sources unlinked, so a pair is never lost halfway.
+class PairMover():
+
+    def __init__(self, log_path, batch_size=32):
+        self.log_path = log_path
+        self.batch_size = batch_size
+        self.moves = queue.Queue()
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.queued = 0
+        self.next_id = 0
+        self.devices = {}
+        # The (source directory, destination directory, stem, error) of every move that failed, for the engine
+        # to put its bookkeeping right (see SortingHatEngine.poll_failed_moves).
+        self.failures = queue.Queue()
+        self.log_file = None
+        self.thread = None
+
+    # Function: start
+    # Description: finishes the moves a previous run left behind and starts the worker thread.
+    def start(self):
+        self.recover()
+        self.log_file = open(self.log_path, 'w')
+        self.thread = threading.Thread(target=self.run, name='SortingHatMover', daemon=True)
+        self.thread.start()
+
+    # Function: submit
+    # Description: logs and queues the move of a sample pair and returns immediately.
+    def submit(self, source_directory, destination_directory, stem):
+        with self.condition:
+            move_id = self.next_id
+            self.next_id += 1
+            self.queued += 1
+            for key in ((source_directory, stem), (destination_directory, stem)):
+                self.pending[key] = self.pending.get(key, 0) + 1
+            self.log('b', move_id, source_directory, destination_directory, stem)
+        self.moves.put((move_id, source_directory, destination_directory, stem))
+
+    # Function: depth
+    # Description: the number of moves submitted but not finished yet.
+    def depth(self):
+        return self.queued
+
+    # Function: wait_for
+    # Description: blocks until no queued move involves this (directory, stem) sample any more.
+    def wait_for(self, sample):
+        with self.condition:
+            while sample in self.pending:
+                self.condition.wait()
+
+    # Function: flush
+    # Description: blocks until every submitted move is done.
+    def flush(self):
+        with self.condition:
+            while self.queued:
+                self.condition.wait()
+
+    def close(self):
+        if self.thread is not None:
+            self.flush()
+            self.moves.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def log(self, *entry):
+        if self.log_file is not None:
+            self.log_file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.log_file.flush()
+
+    def run(self):
+        while True:
+            move = self.moves.get()
+            if move is None:
+                return
+            batch = [move]
+            while len(batch) < self.batch_size:
+                try:
+                    move = self.moves.get_nowait()
+                except queue.Empty:
+                    break
+                if move is None:
+                    self.moves.put(None)
+                    break
+                batch.append(move)
+            self.execute_batch(batch)
+
+    # Function: execute_batch
+    # Description: runs a batch of moves in order. Consecutive cross-filesystem moves are grouped so they share
+    # the copy/fsync/unlink phases, unless the same sample comes up twice, which has to wait for its first move.
+    def execute_batch(self, batch):
+        group = []
+        for move in batch:
+            if self.same_filesystem(move[1], move[2]):
+                self.copy_group(group)
+                group = []
+                self.run_moves([move], self.rename_pair)
+            else:
+                if any(move[3] == other[3] for other in group):
+                    self.copy_group(group)
+                    group = []
+                group.append(move)
+        self.copy_group(group)
+
+    def copy_group(self, group):
+        if group:
+            self.run_moves(group, self.copy_pairs)
+
+    # Function: run_moves
+    # Description: runs one move function on a list of moves and marks them done. The pairs it returns as failed
+    # (each with its error) are left whole where they were; they are logged as failed, so recover leaves them
+    # alone, and handed to the engine through failures.
+    def run_moves(self, moves, move_function):
+        with metrics.stage('move_' + move_function.__name__):
+            failures = dict((move[0], e) for move, e in move_function(moves))
+        with self.condition:
+            for move_id, source_directory, destination_directory, stem in moves:
+                if move_id in failures:
+                    print(f"Could not move {os.path.join(source_directory, stem)} to {destination_directory}: "
+                          f"{failures[move_id]}")
+                    self.log('f', move_id)
+                    self.failures.put((source_directory, destination_directory, stem, failures[move_id]))
+                else:
+                    self.log('d', move_id)
+                for key in ((source_directory, stem), (destination_directory, stem)):
+                    self.pending[key] -= 1
+                    if not self.pending[key]:
+                        del self.pending[key]
+                self.queued -= 1
+            self.condition.notify_all()
+
+    def same_filesystem(self, source_directory, destination_directory):
+        devices = []
+        for directory in (source_directory, destination_directory):
+            if directory not in self.devices:
+                try:
+                    self.devices[directory] = os.stat(directory).st_dev
+                except OSError:
+                    self.devices[directory] = None
+            devices.append(self.devices[directory])
+        return devices[0] is not None and devices[0] == devices[1]
+
+    # Function: rename_pair
+    # Description: the same filesystem path, one pair at a time. If the jpg can't follow its avi, the avi is
+    # renamed back, so a failed pair is never split between two folders. Returns the failed moves.
+    def rename_pair(self, moves):
+        failures = []
+        for move in moves:
+            move_id, source_directory, destination_directory, stem = move
+            renamed = []
+            try:
+                # The avi goes first and an existing file is never replaced, so when another SortingHat sharing
+                # the input directory got to the pair first, this fails before the jpg is split from its avi.
+                for extension in reversed(EXTENSIONS):
+                    destination_name = os.path.join(destination_directory, stem + extension)
+                    if os.path.exists(destination_name):
+                        raise FileExistsError(errno.EEXIST, 'The sample is already there', destination_name)
+                    os.rename(os.path.join(source_directory, stem + extension), destination_name)
+                    renamed.append(extension)
+            except OSError as e:
+                for extension in renamed:
+                    try:
+                        os.rename(os.path.join(destination_directory, stem + extension),
+                                  os.path.join(source_directory, stem + extension))
+                    except OSError as rollback_error:
+                        print(f"Could not move {os.path.join(destination_directory, stem + extension)} back: "
+                              f"{rollback_error}")
+                failures.append((move, e))
+        return failures
+
+    # Function: copy_pairs
+    # Description: the cross-filesystem path: copy and fsync every file of the group under a temporary name,
+    # rename them into place, fsync the destination directories and only then unlink the sources. Each pair
+    # succeeds or fails on its own: a pair that can't be copied or renamed into place has its copies removed
+    # and stays whole at the source. Pairs whose avi is already gone (sorted by another SortingHat sharing the
+    # input directory) fail too. Returns the failed moves.
+    def copy_pairs(self, moves):
+        failures = []
+        for move in moves:
+            if not os.path.exists(os.path.join(move[1], move[3] + '.avi')):
+                failures.append((move, FileNotFoundError(errno.ENOENT, 'Gone, probably sorted by someone else',
+                                                         os.path.join(move[1], move[3] + '.avi'))))
+        copied = []
+        for move in moves:
+            if any(move is failed for failed, e in failures):
+                continue
+            move_id, source_directory, destination_directory, stem = move
+            try:
+                for extension in EXTENSIONS:
+                    copy_synced(os.path.join(source_directory, stem + extension),
+                                os.path.join(destination_directory, stem + extension + '.part'))
+                copied.append(move)
+            except OSError as e:
+                self.remove_copies(move)
+                failures.append((move, e))
+        placed = []
+        for move in copied:
+            move_id, source_directory, destination_directory, stem = move
+            replaced = []
+            try:
+                # As in rename_pair, an existing file is never replaced.
+                for extension in EXTENSIONS:
+                    destination_name = os.path.join(destination_directory, stem + extension)
+                    if os.path.exists(destination_name):
+                        raise FileExistsError(errno.EEXIST, 'The sample is already there', destination_name)
+                # The avi first, so a jpg at the destination means its pair is complete.
+                for extension in reversed(EXTENSIONS):
+                    destination_name = os.path.join(destination_directory, stem + extension)
+                    os.replace(destination_name + '.part', destination_name)
+                    replaced.append(destination_name)
+                placed.append(move)
+            except OSError as e:
+                # The sources are untouched; only the copies have to go.
+                for destination_name in replaced:
+                    try:
+                        os.unlink(destination_name)
+                    except OSError:
+                        pass
+                self.remove_copies(move)
+                failures.append((move, e))
+        for destination_directory in set(move[2] for move in placed):
+            fsync_directory(destination_directory)
+        for move_id, source_directory, destination_directory, stem in placed:
+            for extension in EXTENSIONS:
+                try:
+                    os.unlink(os.path.join(source_directory, stem + extension))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    # The pair is complete at the destination, so the move counts; only a stale copy is left.
+                    print(f"Could not remove {os.path.join(source_directory, stem + extension)} after moving it: {e}")
+        return failures
+
+    def remove_copies(self, move):
+        for extension in EXTENSIONS:
+            try:
+                os.unlink(os.path.join(move[2], move[3] + extension + '.part'))
+            except OSError:
+                pass
+
+    # Function: recover
+    # Description: finishes every logged move that wasn't marked done. Each file is handled on its own, so this
+    # is safe whatever point the move had reached: files still at the source are moved, leftover temporary
+    # copies are dropped, and files already at the destination are left alone. A file whose destination is taken
+    # by another file stays at the source, since an existing file is never replaced.
+    def recover(self):
+        try:
+            with open(self.log_path, 'r') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        unfinished = {}
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            if entry[0] == 'b':
+                unfinished[entry[1]] = entry[2:]
+            elif entry[0] in ('d', 'f'):
+                unfinished.pop(entry[1], None)
+        for move_id in sorted(unfinished):
+            source_directory, destination_directory, stem = unfinished[move_id]
+            for extension in EXTENSIONS:
+                source_name = os.path.join(source_directory, stem + extension)
+                destination_name = os.path.join(destination_directory, stem + extension)
+                try:
+                    if os.path.exists(destination_name + '.part'):
+                        os.unlink(destination_name + '.part')
+                    if not os.path.exists(source_name):
+                        continue
+                    if os.path.exists(destination_name):
+                        print(f"Not finishing the move of {source_name}: {destination_name} is already there.")
+                        continue
+                    shutil.move(source_name, destination_name)
+                except OSError as e:
+                    print(f"Could not finish moving {source_name} to {destination_directory}: {e}")
+        if unfinished:
+            print(f"Finished {len(unfinished)} sample moves left over from the last session.")
@@ -0,0 +1,157 @@
+import os
+import json
+import argparse
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from SortingHatArchive import path_stat
+from SortingHatVideo import decode_clip, frame_is_empty
+
+# The index lives next to the LabGym output it describes, so it travels with the input directory.
+INDEX_FILE_NAME = '.sortinghat_empty_index.json'
+INDEX_VERSION = 1
+
+
+# Function: scan_sample
+# Description: decodes one avi and reports 'empty' if any frame is empty, 'valid' otherwise, 'missing' if it
+# can't be opened or holds no frames and 'error' if decoding it failed. Only 'empty' and 'valid' are recorded.
+# A failure is returned rather than raised, since an exception would end the pool.map of the whole prescan.
+# Note that this, like every function the SortingHat hands to a ProcessPoolExecutor (build_proxy, hash_sample,
+# pack_shard), has to stay a plain top-level function so that the pool can pickle it.
+def scan_sample(video_name, black_fraction=None, black_level=8):
+    try:
+        clip = decode_clip(video_name, stop_on_empty=True, black_fraction=black_fraction, black_level=black_level,
+                           keep_frames=False)
+    except Exception as e:
+        print(f"Could not scan {video_name}: {e}")
+        return 'error'
+    if clip is None or clip.frame_count == 0:
+        return 'missing'
+    if clip.empty_frames:
+        return 'empty'
+    return 'valid'
+
+
+# Class: EmptyFrameIndex
+# Description: a sidecar lookup table of empty/valid status per avi, keyed by absolute path and
+# validated against the file size and mtime so that edited or replaced files are scanned again.
+class EmptyFrameIndex():
+
+    def __init__(self, index_path, black_fraction=None, black_level=8):
+        self.index_path = index_path
+        self.black_fraction = black_fraction
+        self.black_level = black_level
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.unsaved = 0
+
+    def criterion(self):
+        return [self.black_fraction, self.black_level]
+
+    # Function: load
+    # Description: reads the index from disk. Entries made with a different empty-frame criterion are
+    # useless, so they are dropped unless adopt_criterion is set, in which case we switch to the file's one.
+    # This lets the GUI follow whatever threshold the prescan was run with.
+    def load(self, adopt_criterion=False):
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != INDEX_VERSION:
+            return
+        if data.get('criterion') != self.criterion():
+            if not adopt_criterion:
+                return
+            self.black_fraction, self.black_level = data['criterion']
+        self.entries = data.get('entries', {})
+
+    # Function: save
+    # Description: writes the index through a temporary file so an interrupted save never corrupts it.
+    def save(self):
+        with self.lock:
+            if not self.unsaved and os.path.exists(self.index_path):
+                return
+            data = {'version': INDEX_VERSION, 'criterion': self.criterion(), 'entries': dict(self.entries)}
+            self.unsaved = 0
+        temp_path = self.index_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print(f"Could not save the empty frame index {self.index_path}: {e}")
+
+    # Function: lookup
+    # Description: returns 'empty', 'valid' or None if the sample is unknown or changed since it was scanned.
+    def lookup(self, video_name):
+        try:
+            stat = path_stat(video_name)
+        except OSError:
+            return None
+        entry = self.entries.get(os.path.abspath(video_name))
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            return None
+        return entry[2]
+
+    def record(self, video_name, status):
+        try:
+            stat = path_stat(video_name)
+        except OSError:
+            return
+        with self.lock:
+            self.entries[os.path.abspath(video_name)] = [stat.st_size, stat.st_mtime_ns, status]
+            self.unsaved += 1
+
+    def frame_is_empty(self, frame):
+        return frame_is_empty(frame, self.black_fraction, self.black_level)
+
+
+# Function: prescan
+# Description: fills the index for every avi under input_directory using a process pool.
+# Samples that are already indexed and unchanged are skipped, so the prescan can be rerun at any time.
+def prescan(input_directory, workers=None, black_fraction=None, black_level=8, chunksize=16):
+    index = EmptyFrameIndex(os.path.join(input_directory, INDEX_FILE_NAME), black_fraction, black_level)
+    index.load()
+    video_names = []
+    for root, dirs, files in os.walk(input_directory):
+        for name in files:
+            if name.endswith('.avi'):
+                video_name = os.path.join(root, name)
+                if index.lookup(video_name) is None:
+                    video_names.append(video_name)
+
+    counts = {'valid': 0, 'empty': 0, 'missing': 0, 'error': 0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        statuses = pool.map(scan_sample, video_names, repeat(black_fraction), repeat(black_level),
+                            chunksize=chunksize)
+        for i, (video_name, status) in enumerate(zip(video_names, statuses), 1):
+            if status in ('valid', 'empty'):
+                index.record(video_name, status)
+            counts[status] += 1
+            if i % 1000 == 0:
+                index.save()
+                print(f"Scanned {i}/{len(video_names)} samples")
+    index.save()
+    elapsed = time.perf_counter() - start
+    print(f"Scanned {len(video_names)} samples in {elapsed:.1f}s: "
+          f"{counts['valid']} valid, {counts['empty']} with empty frames, "
+          f"{counts['missing'] + counts['error']} unreadable. "
+          f"{len(index.entries)} samples indexed in {index.index_path}")
+    return counts
+
+
+# Run the prescan from the command line, e.g. python SortingHatPrescan.py /path/to/labgym/output
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the empty frame index used by LabGymSortingHat.')
+    parser.add_argument('input_directory', help='directory holding the LabGym avi/jpg samples')
+    parser.add_argument('--workers', type=int, default=None, help='number of scanning processes')
+    parser.add_argument('--black-fraction', type=float, default=None,
+                        help='treat a frame as empty when this fraction of its pixels is dark '
+                             '(default: only all-zero frames are empty)')
+    parser.add_argument('--black-level', type=int, default=8,
+                        help='pixel value below which a pixel counts as dark')
+    args = parser.parse_args()
+    prescan(args.input_directory, args.workers, args.black_fraction, args.black_level)
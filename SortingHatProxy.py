@@ -0,0 +1,216 @@
+import os
+import cv2
+import json
+import hashlib
+import argparse
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from SortingHatArchive import path_stat
+from SortingHatPrescan import INDEX_FILE_NAME, EmptyFrameIndex
+from SortingHatVideo import clip_info, decode_clip
+
+# The proxies live in the input directory. They are named after the sample stem and the size and mtime of its
+# avi and jpg rather than its path, so they stay valid when a sample is moved to a category folder (moves keep
+# the mtime) and are simply not found any more once either file is replaced.
+PROXY_DIRECTORY_NAME = '.sortinghat_proxies'
+PROXY_VERSION = 1
+# Proxies are scaled down to fit the video half of the default window (see SortingHatFrame.display_sizes_for).
+# Raw frames at that size are already larger than a compressed avi, so there is no point in going bigger.
+PROXY_MAX_SIZE = (320, 320)
+
+
+# Function: proxy_key
+# Description: the file name (without extension) of the proxy of an avi and its jpg, or None if either
+# doesn't exist.
+def proxy_key(video_name):
+    try:
+        video_stat = path_stat(video_name)
+        image_stat = path_stat(video_name[:-4] + '.jpg')
+    except OSError:
+        return None
+    stem = os.path.splitext(os.path.basename(video_name))[0]
+    return hashlib.sha1(f"{stem}\0{video_stat.st_size}\0{video_stat.st_mtime_ns}\0"
+                        f"{image_stat.st_size}\0{image_stat.st_mtime_ns}".encode()).hexdigest()
+
+
+# Function: fit_size
+# Description: the largest size with the aspect ratio of (width, height) that fits in max_size, never upscaling.
+def fit_size(width, height, max_size):
+    scale = min(1.0, max_size[0] / width, max_size[1] / height)
+    return max(1, int(width * scale + 0.5)), max(1, int(height * scale + 0.5))
+
+
+# Class: ProxyEntry
+# Description: a loaded proxy: the resized image, the memory-mapped (n, height, width, 3) frame stack and the
+# clip details the GUI needs. criterion is the empty frame criterion the clip was checked with.
+class ProxyEntry():
+
+    def __init__(self, image, frames, fps, frame_count, criterion):
+        self.image = image
+        self.frames = frames
+        self.fps = fps
+        self.frame_count = frame_count
+        self.criterion = criterion
+
+
+# Function: build_proxy
+# Description: decodes one sample once, scaled down to fit max_size, and writes its frames as a .npy, its image
+# as a .jpg and the clip details as a .json (written last, so a proxy without one is incomplete and ignored).
+# Clips with an empty frame get no proxy, since they are never shown. Returns the video name and 'valid',
+# 'empty', 'missing' or 'cached'.
+def build_proxy(video_name, proxy_directory, max_size=PROXY_MAX_SIZE, black_fraction=None, black_level=8):
+    key = proxy_key(video_name)
+    image = cv2.imread(video_name[:-4] + '.jpg')
+    info = clip_info(video_name)
+    if key is None or image is None or info is None:
+        return video_name, 'missing'
+    base = os.path.join(proxy_directory, key)
+    if os.path.exists(base + '.json'):
+        return video_name, 'cached'
+    clip = decode_clip(video_name, fit_size(info[2], info[3], max_size), stop_on_empty=True,
+                       black_fraction=black_fraction, black_level=black_level)
+    if clip is None:
+        return video_name, 'missing'
+    if clip.empty_frames:
+        return video_name, 'empty'
+    image = cv2.resize(image, fit_size(image.shape[1], image.shape[0], max_size), interpolation=cv2.INTER_AREA)
+    np.save(base + '.tmp.npy', clip.frames)
+    os.replace(base + '.tmp.npy', base + '.npy')
+    cv2.imwrite(base + '.tmp.jpg', image)
+    os.replace(base + '.tmp.jpg', base + '.jpg')
+    with open(base + '.tmp.json', 'w') as f:
+        json.dump({'version': PROXY_VERSION, 'fps': clip.fps, 'frame_count': clip.frame_count,
+                   'criterion': [black_fraction, black_level]}, f)
+    os.replace(base + '.tmp.json', base + '.json')
+    return video_name, 'valid'
+
+
+# Class: ProxyCache
+# Description: looks up the proxies of samples. Using a proxy touches its .json, which is what evict goes by
+# to throw out the least recently used proxies once the directory grows past its disk budget.
+class ProxyCache():
+
+    def __init__(self, proxy_directory, budget_bytes=None):
+        self.proxy_directory = proxy_directory
+        self.budget_bytes = budget_bytes
+
+    # Function: load
+    # Description: returns the ProxyEntry of an avi, or None if there is no complete, current proxy of it.
+    def load(self, video_name):
+        key = proxy_key(video_name)
+        if key is None:
+            return None
+        base = os.path.join(self.proxy_directory, key)
+        try:
+            with open(base + '.json', 'r') as f:
+                data = json.load(f)
+            if data.get('version') != PROXY_VERSION:
+                return None
+            frames = np.load(base + '.npy', mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        image = cv2.imread(base + '.jpg')
+        if image is None:
+            return None
+        try:
+            os.utime(base + '.json')
+        except OSError:
+            pass
+        return ProxyEntry(image, frames, data['fps'], data['frame_count'], data['criterion'])
+
+    # Function: evict
+    # Description: deletes the least recently used proxies until the directory fits in the disk budget.
+    # Returns the number of bytes freed.
+    def evict(self, budget_bytes=None):
+        budget_bytes = budget_bytes if budget_bytes is not None else self.budget_bytes
+        if budget_bytes is None:
+            return 0
+        proxies = {}
+        try:
+            entries = list(os.scandir(self.proxy_directory))
+        except OSError:
+            return 0
+        for entry in entries:
+            key, extension = os.path.splitext(entry.name)
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            proxy = proxies.setdefault(key, [0, 0, []])
+            proxy[0] += stat.st_size
+            proxy[2].append(entry.path)
+            if extension == '.json':
+                proxy[1] = stat.st_mtime
+        total = sum(proxy[0] for proxy in proxies.values())
+        freed = 0
+        for key, (size, last_used, paths) in sorted(proxies.items(), key=lambda item: item[1][1]):
+            if total - freed <= budget_bytes:
+                break
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            freed += size
+        return freed
+
+
+# Function: build_proxies
+# Description: builds the missing proxies of every avi under input_directory on a process pool and records the
+# empty frame results in the empty frame index on the way, like the prescan. Reruns only build what's missing.
+def build_proxies(input_directory, workers=None, max_size=PROXY_MAX_SIZE, budget_bytes=None, black_fraction=None,
+                  black_level=8, chunksize=8):
+    proxy_directory = os.path.join(input_directory, PROXY_DIRECTORY_NAME)
+    os.makedirs(proxy_directory, exist_ok=True)
+    index = EmptyFrameIndex(os.path.join(input_directory, INDEX_FILE_NAME), black_fraction, black_level)
+    index.load()
+    video_names = []
+    for root, dirs, files in os.walk(input_directory):
+        dirs[:] = [name for name in dirs if name != PROXY_DIRECTORY_NAME]
+        for name in files:
+            # Samples already known to have empty frames never get a proxy, so they aren't decoded again.
+            if name.endswith('.avi') and index.lookup(os.path.join(root, name)) != 'empty':
+                video_names.append(os.path.join(root, name))
+
+    counts = {'valid': 0, 'empty': 0, 'missing': 0, 'cached': 0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(build_proxy, video_names, repeat(proxy_directory), repeat(max_size),
+                           repeat(black_fraction), repeat(black_level), chunksize=chunksize)
+        for i, (video_name, status) in enumerate(results, 1):
+            counts[status] += 1
+            if status in ('valid', 'empty'):
+                index.record(video_name, status)
+            if i % 1000 == 0:
+                index.save()
+                print(f"Built {i}/{len(video_names)} proxies")
+    index.save()
+    freed = ProxyCache(proxy_directory, budget_bytes).evict()
+    elapsed = time.perf_counter() - start
+    print(f"Built {counts['valid']} proxies in {elapsed:.1f}s ({counts['cached']} already built, "
+          f"{counts['empty']} samples with empty frames, {counts['missing']} incomplete samples). "
+          f"Evicted {freed / 2 ** 20:.0f} MB to stay within the disk budget.")
+    return counts
+
+
+# Build the proxies from the command line, e.g. python SortingHatProxy.py /path/to/labgym/output --budget-mb 4096
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transcode LabGym samples into proxies LabGymSortingHat can '
+                                                 'show without decoding the avi files.')
+    parser.add_argument('input_directory', help='directory holding the LabGym avi/jpg samples')
+    parser.add_argument('--workers', type=int, default=None, help='number of transcoding processes')
+    parser.add_argument('--max-width', type=int, default=PROXY_MAX_SIZE[0],
+                        help='largest proxy frame width; raise it for sorting in a large window')
+    parser.add_argument('--max-height', type=int, default=PROXY_MAX_SIZE[1], help='largest proxy frame height')
+    parser.add_argument('--budget-mb', type=float, default=None,
+                        help='disk budget; the least recently used proxies are evicted beyond it')
+    parser.add_argument('--black-fraction', type=float, default=None,
+                        help='empty frame threshold, as for SortingHatPrescan.py')
+    parser.add_argument('--black-level', type=int, default=8,
+                        help='pixel value below which a pixel counts as dark')
+    args = parser.parse_args()
+    budget_bytes = int(args.budget_mb * 2 ** 20) if args.budget_mb is not None else None
+    build_proxies(args.input_directory, args.workers, (args.max_width, args.max_height), budget_bytes,
+                  args.black_fraction, args.black_level)
@@ -0,0 +1,222 @@
+from array import array
+
+
+# Class: SampleRegistry
+# Description: the samples to sort, in natural sort order, stored as flat arrays instead of a list of tuples.
+# Every sample gets a permanent id (its place in the natural order). Directories are interned and referred to
+# by number. Sorting a sample only marks it as removed (a tombstone), and a Fenwick tree over the alive flags
+# turns positions (what the GUI calls current_index) into ids and back in O(log n). That makes removing a sample
+# and restoring it on undo O(log n) instead of the list.remove/list.insert shifts.
+# Indexing by position returns the same (directory, stem) tuples the old list held.
+class SampleRegistry():
+
+    def __init__(self, samples=()):
+        self.directories = []
+        self.directory_ids = {}
+        self.sample_directories = array('I')
+        self.stems = []
+        self.alive = bytearray()
+        self.tree = array('i', [0])
+        self.count = 0
+        # (directory id, stem) -> sample id, only built once find is first used.
+        self.lookup = None
+        self.extend(samples)
+
+    def intern_directory(self, directory):
+        directory_id = self.directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = self.directory_ids[directory] = len(self.directories)
+            self.directories.append(directory)
+        return directory_id
+
+    # Function: extend
+    # Description: appends samples (already in order) and rebuilds the Fenwick tree in linear time.
+    def extend(self, samples):
+        for root, stem in samples:
+            self.sample_directories.append(self.intern_directory(root))
+            self.stems.append(stem)
+            self.alive.append(1)
+        self.rebuild()
+        self.lookup = None
+
+    # Function: append
+    # Description: appends a single sample in O(log n), e.g. one that appeared while sorting.
+    def append(self, sample):
+        self.sample_directories.append(self.intern_directory(sample[0]))
+        self.stems.append(sample[1])
+        self.alive.append(1)
+        i = len(self.stems)
+        self.tree.append(self.prefix(i - 1) + 1 - self.prefix(i - (i & -i)))
+        self.count += 1
+        if self.lookup is not None:
+            self.lookup[(self.sample_directories[i - 1], sample[1])] = i - 1
+        return i - 1
+
+    def rebuild(self):
+        size = len(self.alive)
+        self.tree = array('i', [0])
+        self.tree.extend(iter(self.alive))
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                self.tree[parent] += self.tree[i]
+        self.count = sum(self.alive)
+
+    # Function: prefix
+    # Description: the number of alive samples among the first i ids.
+    def prefix(self, i):
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def update(self, sample_id, delta):
+        i = sample_id + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    # Function: sample_id
+    # Description: the id of the sample at a position, found by walking down the Fenwick tree.
+    def sample_id(self, position):
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError('sample position out of range')
+        i = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        remaining = position + 1
+        while step:
+            if i + step < len(self.tree) and self.tree[i + step] < remaining:
+                i += step
+                remaining -= self.tree[i]
+            step >>= 1
+        return i
+
+    # Function: position_of
+    # Description: the current position of an alive sample, or of where a removed one would be restored.
+    def position_of(self, sample_id):
+        return self.prefix(sample_id)
+
+    # Function: find
+    # Description: the id of a (directory, stem) sample, alive or not, or None if the registry never had it.
+    def find(self, sample):
+        if self.lookup is None:
+            self.lookup = dict(((directory, stem), sample_id) for sample_id, (directory, stem)
+                               in enumerate(zip(self.sample_directories, self.stems)))
+        directory_id = self.directory_ids.get(sample[0])
+        if directory_id is None:
+            return None
+        return self.lookup.get((directory_id, sample[1]))
+
+    def sample(self, sample_id):
+        return self.directories[self.sample_directories[sample_id]], self.stems[sample_id]
+
+    def remove_id(self, sample_id):
+        if self.alive[sample_id]:
+            self.alive[sample_id] = 0
+            self.update(sample_id, -1)
+            self.count -= 1
+
+    # Function: remove_at
+    # Description: removes the sample at a position and returns its id, so it can be restored later.
+    def remove_at(self, position):
+        sample_id = self.sample_id(position)
+        self.remove_id(sample_id)
+        return sample_id
+
+    # Function: restore
+    # Description: puts a removed sample back in its natural place and returns its position.
+    def restore(self, sample_id):
+        if not self.alive[sample_id]:
+            self.alive[sample_id] = 1
+            self.update(sample_id, 1)
+            self.count += 1
+        return self.position_of(sample_id)
+
+    def pop(self, position):
+        return self.sample(self.remove_at(position))
+
+    def removed_ids(self):
+        return [i for i in range(len(self.alive)) if not self.alive[i]]
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __getitem__(self, position):
+        return self.sample(self.sample_id(position))
+
+    def __delitem__(self, position):
+        self.remove_at(position)
+
+    def __iter__(self):
+        for i in range(len(self.alive)):
+            if self.alive[i]:
+                yield self.sample(i)
+
+
+# Class: UndoStack
+# Description: a compact stack of sort actions: the sample id, the interned id of the category directory it was
+# moved to, the position it was sorted from and a group number. Used for both undo and redo.
+# Samples sorted together (e.g. from the grid) share a non-zero group number and are undone as one action;
+# group 0 means a sample sorted on its own.
+class UndoStack():
+
+    def __init__(self):
+        self.sample_ids = array('i')
+        self.categories = array('i')
+        self.positions = array('i')
+        self.groups = array('i')
+        # Group numbers only go up, so a group never takes the number of one still below it (see discard).
+        self.next_group = 1
+
+    def push(self, sample_id, category, position, group=0):
+        self.sample_ids.append(sample_id)
+        self.categories.append(category)
+        self.positions.append(position)
+        self.groups.append(group)
+        self.next_group = max(self.next_group, group + 1)
+
+    def pop(self):
+        return self.sample_ids.pop(), self.categories.pop(), self.positions.pop(), self.groups.pop()
+
+    # Function: group_size
+    # Description: the number of entries on top of the stack that belong to the same action.
+    def group_size(self):
+        if not self.groups:
+            return 0
+        group = self.groups[-1]
+        if group == 0:
+            return 1
+        size = 1
+        while size < len(self.groups) and self.groups[-size - 1] == group:
+            size += 1
+        return size
+
+    # Function: new_group
+    # Description: a group number no entry on the stack has, for the next group of sorts.
+    def new_group(self):
+        return self.next_group
+
+    # Function: discard
+    # Description: removes the latest entry of a sample wherever it is in the stack and returns it, or None.
+    def discard(self, sample_id):
+        for i in range(len(self.sample_ids) - 1, -1, -1):
+            if self.sample_ids[i] == sample_id:
+                entry = self.sample_ids[i], self.categories[i], self.positions[i], self.groups[i]
+                del self.sample_ids[i], self.categories[i], self.positions[i], self.groups[i]
+                return entry
+        return None
+
+    def clear(self):
+        del self.sample_ids[:], self.categories[:], self.positions[:], self.groups[:]
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    def __iter__(self):
+        return zip(self.sample_ids, self.categories, self.positions, self.groups)
@@ -0,0 +1,157 @@
+import os
+import queue
+import threading
+import time
+from SortingHatMetrics import metrics
+
+
+# Function: list_directory
+# Description: one os.scandir pass over a directory. Returns the natsorted stems of its avi files and the
+# natsorted paths of its subdirectories. With settle_seconds, only pairs whose jpg exists and whose avi hasn't
+# been written to for that long are returned, and the third value tells whether any pair wasn't ready yet.
+def list_directory(directory, settle_seconds=None):
+    from natsort import natsorted
+    stems = []
+    jpgs = set()
+    subdirectories = []
+    unsettled = False
+    now = time.time()
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.avi'):
+                    if settle_seconds is not None:
+                        try:
+                            if now - entry.stat().st_mtime < settle_seconds:
+                                unsettled = True
+                                continue
+                        except OSError:
+                            continue
+                    stems.append(entry.name[:-4])
+                elif entry.name.endswith('.jpg'):
+                    jpgs.add(entry.name[:-4])
+                elif entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+    except OSError:
+        return [], [], False
+    if settle_seconds is not None:
+        unsettled = unsettled or any(stem not in jpgs for stem in stems)
+        stems = [stem for stem in stems if stem in jpgs]
+    return natsorted(stems), natsorted(subdirectories), unsettled
+
+
+# Function: iter_sample_batches
+# Description: walks the input directory and yields, per directory, the list of its (root, stem) samples in
+# natural order. The directories come in the natural order of their full paths, as the natsorted list of all
+# samples used to have them: a directory's own samples and those below it aren't always next to each other
+# (in/a comes before in/a-b, which comes before in/a/b), so each directory stands for two entries, its
+# samples (keyed by its path) and its subdirectories (keyed by its path and a separator), and the entries of
+# the subdirectories of a directory are sorted by those keys. Directories in exclude (e.g. the categories
+# folder when the output is inside the input) are skipped.
+def iter_sample_batches(input_directory, exclude=()):
+    from natsort import natsort_keygen
+    natural_key = natsort_keygen()
+    exclude = set(os.path.abspath(directory) for directory in exclude)
+    if os.path.abspath(input_directory) in exclude:
+        return
+    subdirectories = {}
+    stack = [(input_directory, True), (input_directory, False)]
+    while stack:
+        directory, below = stack.pop()
+        if below:
+            entries = [entry for subdirectory in subdirectories.pop(directory)
+                       if os.path.abspath(subdirectory) not in exclude
+                       for entry in ((subdirectory, False), (subdirectory, True))]
+            entries.sort(key=lambda entry: natural_key(entry[0] + os.sep if entry[1] else entry[0]))
+            stack.extend(reversed(entries))
+            continue
+        with metrics.stage('scan_directory'):
+            stems, subdirectories[directory], _ = list_directory(directory)
+        if stems:
+            yield [(directory, stem) for stem in stems]
+
+
+def iter_samples(input_directory, exclude=()):
+    for batch in iter_sample_batches(input_directory, exclude):
+        yield from batch
+
+
+# Class: StreamingScanner
+# Description: runs iter_sample_batches on a background thread and hands the batches over through a queue,
+# so sorting can start as soon as the first directory with samples was listed. With watch set, it keeps
+# polling afterwards: directories whose mtime changed (or that had pairs still being written) are listed again
+# and their complete avi/jpg pairs are queued. The consumer is expected to skip samples it already has.
+class StreamingScanner():
+
+    def __init__(self, input_directory, exclude=(), watch=False, watch_interval=5, settle_seconds=2):
+        self.input_directory = input_directory
+        self.exclude = set(os.path.abspath(directory) for directory in exclude)
+        self.watch = watch
+        self.watch_interval = watch_interval
+        self.settle_seconds = settle_seconds
+        self.batches = queue.Queue()
+        self.finished = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='SortingHatScanner', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        for batch in iter_sample_batches(self.input_directory, self.exclude):
+            if self.stopped.is_set():
+                return
+            self.batches.put(batch)
+        self.finished.set()
+        if self.watch:
+            self.run_watch()
+
+    # Function: run_watch
+    # Description: polls the directory tree for new sample pairs until stopped. Only directory mtimes are
+    # checked on each poll; a directory is listed again only when it changed. The first poll lists everything
+    # once more, to catch pairs written while the initial scan was running.
+    def run_watch(self):
+        mtimes = {}
+        subdirectories = {}
+        pending = set()
+        while not self.stopped.wait(self.watch_interval):
+            stack = [self.input_directory]
+            while stack and not self.stopped.is_set():
+                directory = stack.pop()
+                if os.path.abspath(directory) in self.exclude:
+                    continue
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                if mtimes.get(directory) != mtime or directory in pending:
+                    mtimes[directory] = mtime
+                    stems, subdirectories[directory], unsettled = list_directory(directory, self.settle_seconds)
+                    if stems:
+                        self.batches.put([(directory, stem) for stem in stems])
+                    if unsettled:
+                        pending.add(directory)
+                    else:
+                        pending.discard(directory)
+                stack.extend(subdirectories.get(directory, []))
+
+    # Function: get_batches
+    # Description: returns every batch queued so far without waiting. With wait set, it first blocks until at
+    # least one batch arrived or the initial scan finished, which is what is needed to show the first sample.
+    def get_batches(self, wait=False):
+        batches = []
+        if wait:
+            while not batches and not (self.finished.is_set() and self.batches.empty()):
+                try:
+                    batches.append(self.batches.get(timeout=0.1))
+                except queue.Empty:
+                    pass
+        while True:
+            try:
+                batches.append(self.batches.get_nowait())
+            except queue.Empty:
+                return batches
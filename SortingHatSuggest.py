@@ -0,0 +1,392 @@
+import os
+import cv2
+import argparse
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from SortingHatArchive import path_exists, read_image
+from SortingHatDuplicates import read_keyframes
+
+# The feature index of the sorted examples lives in the output directory, next to the categories it describes.
+FEATURE_FILE_NAME = '.sortinghat_features.npz'
+FEATURE_VERSION = 2
+# Every sample is described by three FEATURE_SIZE x FEATURE_SIZE blocks: its jpg, the mean of its avi keyframes
+# and the mean absolute difference between consecutive keyframes (how and where it moves).
+FEATURE_SIZE = 8
+FEATURE_LENGTH = 3 * FEATURE_SIZE ** 2
+
+
+# Function: example_key
+# Description: the key of a sorted example: its path relative to the categories folder, without the extension.
+# Stems repeat across LabGym's video folders, but not within one category folder.
+def example_key(category_name, stem):
+    return f"{category_name}/{stem}"
+
+
+# Function: feature_block
+# Description: shrinks a grayscale image to FEATURE_SIZE x FEATURE_SIZE and normalises it to zero mean and unit
+# length, so brightness and contrast don't matter. Returns a flat float32 vector.
+def feature_block(image):
+    block = cv2.resize(image.astype(np.float32), (FEATURE_SIZE, FEATURE_SIZE), interpolation=cv2.INTER_AREA)
+    block = block.ravel() - block.mean()
+    norm = np.linalg.norm(block)
+    return block / norm if norm > 0 else block
+
+
+# Function: sample_features
+# Description: the unit length feature vector of a sample, or None if its jpg or avi can't be read.
+# Tries the avi names in turn, since a sample may be moved between being picked and being read.
+def sample_features(*video_names):
+    for video_name in video_names:
+        if not path_exists(video_name):
+            continue
+        image = read_image(video_name[:-4] + '.jpg', cv2.IMREAD_GRAYSCALE)
+        keyframes = read_keyframes(video_name)
+        if image is None or keyframes is None:
+            continue
+        frames = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in keyframes]).astype(np.float32)
+        features = np.concatenate([feature_block(image), feature_block(frames.mean(axis=0)),
+                                   feature_block(np.abs(np.diff(frames, axis=0)).mean(axis=0))])
+        norm = np.linalg.norm(features)
+        return features / norm if norm > 0 else features
+    return None
+
+
+# Class: FeatureIndex
+# Description: the feature vectors of the sorted examples as rows of one float32 matrix, with the category of
+# each row. Rows are found by example_key. The matrix grows by doubling and a row is removed by moving the last
+# row into its place, so adding and removing one example never copies the matrix. Categories are stored by name,
+# so the index stays valid when the key mapping changes between sessions.
+class FeatureIndex():
+
+    def __init__(self, capacity=1024):
+        self.matrix = np.zeros((capacity, FEATURE_LENGTH), dtype=np.float32)
+        self.labels = np.zeros(capacity, dtype=np.int32)
+        self.keys = []
+        self.rows = {}
+        self.category_names = []
+
+    def category_id(self, category_name):
+        if category_name not in self.category_names:
+            self.category_names.append(category_name)
+        return self.category_names.index(category_name)
+
+    def category_of(self, key):
+        row = self.rows.get(key)
+        return self.category_names[self.labels[row]] if row is not None else None
+
+    def add(self, key, features, category_name):
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.keys)
+            if row == len(self.matrix):
+                self.matrix = np.concatenate([self.matrix, np.zeros_like(self.matrix)])
+                self.labels = np.concatenate([self.labels, np.zeros_like(self.labels)])
+            self.keys.append(key)
+            self.rows[key] = row
+        self.matrix[row] = features
+        self.labels[row] = self.category_id(category_name)
+
+    def remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is None:
+            return False
+        last = len(self.keys) - 1
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.labels[row] = self.labels[last]
+            self.keys[row] = self.keys[last]
+            self.rows[self.keys[row]] = row
+        self.keys.pop()
+        return True
+
+    # Function: suggest_many
+    # Description: a k nearest neighbour vote (by cosine similarity) for every row of queries. Returns the
+    # suggested category ids and their confidence, the share of the similarity weighted vote they got.
+    # The queries are taken in chunks so the similarity matrix stays around chunk_bytes.
+    def suggest_many(self, queries, k=9, chunk_bytes=2 ** 27):
+        count = len(self.keys)
+        categories = np.zeros(len(queries), dtype=np.int32)
+        confidences = np.zeros(len(queries), dtype=np.float32)
+        if not count or not len(queries):
+            return categories, confidences
+        k = min(k, count)
+        matrix = self.matrix[:count]
+        chunk = max(1, chunk_bytes // (4 * count))
+        for start in range(0, len(queries), chunk):
+            similarities = queries[start:start + chunk] @ matrix.T
+            nearest = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            weights = np.maximum(np.take_along_axis(similarities, nearest, axis=1), 0) + 1e-6
+            votes = np.zeros((len(similarities), len(self.category_names)), dtype=np.float32)
+            np.add.at(votes, (np.arange(len(similarities))[:, np.newaxis], self.labels[nearest]), weights)
+            best = votes.argmax(axis=1)
+            categories[start:start + chunk] = best
+            confidences[start:start + chunk] = votes[np.arange(len(votes)), best] / votes.sum(axis=1)
+        return categories, confidences
+
+    # Function: suggest
+    # Description: the suggested category name and confidence for one feature vector, or None if the index is empty.
+    def suggest(self, features, k=9):
+        if not self.keys:
+            return None
+        categories, confidences = self.suggest_many(features[np.newaxis], k)
+        return self.category_names[categories[0]], float(confidences[0])
+
+    def save(self, path):
+        count = len(self.keys)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, version=FEATURE_VERSION, matrix=self.matrix[:count], labels=self.labels[:count],
+                     keys=np.array(self.keys, dtype=str), category_names=np.array(self.category_names, dtype=str))
+        os.replace(path + '.tmp', path)
+
+    # Function: load
+    # Description: reads an index saved by save. Returns False (leaving the index empty) if there is none.
+    def load(self, path):
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != FEATURE_VERSION or data['matrix'].shape[1:] != (FEATURE_LENGTH,):
+                    return False
+                matrix, labels = data['matrix'], data['labels']
+                keys, category_names = data['keys'].tolist(), data['category_names'].tolist()
+        except (OSError, ValueError, KeyError):
+            return False
+        self.__init__(max(1024, 2 * len(keys)))
+        self.matrix[:len(keys)] = matrix
+        self.labels[:len(keys)] = labels
+        self.keys = keys
+        self.rows = dict((key, row) for row, key in enumerate(keys))
+        self.category_names = category_names
+        return True
+
+    def __len__(self):
+        return len(self.keys)
+
+
+# Function: category_samples
+# Description: the avi files in the category folders as {example key: (category name, avi path)}.
+def category_samples(category_directories):
+    found = {}
+    for category_directory in category_directories:
+        category_name = os.path.basename(os.path.normpath(category_directory))
+        try:
+            entries = list(os.scandir(category_directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.endswith('.avi'):
+                found[example_key(category_name, entry.name[:-4])] = (category_name, entry.path)
+    return found
+
+
+# Class: LabelSuggester
+# Description: suggests a category for the samples still to sort from the examples already sorted.
+# The feature index is brought in line with the category folders on a background thread when it starts, and
+# then kept up to date as samples are sorted and unsorted. Features are computed on a small thread pool and
+# remembered per (directory, stem) sample, so a sample that was shown (and suggested for) is added to the index
+# without reading it again once it is sorted. Only the max_features most recently used samples still to sort
+# are remembered; a sorted sample's features move into the index (and back on undo). version goes up with
+# every change to the index, so callers can cache suggestions.
+class LabelSuggester():
+
+    def __init__(self, index_path, workers=2, k=9, max_features=10000):
+        self.index_path = index_path
+        self.workers = workers
+        self.k = k
+        self.max_features = max_features
+        self.index = FeatureIndex()
+        self.features = OrderedDict()
+        self.pending = {}
+        self.version = 0
+        self.dirty = False
+        self.ready = False
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    # Function: start
+    # Description: loads the saved index and reconciles it with the category folders in the background.
+    # labels are the (directory, stem, category name) of samples that are labelled but not committed yet
+    # (LabelStore.pending_rows), which count as sorted examples although they aren't in their folders yet.
+    def start(self, category_directories, labels=()):
+        threading.Thread(target=self.reconcile, args=(list(category_directories), list(labels)),
+                         name='SortingHatSuggest', daemon=True).start()
+
+    def reconcile(self, category_directories, labels=()):
+        start = time.perf_counter()
+        index = FeatureIndex()
+        index.load(self.index_path)
+        with self.lock:
+            # Anything sorted or unsorted before the saved index was loaded is already in self.index.
+            for key in self.index.keys:
+                index.add(key, self.index.matrix[self.index.rows[key]], self.index.category_of(key))
+            self.index = index
+        examples = category_samples(category_directories)
+        for directory, stem, category_name in labels:
+            examples[example_key(category_name, stem)] = (category_name, os.path.join(directory, stem + '.avi'))
+        with self.lock:
+            for key in [key for key in self.index.keys if key not in examples]:
+                self.index.remove(key)
+            missing = [(key, category_name, video_name) for key, (category_name, video_name) in examples.items()
+                       if self.index.category_of(key) != category_name]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = pool.map(sample_features, [video_name for _, _, video_name in missing])
+            for (key, category_name, video_name), features in zip(missing, results):
+                # Skip examples that were unsorted again while their features were computed.
+                if features is not None and path_exists(video_name):
+                    with self.lock:
+                        self.index.add(key, features, category_name)
+        with self.lock:
+            self.version += 1
+            self.dirty = True
+            self.ready = True
+        self.save()
+        print(f"Indexed {len(self.index)} sorted examples for suggestions ({len(missing)} new) in "
+              f"{time.perf_counter() - start:.1f}s")
+
+    # Function: request
+    # Description: starts computing the features of a (directory, stem) sample unless they are known or on the way.
+    def request(self, sample):
+        sample = tuple(sample)
+        with self.lock:
+            if sample in self.features or sample in self.pending:
+                return
+            self.pending[sample] = self.executor.submit(self.compute, sample,
+                                                        os.path.join(sample[0], sample[1] + '.avi'))
+
+    def compute(self, sample, *video_names):
+        features = sample_features(*video_names)
+        with self.lock:
+            self.pending.pop(sample, None)
+            if features is not None:
+                self.remember(sample, features)
+        return features
+
+    # Function: remember
+    # Description: keeps the features of a sample still to sort, forgetting the least recently used ones beyond
+    # max_features. Called with the lock held.
+    def remember(self, sample, features):
+        self.features[sample] = features
+        self.features.move_to_end(sample)
+        while len(self.features) > self.max_features:
+            self.features.popitem(last=False)
+
+    # Function: suggest
+    # Description: (category name, confidence) for a sample, or None until its features are computed or if
+    # nothing is sorted yet.
+    def suggest(self, sample):
+        sample = tuple(sample)
+        with self.lock:
+            features = self.features.get(sample)
+            if features is not None:
+                self.features.move_to_end(sample)
+                return self.index.suggest(features, self.k)
+        self.request(sample)
+        return None
+
+    # Function: sorted
+    # Description: adds a sample that was just sorted into category_directory to the index.
+    def sorted(self, sample, category_directory):
+        sample = tuple(sample)
+        category_name = os.path.basename(os.path.normpath(category_directory))
+        with self.lock:
+            features = self.features.pop(sample, None)
+            if features is not None:
+                self.index.add(example_key(category_name, sample[1]), features, category_name)
+                self.version += 1
+                self.dirty = True
+                return
+        # The mover may already have moved it, so look in the category folder too.
+        self.executor.submit(self.compute_and_add, sample, category_name,
+                             os.path.join(sample[0], sample[1] + '.avi'),
+                             os.path.join(category_directory, sample[1] + '.avi'))
+
+    def compute_and_add(self, sample, category_name, *video_names):
+        features = sample_features(*video_names)
+        if features is not None:
+            with self.lock:
+                self.index.add(example_key(category_name, sample[1]), features, category_name)
+                self.version += 1
+                self.dirty = True
+
+    # Function: unsorted
+    # Description: takes a sample that was just moved out of category_directory (undo) out of the index. Its
+    # features are remembered again, since it is back among the samples to sort.
+    def unsorted(self, sample, category_directory):
+        key = example_key(os.path.basename(os.path.normpath(category_directory)), sample[1])
+        with self.lock:
+            if key in self.index.rows:
+                self.remember(tuple(sample), self.index.matrix[self.index.rows[key]].copy())
+            if self.index.remove(key):
+                self.version += 1
+                self.dirty = True
+
+    # Function: suggest_all
+    # Description: computes the features of every sample in a list on the pool and suggests a category for each.
+    # Returns (category names, confidences) in the order of the samples; samples that can't be read get None.
+    # The features computed here aren't remembered, there can be far more of them than max_features.
+    def suggest_all(self, samples):
+        samples = [tuple(sample) for sample in samples]
+        with self.lock:
+            features = [self.features.get(sample) for sample in samples]
+        missing = [i for i, vector in enumerate(features) if vector is None]
+        computed = self.executor.map(lambda i: sample_features(os.path.join(samples[i][0], samples[i][1] + '.avi')),
+                                     missing)
+        for i, vector in zip(missing, computed):
+            features[i] = vector
+        rows = [i for i, vector in enumerate(features) if vector is not None]
+        queries = np.array([features[i] for i in rows], dtype=np.float32)
+        with self.lock:
+            categories, confidences = self.index.suggest_many(queries.reshape(-1, FEATURE_LENGTH), self.k)
+            names = [self.index.category_names[category] for category in categories] if len(self.index) else []
+        suggested = [None] * len(samples)
+        confidence = [0.0] * len(samples)
+        for i, name, value in zip(rows, names, confidences):
+            suggested[i] = name
+            confidence[i] = float(value)
+        return suggested, confidence
+
+    # Function: save
+    # Description: writes the index to the output directory if it changed since the last save.
+    def save(self):
+        with self.lock:
+            if not self.dirty or not self.ready:
+                return
+            self.dirty = False
+            try:
+                self.index.save(self.index_path)
+            except OSError as e:
+                print(f"Could not save the feature index {self.index_path}: {e}")
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.save()
+
+
+# Evaluate the suggestions from the command line, e.g. python SortingHatSuggest.py /path/to/output/categories
+# Every sorted example is suggested a category from all the others (leave one out).
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check how well the sorted examples predict each other.')
+    parser.add_argument('categories_directory', help='the categories folder of a LabGymSortingHat output directory')
+    parser.add_argument('-k', type=int, default=9, help='number of neighbours that vote')
+    parser.add_argument('--workers', type=int, default=4, help='number of threads computing features')
+    args = parser.parse_args()
+
+    directories = [entry.path for entry in os.scandir(args.categories_directory) if entry.is_dir()]
+    examples = sorted(category_samples(directories).items())
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        example_features = list(executor.map(sample_features, [video_name for _, (_, video_name) in examples]))
+    full_index = FeatureIndex()
+    for (key, (example_category, _)), vector in zip(examples, example_features):
+        if vector is not None:
+            full_index.add(key, vector, example_category)
+    correct = 0
+    for key in list(full_index.keys):
+        row = full_index.rows[key]
+        vector, example_category = full_index.matrix[row].copy(), full_index.category_of(key)
+        full_index.remove(key)
+        suggestion = full_index.suggest(vector, args.k)
+        correct += suggestion is not None and suggestion[0] == example_category
+        full_index.add(key, vector, example_category)
+    print(f"{correct} of {len(full_index)} sorted examples ({correct / max(1, len(full_index)):.0%}) are suggested "
+          f"their own category by their {args.k} nearest neighbours.")
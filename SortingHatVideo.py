@@ -0,0 +1,317 @@
+import cv2
+import time
+import numpy as np
+from functools import lru_cache
+from SortingHatArchive import open_capture
+
+
+# Function: frame_is_empty
+# Description: the empty-frame test shared by the GUI and the prescan.
+# With no black_fraction a frame is only empty if every pixel is zero (the original behavior).
+# Otherwise the frame is downsampled and counts as empty when at least black_fraction of its
+# pixels are darker than black_level in every channel.
+def frame_is_empty(frame, black_fraction=None, black_level=8, downsample=8):
+    if black_fraction is None:
+        return not frame.any()
+    small = frame[::downsample, ::downsample]
+    if small.ndim == 3:
+        small = small.max(axis=2)
+    return np.count_nonzero(small < black_level) >= black_fraction * small.size
+
+
+# Class: DecodedClip
+# Description: the result of decode_clip. frames is one contiguous (n, height, width, 3) uint8 array.
+# frame_count is the number of frames read from the file and empty_frames how many of them were found empty
+# (only counted when check_empty is on; with stop_on_empty the decode ends at the first one).
+class DecodedClip():
+
+    def __init__(self, frames, fps, frame_count, empty_frames):
+        self.frames = frames
+        self.fps = fps
+        self.frame_count = frame_count
+        self.empty_frames = empty_frames
+
+
+# Function: decode_clip
+# Description: reads an avi exactly once. Every frame_stride-th frame (up to max_frames of them) is resized
+# straight into a preallocated frame stack at dsize, while the empty frame statistics are gathered on the way.
+# When check_empty is off, skipped frames are only grabbed and decoding stops at max_frames, so a long clip can
+# be previewed from a subsample. When it is on, every frame still has to be looked at to know the clip is clean.
+# Returns None if the video cannot be opened.
+def decode_clip(video_name, dsize=None, frame_stride=1, max_frames=None, check_empty=True, stop_on_empty=False,
+                black_fraction=None, black_level=8, keep_frames=True):
+    cap = open_capture(video_name)
+    if not cap.isOpened():
+        return None
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    expected = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    stack = None
+    kept = 0
+    position = 0
+    empty_frames = 0
+    while True:
+        full = max_frames is not None and kept >= max_frames
+        wanted = keep_frames and not full and position % frame_stride == 0
+        if not wanted and not check_empty:
+            if full or not keep_frames or not cap.grab():
+                break
+            position += 1
+            continue
+
+        _, frame = cap.read()
+        if frame is None:
+            break
+        position += 1
+        if check_empty and frame_is_empty(frame, black_fraction, black_level):
+            empty_frames += 1
+            if stop_on_empty:
+                break
+        if not wanted:
+            continue
+
+        if stack is None:
+            height, width = (dsize[1], dsize[0]) if dsize is not None else frame.shape[:2]
+            capacity = max(1, (expected + frame_stride - 1) // frame_stride)
+            if max_frames is not None:
+                capacity = min(capacity, max_frames)
+            stack = np.empty((capacity, height, width, 3), dtype=np.uint8)
+        elif kept == len(stack):
+            stack = np.concatenate((stack, np.empty_like(stack)))
+        if dsize is not None:
+            cv2.resize(frame, dsize, dst=stack[kept], interpolation=cv2.INTER_CUBIC)
+        else:
+            stack[kept] = frame
+        kept += 1
+    cap.release()
+
+    if stack is None:
+        height, width = (dsize[1], dsize[0]) if dsize is not None else (0, 0)
+        stack = np.empty((0, height, width, 3), dtype=np.uint8)
+    elif kept < len(stack):
+        # The frame count reported by OpenCV was too high; don't hold on to the unused tail.
+        stack = stack[:kept].copy()
+    return DecodedClip(stack, fps, position, empty_frames)
+
+
+# Function: clip_info
+# Description: the (fps, frame_count, width, height) OpenCV reports for a video without decoding it,
+# or None if it cannot be opened.
+def clip_info(video_name):
+    cap = open_capture(video_name)
+    if not cap.isOpened():
+        return None
+    info = (cap.get(cv2.CAP_PROP_FPS), int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+            int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    cap.release()
+    return info
+
+
+# Function: kept_frame_count
+# Description: how many frames decode_clip keeps of frame_count with the given stride and limit.
+def kept_frame_count(frame_count, frame_stride=1, max_frames=None):
+    kept = (frame_count + frame_stride - 1) // frame_stride
+    return min(kept, max_frames) if max_frames is not None else kept
+
+
+# Class: ClipStream
+# Description: plays a clip straight from the file for when its frames are too big to keep in memory.
+# It is indexed like a decode_clip frame stack (every frame_stride-th frame, at most max_frames of them) but only
+# holds the last frame read. Playback moves forward one frame at a time; asking for an earlier frame (the loop
+# back to the start) reopens the file. If the file ends early, the last frame is repeated.
+class ClipStream():
+
+    def __init__(self, video_name, frame_stride=1, max_frames=None, info=None):
+        self.video_name = video_name
+        self.frame_stride = frame_stride
+        info = info if info is not None else clip_info(video_name)
+        self.fps, frame_count = (info[0], info[1]) if info is not None else (0, 0)
+        self.length = max(1, kept_frame_count(frame_count, frame_stride, max_frames))
+        self.cap = None
+        self.position = 0
+        self.index = -1
+        self.frame = None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index == self.index:
+            return self.frame
+        if self.cap is None or index < self.index:
+            self.close()
+            self.cap = open_capture(self.video_name)
+            self.position = 0
+            self.index = -1
+        target = index * self.frame_stride
+        while self.position < target and self.cap.grab():
+            self.position += 1
+        if self.position == target:
+            _, frame = self.cap.read()
+            if frame is not None:
+                self.position += 1
+                self.frame = frame
+                self.index = index
+        return self.frame
+
+    def close(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+
+# Function: fit_labels
+# Description: walk through the category labels and pick a scaling factor such that they all fit vertically and
+# only take up 10% of the horizontal space (centered) and 70% of the vertical space.
+# Returns (label_scale, label_width, label_height). The getTextSize search only depends on the display size and
+# the category strings, so it is memoised on exactly those.
+@lru_cache(maxsize=32)
+def fit_labels(display_sizes, category_strings):
+    label_scale = 100
+    label_height = np.inf
+    label_width = np.inf
+    for j in range(len(category_strings)):
+        while label_height > (display_sizes[1] / len(category_strings)) * .7:
+            label_scale = label_scale * .9
+            (label_width, label_height), baseline = cv2.getTextSize(category_strings[j], cv2.FONT_HERSHEY_SIMPLEX,
+                                                                    label_scale, int(2 * label_scale))
+            label_height = label_height + baseline
+        while label_width > (display_sizes[0] * 2 * .1):
+            label_scale = label_scale * .9
+            (label_width, label_height), baseline = cv2.getTextSize(category_strings[j], cv2.FONT_HERSHEY_SIMPLEX,
+                                                                    label_scale, int(2 * label_scale))
+            label_height = label_height + baseline
+    return label_scale, label_width, label_height
+
+
+# Function: label_overlay
+# Description: renders the category labels once into a coverage mask of the whole (image + video) display.
+# Returns the bounding box (top, bottom, left, right) of the drawn pixels and the mask cropped to it as a
+# (height, width, 1) float32 alpha, so compose_frames only has to blend the few pixels the text covers.
+# Using the coverage as alpha keeps anti-aliased text looking the same as when it is drawn onto each frame.
+# Memoised like fit_labels.
+@lru_cache(maxsize=32)
+def label_overlay(display_sizes, category_strings):
+    label_scale, label_width, label_height = fit_labels(display_sizes, category_strings)
+    canvas = np.zeros((display_sizes[1], display_sizes[0] * 2), dtype=np.uint8)
+    for j in range(len(category_strings)):
+        cv2.putText(canvas, category_strings[j],
+                    (int(display_sizes[0] - label_width / 2), label_height * (j + 1) + 1),
+                    cv2.FONT_HERSHEY_SIMPLEX, label_scale, 255, int(label_scale * 2))
+    rows = np.flatnonzero(canvas.any(axis=1))
+    columns = np.flatnonzero(canvas.any(axis=0))
+    if not len(rows):
+        return (0, 0, 0, 0), np.zeros((0, 0, 1), dtype=np.float32)
+    top, bottom, left, right = rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+    alpha = canvas[top:bottom, left:right, np.newaxis] / np.float32(255)
+    alpha.flags.writeable = False
+    return (top, bottom, left, right), alpha
+
+
+# Function: compose_frames
+# Description: builds the displayed frames for a sample in one preallocated (n, height, width * 2, 3) RGB buffer:
+# the still image on the left, the video frames on the right and the cached label overlay on top.
+# Both inputs are BGR as OpenCV delivers them; the output is RGB so it can be handed to wx as is.
+def compose_frames(display_image, frames, display_sizes, category_strings, label_color=(255, 0, 0)):
+    width = display_sizes[0]
+    composed = np.empty((len(frames), display_sizes[1], width * 2, 3), dtype=np.uint8)
+    composed[:, :, :width] = display_image[:, :, ::-1]
+    composed[:, :, width:] = frames[..., ::-1]
+    (top, bottom, left, right), alpha = label_overlay(tuple(display_sizes), tuple(category_strings))
+    region = composed[:, top:bottom, left:right]
+    region[:] = region * (1 - alpha) + np.asarray(label_color, dtype=np.float32) * alpha
+    return composed
+
+
+# Function: compose_grid
+# Description: lays out one frame of the grid view: a columns x rows page of cells of cell_size, each with the
+# thumbnail image on the left and the thumbnail video on the right (its frame_index-th frame, looping short
+# clips). cells holds (image, frames) pairs in BGR, or None for an empty cell; highlights maps cell numbers to
+# the RGB colour of the frame drawn around them. Returns an RGB page ready for wx.
+def compose_grid(cells, columns, rows, cell_size, frame_index, highlights={}, border=2):
+    cell_width, cell_height = cell_size
+    page = np.zeros((rows * cell_height, columns * cell_width, 3), dtype=np.uint8)
+    for i, cell in enumerate(cells):
+        if cell is None:
+            continue
+        image, frames = cell
+        top = (i // columns) * cell_height + border
+        left = (i % columns) * cell_width + border
+        height, width = image.shape[:2]
+        page[top:top + height, left:left + width] = image[:, :, ::-1]
+        if len(frames):
+            page[top:top + height, left + width:left + 2 * width] = frames[frame_index % len(frames)][:, :, ::-1]
+        if i in highlights:
+            cv2.rectangle(page, (left - border, top - border),
+                          (left - border + cell_width - 1, top - border + cell_height - 1),
+                          highlights[i], border)
+    return page
+
+
+# Function: resize_frames
+# Description: resizes a whole frame stack into one preallocated stack at dsize.
+def resize_frames(frames, dsize, interpolation=cv2.INTER_CUBIC):
+    resized = np.empty((len(frames), dsize[1], dsize[0]) + frames.shape[3:], dtype=frames.dtype)
+    for i in range(len(frames)):
+        cv2.resize(frames[i], dsize, dst=resized[i], interpolation=interpolation)
+    return resized
+
+
+# Class: PlaybackClock
+# Description: works out which frame of a looping clip should be on screen from the time since playback
+# started, instead of counting timer ticks. Frames are dropped when the display falls behind and held when
+# it is early, so a clip plays in real time at any speed. Each loop starts by holding the first frame for
+# loop_pause seconds so the beginning of the clip is easy to spot. A clip reporting no frame rate is played
+# at default_fps. rate is the base playback rate relative to the clip's own; speed multiplies it.
+class PlaybackClock():
+
+    def __init__(self, rate=1.0, loop_pause=0.5, default_fps=25, clock=time.perf_counter):
+        self.rate = rate
+        self.loop_pause = loop_pause
+        self.default_fps = default_fps
+        self.clock = clock
+        self.speed = 1.0
+        self.fps = default_fps
+        self.frame_count = 1
+        self.start_time = clock()
+
+    # Function: start
+    # Description: starts a clip from its first frame (including the pause).
+    def start(self, fps, frame_count):
+        self.fps = fps if fps and fps > 0 else self.default_fps
+        self.frame_count = max(1, frame_count)
+        self.start_time = self.clock()
+
+    def frames_per_second(self):
+        return self.fps * self.rate * self.speed
+
+    def loop_seconds(self):
+        return self.loop_pause + self.frame_count / self.frames_per_second()
+
+    # Function: set_speed
+    # Description: changes the speed without jumping: the frame on screen stays where it is.
+    def set_speed(self, speed):
+        now = self.clock()
+        position = (now - self.start_time) % self.loop_seconds()
+        if position > self.loop_pause:
+            position = self.loop_pause + (position - self.loop_pause) * self.speed / speed
+        self.speed = speed
+        self.start_time = now - position
+
+    # Function: frame_at
+    # Description: the index of the frame to show now (or at the given clock time).
+    def frame_at(self, now=None):
+        position = ((self.clock() if now is None else now) - self.start_time) % self.loop_seconds()
+        if position < self.loop_pause:
+            return 0
+        # The small epsilon keeps float error from flipping a frame boundary, e.g. right after set_speed.
+        return min(int((position - self.loop_pause) * self.frames_per_second() + 1e-9), self.frame_count - 1)
+
+    # Function: seconds_to_next_frame
+    # Description: how long the current frame stays on screen, to schedule the next repaint.
+    def seconds_to_next_frame(self, now=None):
+        position = ((self.clock() if now is None else now) - self.start_time) % self.loop_seconds()
+        if position < self.loop_pause:
+            return self.loop_pause - position if self.frame_count > 1 else self.loop_seconds() - position
+        frame_seconds = 1 / self.frames_per_second()
+        played = position - self.loop_pause
+        return frame_seconds - played % frame_seconds
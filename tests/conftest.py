@@ -0,0 +1,18 @@
+import os
+import sys
+import pytest
+
+# The SortingHat modules sit at the top of the repository rather than in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Fixture: make_pair
+# Description: writes a jpg/avi sample pair whose files hold their own names, so a test can tell them apart.
+@pytest.fixture
+def make_pair():
+    def make(directory, stem):
+        os.makedirs(directory, exist_ok=True)
+        for extension in ('.avi', '.jpg'):
+            with open(os.path.join(directory, stem + extension), 'w') as f:
+                f.write(stem + extension)
+    return make
@@ -0,0 +1,107 @@
+import os
+import time
+from SortingHatClaims import ClaimManager
+
+
+def make_managers(tmp_path, count=2, lease_seconds=120):
+    input_directory = str(tmp_path / 'input')
+    managers = []
+    for i in range(count):
+        claims = ClaimManager(input_directory, f"annotator{i}", chunk_size=3, lease_seconds=lease_seconds,
+                              retry_seconds=0)
+        claims.start()
+        managers.append(claims)
+    return input_directory, managers
+
+
+def test_annotators_never_claim_the_same_chunk(tmp_path):
+    input_directory, (first, second) = make_managers(tmp_path)
+    folders = {os.path.join(input_directory, f"video{i}"): [f"sample_{i}_{j}" for j in range(7)] for i in range(3)}
+    for directory, stems in folders.items():
+        first.add_batch(directory, stems)
+    # The second one scans after a sample was sorted; it still gets the chunks of the first one's manifest.
+    for directory, stems in folders.items():
+        second.add_batch(directory, stems[1:])
+    claimed = {first.owner: [], second.owner: []}
+    while True:
+        chunks = [(claims.owner, claims.claim_next()) for claims in (first, second)]
+        if all(chunk is None for _, chunk in chunks):
+            break
+        for owner, chunk in chunks:
+            if chunk is not None:
+                claimed[owner].append(chunk)
+    assert claimed[first.owner] and claimed[second.owner]
+    keys = [chunk[0] for chunks in claimed.values() for chunk in chunks]
+    assert len(keys) == len(set(keys)) == 9
+    stems = [stem for chunks in claimed.values() for _, _, chunk in chunks for stem in chunk]
+    assert len(stems) == len(set(stems))
+    # Only the sample sorted already may be missing, when the second one got its chunk.
+    assert set(stems) >= {stem for folder in folders.values() for stem in folder[1:]}
+
+
+def test_an_expired_claim_is_taken_over(tmp_path):
+    input_directory, (first, second) = make_managers(tmp_path)
+    directory = os.path.join(input_directory, 'video0')
+    for claims in (first, second):
+        claims.add_batch(directory, ['a', 'b'])
+    key = first.claim_next()[0]
+    assert second.claim_next() is None
+
+    # The first annotator's computer went to sleep and didn't renew its claim for longer than the lease.
+    expired = time.time() - first.lease_seconds - 1
+    os.utime(first.claim_path(key, 0), (expired, expired))
+    assert second.claim_next()[0] == key
+    assert second.owns(key) and not first.owns(key)
+    assert first.renew(force=True) == [key]
+    assert key not in first.held
+    assert second.renew(force=True) == []
+
+    second.finish(key)
+    assert not os.path.exists(second.claim_path(key, 0)) and not os.path.exists(second.claim_path(key, 1))
+    third = ClaimManager(input_directory, 'annotator2', chunk_size=3, retry_seconds=0)
+    third.add_batch(directory, ['a', 'b'])
+    assert third.claim_next() is None and not third.outstanding()
+
+
+def test_released_claims_are_taken_over_right_away(tmp_path):
+    input_directory, (first, second) = make_managers(tmp_path)
+    directory = os.path.join(input_directory, 'video0')
+    for claims in (first, second):
+        claims.add_batch(directory, ['a', 'b', 'c', 'd'])
+    held = {first.claim_next()[0], first.claim_next()[0]}
+    assert second.claim_next() is None
+
+    first.release()
+    assert not first.held
+    taken = {second.claim_next()[0], second.claim_next()[0]}
+    assert taken == held
+    assert all(second.owns(key) for key in taken)
+
+
+def test_closing_the_session_releases_without_claiming_ahead(tmp_path, make_pair):
+    from SortingHatEngine import SortingHatEngine
+
+    input_directory, (other,) = make_managers(tmp_path, count=1)
+    for i in range(12):
+        make_pair(input_directory, f"sample_{i:02d}")
+    engine = SortingHatEngine()
+    engine.resume_session = False
+    engine.claims = ClaimManager(input_directory, 'annotator1', chunk_size=3, claim_ahead=3, retry_seconds=0)
+    engine.prepare(['walking', 'grooming'], ['w', 'g'], input_directory, str(tmp_path / 'output'))
+    while not engine.scan_complete:
+        engine.poll_scanner(wait=True)
+    assert len(engine.behavior_sample_paths) == 3
+    for _ in range(3):
+        engine.sort_sample(0)
+    held = set(engine.claims.held)
+    # However short of samples it is, closing claims nothing more.
+    engine.claims.claim_ahead = 100
+    engine.close_session()
+    assert not engine.claims.held
+
+    other.add_batch(input_directory, sorted(stem[:-4] for stem in os.listdir(input_directory)
+                                            if stem.endswith('.avi')))
+    chunks = [other.claim_next() for _ in range(4)]
+    assert chunks[-1] is None
+    # Only the chunks held before closing were claimed by the engine; the rest are claimed fresh.
+    assert all(other.generations[key] == (1 if key in held else 0) for key, _, _ in chunks[:3])
@@ -0,0 +1,112 @@
+import os
+import sys
+import subprocess
+from SortingHatEngine import JOURNAL_FILE_NAME, SortingHatEngine
+from SortingHatRegistry import SampleRegistry
+
+
+def make_engine(tmp_path, make_pair=None, stems=()):
+    engine = SortingHatEngine()
+    engine.input_image_directory = str(tmp_path / 'input')
+    engine.output_image_directory = str(tmp_path / 'output')
+    engine.behavior_names = ['walking', 'grooming']
+    engine.category_directories = [engine.make_category_directory(name) for name in engine.behavior_names]
+    if make_pair is not None:
+        for stem in stems:
+            make_pair(engine.input_image_directory, stem)
+        engine.behavior_sample_paths = SampleRegistry((engine.input_image_directory, stem) for stem in stems)
+    return engine
+
+
+def state(engine):
+    return (list(engine.behavior_sample_paths), engine.current_index, list(engine.undo_stack),
+            list(engine.redo_stack))
+
+
+def test_engine_imports_no_display_modules():
+    # In a fresh interpreter, since other tests may have loaded them already.
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, SortingHatEngine; '
+                             'print(sorted({"wx", "cv2", "numpy"} & set(sys.modules)))'],
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            capture_output=True, text=True, check=True).stdout
+    assert loaded.strip() == '[]'
+
+
+def test_session_round_trip_through_the_journal(tmp_path, make_pair):
+    stems = [f"sample_{i}" for i in range(12)]
+    engine = make_engine(tmp_path, make_pair, stems)
+    engine.save_session()
+    engine.set_current_index(3)
+    engine.sort_sample(0)
+    engine.sort_sample(1)
+    engine.sort_samples([0, 2, 5], 1)
+    engine.undo()
+    engine.redo()
+    engine.undo()
+    engine.drop_sample(6)
+    engine.set_current_index(4)
+    engine.sort_sample(0)
+    engine.undo()
+    expected = state(engine)
+    assert os.path.exists(os.path.join(engine.category_directories[0], 'sample_3.avi'))
+    engine.journal_file.close()
+
+    resumed = make_engine(tmp_path)
+    assert resumed.load_session()
+    assert state(resumed) == expected
+    # The history still works after resuming, and the files follow it.
+    sample = resumed.undo()
+    assert os.path.exists(os.path.join(*sample) + '.avi')
+    assert resumed.redo() == sample
+    assert not os.path.exists(os.path.join(*sample) + '.avi')
+
+
+def test_session_snapshot_and_compaction_agree(tmp_path, make_pair):
+    stems = [f"sample_{i}" for i in range(8)]
+    engine = make_engine(tmp_path, make_pair, stems)
+    engine.session_compact_every = 3
+    engine.save_session()
+    for category_index in (0, 1, 0, 1, 0):
+        engine.sort_sample(category_index)
+    engine.undo()
+    expected = state(engine)
+    engine.journal_file.close()
+
+    resumed = make_engine(tmp_path)
+    assert resumed.load_session()
+    assert state(resumed) == expected
+
+
+def test_replay_stops_at_a_line_cut_short(tmp_path, make_pair):
+    engine = make_engine(tmp_path, make_pair, ['a', 'b', 'c'])
+    engine.save_session()
+    engine.sort_sample(0)
+    expected = state(engine)
+    engine.sort_sample(0)
+    engine.journal_file.close()
+    journal_path = os.path.join(engine.output_image_directory, JOURNAL_FILE_NAME)
+    with open(journal_path, 'r') as f:
+        lines = f.read().splitlines()
+    with open(journal_path, 'w') as f:
+        f.write('\n'.join(lines[:-1] + [lines[-1][:4]]))
+
+    resumed = make_engine(tmp_path)
+    assert resumed.load_session()
+    assert state(resumed) == expected
+
+
+def test_journal_of_another_snapshot_is_ignored(tmp_path, make_pair):
+    engine = make_engine(tmp_path, make_pair, ['a', 'b', 'c'])
+    engine.save_session()
+    expected = state(engine)
+    engine.sort_sample(0)
+    engine.journal_file.close()
+    journal_path = os.path.join(engine.output_image_directory, JOURNAL_FILE_NAME)
+    with open(journal_path, 'r') as f:
+        lines = f.read().splitlines()
+    with open(journal_path, 'w') as f:
+        f.write('\n'.join(['{"generation": 99}'] + lines[1:]) + '\n')
+
+    resumed = make_engine(tmp_path)
+    assert resumed.load_session()
+    assert state(resumed) == expected
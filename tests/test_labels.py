@@ -0,0 +1,79 @@
+import os
+import SortingHatLabels
+from SortingHatLabels import LabelStore, commit_labels
+
+
+def test_commit_labels_can_be_restarted(tmp_path, make_pair, monkeypatch):
+    source = str(tmp_path / 'input')
+    categories = str(tmp_path / 'categories')
+    store = LabelStore(str(tmp_path / 'labels.sqlite'), source)
+    stems = [f"sample_{i}" for i in range(10)]
+    for i, stem in enumerate(stems):
+        make_pair(source, stem)
+        store.record(source, stem, 'walking' if i % 2 else 'grooming')
+    assert store.pending == 10
+
+    # The first commit dies after a few samples, one of them only halfway (its avi is in place, its jpg isn't).
+    commit_sample = SortingHatLabels.commit_sample
+    committed = []
+
+    def crashing_commit_sample(row, categories_directory, keep_input=False):
+        if len(committed) == 3:
+            category_directory = os.path.join(categories_directory, row[2])
+            os.rename(os.path.join(row[0], row[1] + '.avi'), os.path.join(category_directory, row[1] + '.avi'))
+            raise KeyboardInterrupt
+        committed.append(row)
+        return commit_sample(row, categories_directory, keep_input)
+
+    monkeypatch.setattr(SortingHatLabels, 'commit_sample', crashing_commit_sample)
+    try:
+        commit_labels(store, categories, workers=1, batch_size=2, progress=False)
+    except KeyboardInterrupt:
+        pass
+    monkeypatch.setattr(SortingHatLabels, 'commit_sample', commit_sample)
+    # Only the batch that was finished counts as committed.
+    assert store.pending == 8
+
+    summary = commit_labels(store, categories, workers=2, batch_size=4, progress=False)
+    assert summary['committed'] == 8 and summary['failed'] == 0
+    assert store.pending == 0
+    assert os.listdir(source) == []
+    for i, stem in enumerate(stems):
+        category_directory = os.path.join(categories, 'walking' if i % 2 else 'grooming')
+        for extension in ('.avi', '.jpg'):
+            with open(os.path.join(category_directory, stem + extension), 'r') as f:
+                assert f.read() == stem + extension
+
+    # Nothing is left to do the third time.
+    assert commit_labels(store, categories, progress=False)['committed'] == 0
+    store.close()
+
+
+def test_commit_with_keep_input_links_and_can_be_repeated(tmp_path, make_pair):
+    source = str(tmp_path / 'input')
+    categories = str(tmp_path / 'categories')
+    store = LabelStore(str(tmp_path / 'labels.sqlite'), source)
+    make_pair(source, 'a')
+    store.record(source, 'a', 'walking')
+    assert commit_labels(store, categories, keep_input=True, progress=False)['committed'] == 1
+    assert sorted(os.listdir(source)) == ['a.avi', 'a.jpg']
+    assert os.path.samefile(os.path.join(source, 'a.avi'), os.path.join(categories, 'walking', 'a.avi'))
+
+    # Labelling it again (e.g. after an undo) and committing again leaves the links as they are.
+    store.record(source, 'a', 'walking')
+    assert commit_labels(store, categories, keep_input=True, progress=False)['committed'] == 1
+    assert sorted(os.listdir(os.path.join(categories, 'walking'))) == ['a.avi', 'a.jpg']
+    store.close()
+
+
+def test_undo_before_commit_only_drops_the_label(tmp_path, make_pair):
+    source = str(tmp_path / 'input')
+    store = LabelStore(str(tmp_path / 'labels.sqlite'), source)
+    make_pair(source, 'a')
+    store.record(source, 'a', 'walking')
+    assert store.labelled_stems(source) == {'a'}
+    assert store.remove(source, 'a') is False
+    assert store.pending == 0
+    assert commit_labels(store, str(tmp_path / 'categories'), progress=False)['committed'] == 0
+    assert sorted(os.listdir(source)) == ['a.avi', 'a.jpg']
+    store.close()
@@ -0,0 +1,92 @@
+import os
+import pytest
+from SortingHatMover import PairMover
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+@pytest.fixture(params=['rename_pair', 'copy_pairs'])
+def mover(request, tmp_path, monkeypatch):
+    mover = PairMover(str(tmp_path / 'moves.journal'))
+    if request.param == 'copy_pairs':
+        # Take the cross-filesystem path even though the test directories share one.
+        monkeypatch.setattr(mover, 'same_filesystem', lambda source, destination: False)
+    mover.start()
+    yield mover
+    mover.close()
+
+
+def test_moves_pairs(tmp_path, make_pair, mover):
+    source, destination = str(tmp_path / 'input'), str(tmp_path / 'walking')
+    os.makedirs(destination)
+    for stem in ('a', 'b'):
+        make_pair(source, stem)
+        mover.submit(source, destination, stem)
+    mover.submit(destination, source, 'a')
+    mover.flush()
+    assert mover.failures.empty()
+    assert sorted(os.listdir(destination)) == ['b.avi', 'b.jpg']
+    assert sorted(os.listdir(source)) == ['a.avi', 'a.jpg']
+
+
+def test_rolls_back_a_pair_whose_destination_exists(tmp_path, make_pair, mover):
+    source, destination = str(tmp_path / 'input'), str(tmp_path / 'walking')
+    make_pair(source, 'a')
+    make_pair(source, 'b')
+    # Only the jpg is in the way: the avi goes first and must come back.
+    os.makedirs(destination)
+    with open(os.path.join(destination, 'a.jpg'), 'w') as f:
+        f.write('someone else')
+    mover.submit(source, destination, 'a')
+    mover.submit(source, destination, 'b')
+    mover.flush()
+
+    failed = mover.failures.get_nowait()
+    assert failed[:3] == (source, destination, 'a')
+    assert isinstance(failed[3], FileExistsError)
+    assert mover.failures.empty()
+    assert read(os.path.join(source, 'a.avi')) == 'a.avi'
+    assert read(os.path.join(source, 'a.jpg')) == 'a.jpg'
+    assert read(os.path.join(destination, 'a.jpg')) == 'someone else'
+    assert sorted(os.listdir(destination)) == ['a.jpg', 'b.avi', 'b.jpg']
+    assert mover.depth() == 0
+
+
+def test_recover_finishes_logged_moves(tmp_path, make_pair):
+    source, destination = str(tmp_path / 'input'), str(tmp_path / 'walking')
+    make_pair(source, 'a')
+    os.makedirs(destination)
+    log_path = str(tmp_path / 'moves.journal')
+    # A crash after the avi was moved and a copy of the jpg was started.
+    with open(log_path, 'w') as f:
+        f.write(f'["b",0,"{source}","{destination}","a"]\n')
+    os.rename(os.path.join(source, 'a.avi'), os.path.join(destination, 'a.avi'))
+    with open(os.path.join(destination, 'a.jpg.part'), 'w') as f:
+        f.write('a.j')
+
+    mover = PairMover(log_path)
+    mover.start()
+    mover.close()
+    assert sorted(os.listdir(destination)) == ['a.avi', 'a.jpg']
+    assert read(os.path.join(destination, 'a.jpg')) == 'a.jpg'
+    assert os.listdir(source) == []
+
+
+def test_recover_never_replaces_an_existing_destination(tmp_path, make_pair):
+    source, destination = str(tmp_path / 'input'), str(tmp_path / 'walking')
+    make_pair(source, 'a')
+    os.makedirs(destination)
+    with open(os.path.join(destination, 'a.avi'), 'w') as f:
+        f.write('someone else')
+    log_path = str(tmp_path / 'moves.journal')
+    with open(log_path, 'w') as f:
+        f.write(f'["b",0,"{source}","{destination}","a"]\n')
+
+    mover = PairMover(log_path)
+    mover.start()
+    mover.close()
+    assert read(os.path.join(destination, 'a.avi')) == 'someone else'
+    assert read(os.path.join(source, 'a.avi')) == 'a.avi'
@@ -0,0 +1,99 @@
+import random
+import pytest
+from SortingHatRegistry import SampleRegistry, UndoStack
+
+
+def test_registry_matches_a_plain_list():
+    rng = random.Random(7)
+    samples = [(f"in/{i // 10}", f"sample_{i}") for i in range(200)]
+    registry = SampleRegistry(samples)
+    plain = list(samples)
+    removed = []
+    for _ in range(2000):
+        action = rng.random()
+        if action < 0.45 and plain:
+            position = rng.randrange(len(plain))
+            sample_id = registry.remove_at(position)
+            removed.append((sample_id, plain.pop(position)))
+        elif action < 0.8 and removed:
+            sample_id, sample = removed.pop(rng.randrange(len(removed)))
+            position = registry.restore(sample_id)
+            # Restored samples go back to their place in the original order.
+            plain.insert(position, sample)
+        elif action < 0.9:
+            sample = ("in/new", f"late_{len(samples)}")
+            samples.append(sample)
+            registry.append(sample)
+            plain.append(sample)
+        if plain:
+            position = rng.randrange(len(plain))
+            assert registry[position] == plain[position]
+            assert registry[-1] == plain[-1]
+            assert registry.position_of(registry.sample_id(position)) == position
+        assert len(registry) == len(plain)
+        assert bool(registry) == bool(plain)
+    assert list(registry) == plain
+    # Samples keep the order they were added in, however often they were removed and restored.
+    remaining = set(plain)
+    assert plain == [sample for sample in samples if sample in remaining]
+    for sample_id, sample in removed:
+        assert registry.find(sample) == sample_id
+        assert not registry.alive[sample_id]
+    assert registry.find(("in/nowhere", "sample_0")) is None
+
+
+def test_registry_index_errors():
+    registry = SampleRegistry([("in", "a"), ("in", "b")])
+    registry.remove_at(0)
+    assert registry[0] == ("in", "b")
+    with pytest.raises(IndexError):
+        registry[1]
+
+
+def test_undo_stack_groups():
+    stack = UndoStack()
+    assert stack.group_size() == 0
+    stack.push(1, 0, 1)
+    group = stack.new_group()
+    for sample_id in (2, 3, 4):
+        stack.push(sample_id, 1, sample_id, group)
+    assert stack.group_size() == 3
+    next_group = stack.new_group()
+    assert next_group != group
+    stack.push(5, 0, 5, next_group)
+    assert stack.group_size() == 1
+    stack.pop()
+    assert [stack.pop()[0] for _ in range(stack.group_size())] == [4, 3, 2]
+    # A sample sorted on its own (group 0) is undone on its own.
+    assert stack.group_size() == 1
+    assert stack.pop() == (1, 0, 1, 0)
+    assert len(stack) == 0
+
+
+def test_undo_stack_groups_next_to_each_other_stay_apart():
+    stack = UndoStack()
+    first = stack.new_group()
+    stack.push(1, 0, 1, first)
+    stack.push(2, 0, 2, first)
+    second = stack.new_group()
+    stack.push(3, 0, 3, second)
+    stack.push(4, 0, 4, second)
+    assert stack.group_size() == 2
+    assert stack.discard(1) == (1, 0, 1, first)
+    assert stack.discard(1) is None
+    assert list(stack) == [(2, 0, 2, first), (3, 0, 3, second), (4, 0, 4, second)]
+
+
+def test_undo_stack_group_numbers_are_not_reused_after_discard():
+    stack = UndoStack()
+    first = stack.new_group()
+    stack.push(1, 0, 1, first)
+    stack.push(2, 0, 2, first)
+    stack.push(3, 0, 3)
+    second = stack.new_group()
+    assert second != first
+    stack.push(4, 0, 4, second)
+    stack.push(5, 0, 5, second)
+    # The move of the sample sorted on its own failed; the two groups around it must stay apart.
+    stack.discard(3)
+    assert stack.group_size() == 2